@@ -0,0 +1,228 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+"""
+On-disk cache of API responses, shared by the DeviantArt and Youtube clients.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from collections import namedtuple
+
+from sqlalchemy.exc import IntegrityError
+
+from myarchive.db.db import DB
+
+from myarchive.db.response_cache.tables import Base, CachedResponse
+
+# Get the module logger.
+LOGGER = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+
+# How long a response is served without asking the server again, by
+# namespace and endpoint prefix. The longest matching prefix wins. Endpoints
+# not listed here are never cached.
+DEFAULT_TTLS = {
+    "deviantart": {
+        "/deviation/metadata": 7 * DAY,
+        "/user/profile/": 7 * DAY,
+        "/user/whois": 7 * DAY,
+        "/gallery/folders": DAY,
+        "/collections/folders": DAY,
+        # Folder pages are kept short, since crawls stop at the first
+        # deviation we already have and so only ever see the newest pages.
+        "/gallery/": 60 * 60,
+        "/collections/": 60 * 60,
+    },
+    "youtube": {
+        "videoCategories": 30 * DAY,
+        "videos": DAY,
+        "playlists": 60 * 60,
+        "playlistItems": 60 * 60,
+    },
+}
+# Stale responses are kept this long past their TTL, so that they can still
+# be revalidated with ETag/Last-Modified instead of refetched.
+STALE_GRACE_PERIOD = 30 * DAY
+DEFAULT_MAX_ENTRIES = 100000
+# Cache hits are only written back to last_used_time this many at a time.
+TOUCH_BATCH_SIZE = 100
+# Stay well under SQLite's limit on bound parameters.
+QUERY_CHUNK_SIZE = 500
+
+CacheEntry = namedtuple(
+    "CacheEntry", ["body", "etag", "last_modified", "fresh"])
+
+
+class ResponseCacheDB(DB):
+    """
+    Stores API response bodies keyed by request. Clients call lookup() before
+    a request, serving fresh entries directly and sending the stored
+    ETag/Last-Modified for stale ones, then store() on a new response or
+    revalidated() on a 304.
+    """
+
+    def __init__(self,
+                 drivername=None, username=None, password=None, db_name=None,
+                 host=None, port=None, pool_size=5,
+                 ttls=None, max_entries=DEFAULT_MAX_ENTRIES):
+        super(ResponseCacheDB, self).__init__(
+            base=Base, drivername=drivername, username=username,
+            password=password, db_name=db_name, host=host, port=port,
+            pool_size=pool_size
+        )
+        self.metadata.create_all(self.engine)
+        self.ttls = ttls if ttls is not None else DEFAULT_TTLS
+        self.max_entries = max_entries
+        self._touched_lock = threading.Lock()
+        self._touched_keys = set()
+        self.evict()
+
+    def ttl_for(self, namespace, endpoint):
+        """Returns the TTL for an endpoint, or None if it isn't cached."""
+        matching_prefixes = [
+            prefix for prefix in self.ttls.get(namespace, {})
+            if endpoint.startswith(prefix)]
+        if not matching_prefixes:
+            return None
+        return self.ttls[namespace][max(matching_prefixes, key=len)]
+
+    @staticmethod
+    def request_key(namespace, endpoint, params):
+        """Hashes everything that identifies a request into one key."""
+        request_repr = json.dumps(
+            [namespace, endpoint, params], sort_keys=True, default=str)
+        return hashlib.md5(request_repr.encode("utf-8")).hexdigest()
+
+    def lookup(self, namespace, endpoint, params):
+        """
+        Returns a CacheEntry for the request, or None if the endpoint isn't
+        cached or we have nothing stored for it.
+        """
+        ttl = self.ttl_for(namespace, endpoint)
+        if ttl is None:
+            return None
+        cached_response = self.session.query(CachedResponse).\
+            filter_by(request_key=self.request_key(
+                namespace, endpoint, params)).one_or_none()
+        if cached_response is None:
+            return None
+        self._touch(cached_response.request_key)
+        return CacheEntry(
+            body=cached_response.body,
+            etag=cached_response.etag,
+            last_modified=cached_response.last_modified,
+            fresh=time.time() - cached_response.stored_time < ttl)
+
+    def _touch(self, request_key):
+        """Queues a last_used_time update for a cache hit."""
+        with self._touched_lock:
+            self._touched_keys.add(request_key)
+            flush = len(self._touched_keys) >= TOUCH_BATCH_SIZE
+        if flush:
+            self.flush_touched()
+
+    def flush_touched(self):
+        """Writes out last_used_time for the hits queued by lookup()."""
+        with self._touched_lock:
+            request_keys = list(self._touched_keys)
+            self._touched_keys.clear()
+        if not request_keys:
+            return
+        now = time.time()
+        for index in range(0, len(request_keys), QUERY_CHUNK_SIZE):
+            self.session.query(CachedResponse).\
+                filter(CachedResponse.request_key.in_(
+                    request_keys[index:index + QUERY_CHUNK_SIZE])).\
+                update({"last_used_time": now}, synchronize_session=False)
+        self.session.commit()
+
+    def store(self, namespace, endpoint, params, body, etag=None,
+              last_modified=None):
+        """Saves a response body, if the endpoint is one we cache."""
+        if self.ttl_for(namespace, endpoint) is None:
+            return
+        request_key = self.request_key(namespace, endpoint, params)
+        now = time.time()
+        cached_response = self.session.query(CachedResponse).\
+            filter_by(request_key=request_key).one_or_none()
+        if cached_response is None:
+            self.session.add(CachedResponse(
+                namespace=namespace,
+                endpoint=endpoint,
+                request_key=request_key,
+                body=body,
+                etag=etag,
+                last_modified=last_modified,
+                stored_time=now))
+        else:
+            cached_response.body = body
+            cached_response.etag = etag
+            cached_response.last_modified = last_modified
+            cached_response.stored_time = now
+            cached_response.last_used_time = now
+        try:
+            self.session.commit()
+        except IntegrityError:
+            # Another thread stored the same request first. Theirs is just as
+            # good.
+            self.session.rollback()
+
+    def revalidated(self, namespace, endpoint, params):
+        """Marks a stored response as fresh again after a 304."""
+        self.session.query(CachedResponse).\
+            filter_by(request_key=self.request_key(
+                namespace, endpoint, params)).\
+            update({"stored_time": time.time()})
+        self.session.commit()
+
+    def evict(self):
+        """
+        Drops entries that are past their TTL plus the grace period, then the
+        least recently used ones beyond max_entries.
+        """
+        self.flush_touched()
+        now = time.time()
+        evicted = 0
+        for namespace, endpoint_ttls in self.ttls.items():
+            for prefix, ttl in endpoint_ttls.items():
+                expired_query = self.session.query(CachedResponse).\
+                    filter(CachedResponse.namespace == namespace).\
+                    filter(CachedResponse.endpoint.startswith(prefix)).\
+                    filter(CachedResponse.stored_time <
+                           now - ttl - STALE_GRACE_PERIOD)
+                # Longer prefixes are left to their own TTLs.
+                for other_prefix in endpoint_ttls:
+                    if (other_prefix != prefix and
+                            other_prefix.startswith(prefix)):
+                        expired_query = expired_query.filter(
+                            ~CachedResponse.endpoint.startswith(other_prefix))
+                evicted += expired_query.delete(synchronize_session=False)
+
+        overflow = self.session.query(CachedResponse).count() - \
+            self.max_entries
+        if overflow > 0:
+            lru_ids = self.session.query(CachedResponse.id).\
+                order_by(CachedResponse.last_used_time).\
+                limit(overflow).subquery()
+            evicted += self.session.query(CachedResponse).\
+                filter(CachedResponse.id.in_(lru_ids.select())).\
+                delete(synchronize_session=False)
+        self.session.commit()
+        if evicted > 0:
+            LOGGER.debug("Evicted %s cached responses.", evicted)
+
+    def close(self):
+        """Evicts old entries and releases the session."""
+        self.evict()
+        self.session.remove()
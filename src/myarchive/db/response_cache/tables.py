@@ -0,0 +1,46 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+"""Definitions for the API response cache database."""
+
+from sqlalchemy import Column, Float, Integer, String, Text
+from sqlalchemy.ext.declarative import declarative_base
+
+
+Base = declarative_base()  # pylint:disable=C0103
+
+
+class CachedResponse(Base):
+    """A single API response body, plus what we need to revalidate it."""
+
+    __tablename__ = 'cached_responses'
+
+    id = Column(Integer, primary_key=True)
+    namespace = Column(String, nullable=False)
+    endpoint = Column(String, nullable=False)
+    request_key = Column(String, nullable=False, unique=True, index=True)
+    body = Column(Text, nullable=False)
+    etag = Column(String)
+    last_modified = Column(String)
+    stored_time = Column(Float, nullable=False)
+    last_used_time = Column(Float, nullable=False, index=True)
+
+    def __init__(self, namespace, endpoint, request_key, body, etag,
+                 last_modified, stored_time):
+        self.namespace = namespace
+        self.endpoint = endpoint
+        self.request_key = request_key
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_time = stored_time
+        self.last_used_time = stored_time
+
+    def __repr__(self):
+        return "<CachedResponse(namespace='%s', endpoint='%s')>" % (
+            self.namespace, self.endpoint)
@@ -13,3 +13,6 @@ from .file import TrackedFile
 from .tag import Tag
 from .twittertables import Tweet, TwitterUser
 from .datables import Deviation, DeviantArtUser
+from .ljtables import LJComment, LJEntry, LJHost, LJUser
+from .yttables import YTPlaylist, YTVideo
+from .shotwelltables import ShotwellAppliedTag, ShotwellSyncedMedia
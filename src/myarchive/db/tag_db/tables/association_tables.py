@@ -45,6 +45,14 @@ at_ljentry_tag = Table(
         "tag_id", Integer, ForeignKey("tags.tag_id"), primary_key=True),
     info="Association table for mapping LJ entries to tags and vice versa.")
 
+at_tweet_reply = Table(
+    'at_tweet_reply', Base.metadata,
+    Column("ancestor_id", Integer, primary_key=True),
+    Column("descendant_id", Integer, primary_key=True, index=True),
+    Column("depth", Integer, nullable=False),
+    info="Closure table mapping tweets to every tweet in their reply chain. "
+         "Ancestors may be tweets that haven't been fetched yet.")
+
 at_tweet_file = Table(
     'at_tweet_file', Base.metadata,
     Column("tweet_id", Integer, ForeignKey("tweets.id"), primary_key=True),
@@ -74,3 +82,12 @@ at_ytvideo_tag = Table(
     Column(
         "tag_id", Integer, ForeignKey("tags.tag_id"), primary_key=True),
     info="Association table for mapping youtube videos to tags and vice versa.")
+
+at_ytplaylist_ytvideo = Table(
+    "at_ytplaylist_ytvideo", Base.metadata,
+    Column("ytplaylist_id", Integer,
+           ForeignKey("ytplaylists.id"), primary_key=True),
+    Column("ytvideo_id", Integer,
+           ForeignKey("ytvideos.id"), primary_key=True, index=True),
+    info="Association table for mapping youtube playlists to videos and vice "
+         "versa.")
@@ -25,8 +25,10 @@ from myarchive.db.tag_db.tables.file import TrackedFile
 LOGGER = logging.getLogger(__name__)
 
 
-EXISTING_USERNAME_CACHE = list()
+EXISTING_USERNAME_CACHE = set()
 HASHTAG_REGEX = r'#([\d\w]+)'
+# Max. usernames the API takes per get_users call.
+USERS_BATCH_SIZE = 50
 
 
 class DeviantArtUser(Base):
@@ -94,27 +96,78 @@ class Deviation(Base):
         self.deviationid = deviationid
 
 
-def get_da_user(db_session, da_api, username, media_storage_path):
+def get_da_user(db_session, da_api, username, media_storage_path,
+                workers=None, rate_limiter=None):
     """
     Returns the DB user object if it exists, otherwise it grabs the user data
     from the API and stuffs it in the DB.
     """
-    global EXISTING_USERNAME_CACHE
+    get_da_users(
+        db_session=db_session,
+        da_api=da_api,
+        usernames=[username],
+        media_storage_path=media_storage_path,
+        workers=workers,
+        rate_limiter=rate_limiter)
+    return db_session.query(DeviantArtUser).\
+        filter_by(name=username).one_or_none()
+
+
+def get_da_users(db_session, da_api, usernames, media_storage_path,
+                 workers=None, rate_limiter=None):
+    """
+    Makes sure every one of usernames is in the DB. Names we haven't seen
+    before are looked up with the API (in bulk where the grant allows it),
+    their icons are fetched in workers' thread pool, and everything is
+    committed in one go. Lookups wait on rate_limiter, if one is given.
+    """
     if len(EXISTING_USERNAME_CACHE) == 0:
-        EXISTING_USERNAME_CACHE = [
-            username[0] for username in
-            db_session.query(DeviantArtUser.name).all()]
-    # Grab the User object from the API.
-    if username in EXISTING_USERNAME_CACHE:
-        da_user = db_session.query(DeviantArtUser).\
-            filter_by(name=username).one()
+        EXISTING_USERNAME_CACHE.update(
+            name for (name,) in db_session.query(DeviantArtUser.name))
+    unknown_usernames = sorted(set(usernames) - EXISTING_USERNAME_CACHE)
+    if not unknown_usernames:
+        return
+    # Mark them as seen up front, as failed lookups aren't worth retrying
+    # within a run.
+    EXISTING_USERNAME_CACHE.update(unknown_usernames)
+
+    # whois is only open to authorization_code grants. Anything else gets
+    # one profile lookup per user.
+    if da_api.standard_grant_type == "authorization_code":
+        batch_size = USERS_BATCH_SIZE
     else:
-        EXISTING_USERNAME_CACHE.append(username)
-        try:
-            user = da_api.get_user(username=username)
-        except DeviantartError:
-            LOGGER.error("Unable to obtain user data for %s", username)
-            return None
+        batch_size = 1
+
+    api_users = []
+    for index in range(0, len(unknown_usernames), batch_size):
+        batch = unknown_usernames[index:index + batch_size]
+        if batch_size > 1:
+            if rate_limiter is not None:
+                rate_limiter.wait()
+            try:
+                api_users.extend(da_api.get_users(usernames=batch))
+                continue
+            except DeviantartError as error:
+                LOGGER.error(
+                    "Bulk user lookup failed, looking users up one at a "
+                    "time: %s", error)
+        for username in batch:
+            if rate_limiter is not None:
+                rate_limiter.wait()
+            try:
+                api_users.append(da_api.get_user(username=username))
+            except DeviantartError:
+                LOGGER.error("Unable to obtain user data for %s", username)
+
+    EXISTING_USERNAME_CACHE.update(user.username for user in api_users)
+
+    icons_by_url = TrackedFile.download_files(
+        db_session=db_session,
+        media_path=media_storage_path,
+        urls=[user.usericon for user in api_users],
+        file_source="deviantart",
+        workers=workers)
+    for user in api_users:
         da_user = DeviantArtUser(
             userid=user.userid,
             name=user.username,
@@ -122,12 +175,6 @@ def get_da_user(db_session, da_api, username, media_storage_path):
             stats=str(user.stats),
             details=str(user.details)
         )
-        icon_file, existing = TrackedFile.download_file(
-            file_source="deviantart",
-            db_session=db_session,
-            media_path=media_storage_path,
-            url=user.usericon)
-        da_user.icon = icon_file
+        da_user.icon = icons_by_url.get(user.usericon)
         db_session.add(da_user)
-        db_session.commit()
-    return da_user
+    db_session.commit()
@@ -19,7 +19,7 @@ import shutil
 
 from hashlib import md5
 from urllib.parse import urlparse
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, bindparam
 from sqlalchemy.orm import backref, relationship
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -31,6 +31,9 @@ LOGGER = logging.getLogger(__name__)
 
 MAX_BUFFER = 16 * 2 ** 20
 
+# Stay well under SQLite's limit on bound parameters.
+QUERY_CHUNK_SIZE = 500
+
 FILE_SOURCE_PRIORITIES = {
     "deviantart": 5,
     "youtube": 4,
@@ -52,6 +55,8 @@ class TrackedFile(Base):
     filepath = Column(String)
     md5sum = Column(String(32), index=True)
     url = Column(String, index=True)
+    title = Column(String)
+    comment = Column(String)
 
     tags = relationship(
         "Tag",
@@ -226,6 +231,120 @@ class TrackedFile(Base):
             original_filename=filename,
             url=saved_url)
 
+    @classmethod
+    def download_files(cls, db_session, media_path, urls, file_source,
+                       workers=None):
+        """
+        Bulk version of download_file. URLs we already track are looked up in
+        one query and the rest are fetched in workers' thread pool (serially
+        if no WorkerPools is given) before being added to the DB. Returns a
+        dict of URL to TrackedFile; URLs that fail to download are left out.
+        """
+        urls = set(url for url in urls if url)
+        tracked_files_by_url = dict()
+        if not urls:
+            return tracked_files_by_url
+
+        for tracked_file in db_session.query(cls).filter(cls.url.in_(urls)):
+            tracked_files_by_url[tracked_file.url] = tracked_file
+
+        missing_urls = urls.difference(tracked_files_by_url)
+        if workers is not None:
+            fetched_urls = workers.thread_imap_unordered(
+                _fetch_url, missing_urls)
+        else:
+            fetched_urls = map(_fetch_url, missing_urls)
+        for url, file_buffer in fetched_urls:
+            if file_buffer is None:
+                continue
+            tracked_file, existing = TrackedFile.add_file(
+                file_source=file_source,
+                db_session=db_session,
+                media_path=media_path,
+                file_buffer=file_buffer,
+                original_filename=os.path.basename(urlparse(url).path),
+                url=url)
+            tracked_files_by_url[url] = tracked_file
+        return tracked_files_by_url
+
+    @classmethod
+    def attach_tags(cls, db_session, file_tag_ids):
+        """
+        Applies tags to many files without loading their tag collections.
+        Takes an iterable of (file id, tag_id) pairs, skips the ones already
+        in at_file_tag and inserts the rest with a single executemany. Leaves
+        committing to the caller. Returns the set of pairs added.
+        """
+        missing_pairs = set(file_tag_ids)
+        file_ids = list(set(file_id for file_id, _ in missing_pairs))
+        for index in range(0, len(file_ids), QUERY_CHUNK_SIZE):
+            existing_pairs = db_session.execute(
+                at_file_tag.select().where(
+                    at_file_tag.c.file_id.in_(
+                        file_ids[index:index + QUERY_CHUNK_SIZE])))
+            for row in existing_pairs:
+                missing_pairs.discard((row.file_id, row.tag_id))
+        if missing_pairs:
+            db_session.execute(
+                at_file_tag.insert(),
+                [{"file_id": file_id, "tag_id": tag_id}
+                 for file_id, tag_id in missing_pairs])
+        return missing_pairs
+
+    @classmethod
+    def detach_tag_pairs(cls, db_session, file_tag_ids):
+        """
+        Removes an iterable of (file id, tag_id) pairs from at_file_tag with
+        a single executemany. Leaves committing to the caller.
+        """
+        file_tag_ids = list(file_tag_ids)
+        if file_tag_ids:
+            db_session.execute(
+                at_file_tag.delete().
+                where(at_file_tag.c.file_id == bindparam("stale_file_id")).
+                where(at_file_tag.c.tag_id == bindparam("stale_tag_id")),
+                [{"stale_file_id": file_id, "stale_tag_id": tag_id}
+                 for file_id, tag_id in file_tag_ids])
+
+    @classmethod
+    def bulk_set_descriptions(cls, db_session, descriptions):
+        """
+        Sets title and comment on many files with one executemany. Takes a
+        dict of file id to (title, comment). Leaves committing to the caller.
+        """
+        if descriptions:
+            db_session.execute(
+                cls.__table__.update().
+                where(cls.__table__.c.id == bindparam("file_row_id")),
+                [{"file_row_id": file_id, "title": title, "comment": comment}
+                 for file_id, (title, comment) in descriptions.items()])
+
+    @classmethod
+    def detach_tags(cls, db_session, file_ids, tag_id):
+        """
+        Removes one tag from many files at once. Leaves committing to the
+        caller.
+        """
+        file_ids = list(file_ids)
+        for index in range(0, len(file_ids), QUERY_CHUNK_SIZE):
+            db_session.execute(
+                at_file_tag.delete().
+                where(at_file_tag.c.tag_id == tag_id).
+                where(at_file_tag.c.file_id.in_(
+                    file_ids[index:index + QUERY_CHUNK_SIZE])))
+
+
+def _fetch_url(url):
+    """Pool worker for TrackedFile.download_files."""
+    LOGGER.debug("Downloading %s...", url)
+    try:
+        media_request = requests.get(url)
+        media_request.raise_for_status()
+    except requests.RequestException as error:
+        LOGGER.error("Unable to download %s: %s", url, error)
+        return url, None
+    return url, media_request.content
+
 
 def get_md5sum_by_filename(file_id, filepath, block_size=2**20):
     with open(filepath, "rb") as fptr:
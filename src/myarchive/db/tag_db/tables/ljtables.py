@@ -10,13 +10,18 @@ from myarchive.db.tag_db.tables.association_tables import (
     at_ljcomment_tag, at_ljentry_tag)
 from myarchive.db.tag_db.tables.base import Base
 from sqlalchemy import (
-    Column, Integer, String, TIMESTAMP, ForeignKey, UniqueConstraint)
+    Column, Integer, String, TIMESTAMP, ForeignKey, UniqueConstraint,
+    bindparam)
 from sqlalchemy.orm import backref, relationship
 from sqlalchemy.orm.exc import NoResultFound
 
 from myarchive.db.tag_db.tables.tag import Tag
 
 
+# Stay well under SQLite's limit on bound parameters.
+QUERY_CHUNK_SIZE = 500
+
+
 class CircularDependencyError(Exception):
     """
     Specific exception for attempting to create a self-referential
@@ -51,6 +56,11 @@ class LJUser(Base):
     user_id = Column(Integer)
     username = Column(String, nullable=False)
     host_id = Column(Integer, ForeignKey("lj_hosts.id"), nullable=False)
+    # Sync state for this user's journal, in the same form backup.py keeps it
+    # in its journal dict.
+    last_entry = Column(String)
+    last_comment = Column(String)
+    last_comment_meta = Column(String)
 
     __table_args__ = (
         UniqueConstraint(user_id, host_id),
@@ -78,13 +88,55 @@ class LJUser(Base):
         self.username = username
 
     @classmethod
-    def get_user(cls, db_session, user_id, username):
+    def get_user(cls, db_session, user_id, username, lj_host=None):
+        query = db_session.query(cls).filter_by(user_id=user_id)
+        if lj_host is not None and lj_host.id is not None:
+            query = query.filter_by(host_id=lj_host.id)
         try:
-            ljuser = db_session.query(cls).filter_by(user_id=user_id).one()
+            ljuser = query.one()
         except NoResultFound:
             ljuser = LJUser(user_id=user_id, username=username)
         return ljuser
 
+    @classmethod
+    def get_users(cls, db_session, lj_host, usernames):
+        """
+        Returns a dict of user_id to LJUser for every user_id in usernames (a
+        dict of user_id to username), adding the ones lj_host doesn't have
+        yet. New users are flushed, so their row ids are usable right away.
+        """
+        lj_users = dict()
+        user_ids = list(usernames.keys())
+        if lj_host.id is not None:
+            for index in range(0, len(user_ids), QUERY_CHUNK_SIZE):
+                chunk_ids = user_ids[index:index + QUERY_CHUNK_SIZE]
+                for lj_user in db_session.query(cls).\
+                        filter(cls.host_id == lj_host.id).\
+                        filter(cls.user_id.in_(chunk_ids)):
+                    lj_users[lj_user.user_id] = lj_user
+        for user_id, username in usernames.items():
+            if user_id not in lj_users:
+                lj_user = cls(user_id=user_id, username=username)
+                lj_host.users.append(lj_user)
+                lj_users[user_id] = lj_user
+        db_session.flush()
+        return lj_users
+
+    def load_sync_state(self, journal):
+        """Copies the stored sync state into a backup.py journal dict."""
+        if self.last_entry is not None:
+            journal['last_entry'] = self.last_entry
+        if self.last_comment is not None:
+            journal['last_comment'] = self.last_comment
+        if self.last_comment_meta is not None:
+            journal['last_comment_meta'] = self.last_comment_meta
+
+    def save_sync_state(self, journal):
+        """Stores the sync state from a backup.py journal dict."""
+        self.last_entry = journal.get('last_entry')
+        self.last_comment = journal.get('last_comment')
+        self.last_comment_meta = journal.get('last_comment_meta')
+
 
 class LJEntry(Base):
     """Class representing an entry retrieved from a LJ-like service."""
@@ -98,6 +150,8 @@ class LJEntry(Base):
     text = Column(String)
     current_music = Column(String)
     user_id = Column(Integer, ForeignKey("lj_users.id"), nullable=False)
+    # Server time of the syncitems change we last stored this entry for.
+    synctime = Column(String)
 
     __table_args__ = (
         UniqueConstraint(itemid, user_id),
@@ -132,7 +186,8 @@ class LJEntry(Base):
             cls, db_session, lj_user, itemid, eventtime, subject, text,
             current_music, tag_list):
         try:
-            lj_entry = db_session.query(cls).filter_by(itemid=itemid).one()
+            lj_entry = db_session.query(cls).\
+                filter_by(itemid=itemid, user_id=lj_user.id).one()
         except NoResultFound:
             lj_entry = cls(
                 itemid, eventtime, subject, text, current_music)
@@ -143,6 +198,71 @@ class LJEntry(Base):
                 lj_entry.tags.append(tag)
         return lj_entry
 
+    @classmethod
+    def bulk_upsert(cls, db_session, lj_user, entries):
+        """
+        Stores lj_user's entries from a list of dicts of column values, each
+        with an extra "tag_names" list. Existing entries are only rewritten
+        (tags included) when their synctime differs from the stored one; new
+        ones are inserted with their tags in batches. Leaves committing to
+        the caller. Returns the number of entries inserted and updated.
+        """
+        entries_table = cls.__table__
+        existing_entries = dict(
+            (itemid, (row_id, synctime))
+            for itemid, row_id, synctime in
+            db_session.query(cls.itemid, cls.id, cls.synctime).
+            filter(cls.user_id == lj_user.id))
+
+        new_rows = []
+        updated_rows = []
+        tag_names_by_itemid = dict()
+        for entry in entries:
+            row = dict(entry)
+            tag_names = row.pop("tag_names")
+            if row["itemid"] in existing_entries:
+                row_id, synctime = existing_entries[row["itemid"]]
+                if synctime is not None and synctime == row["synctime"]:
+                    continue
+                row["row_id"] = row_id
+                updated_rows.append(row)
+            else:
+                row["user_id"] = lj_user.id
+                new_rows.append(row)
+            tag_names_by_itemid[row["itemid"]] = tag_names
+
+        if new_rows:
+            db_session.execute(entries_table.insert(), new_rows)
+        if updated_rows:
+            db_session.execute(
+                entries_table.update().
+                where(entries_table.c.id == bindparam("row_id")),
+                updated_rows)
+
+        # Replace the tags of everything we wrote.
+        if tag_names_by_itemid:
+            row_ids = dict(
+                db_session.query(cls.itemid, cls.id).
+                filter(cls.user_id == lj_user.id))
+            updated_row_ids = [row["row_id"] for row in updated_rows]
+            for index in range(0, len(updated_row_ids), QUERY_CHUNK_SIZE):
+                db_session.execute(
+                    at_ljentry_tag.delete().where(
+                        at_ljentry_tag.c.lj_entry_id.in_(
+                            updated_row_ids[index:index + QUERY_CHUNK_SIZE])))
+            tag_ids = Tag.get_tag_ids(
+                db_session=db_session,
+                tag_names=[
+                    tag_name for tag_names in tag_names_by_itemid.values()
+                    for tag_name in tag_names])
+            tag_rows = [
+                {"lj_entry_id": row_ids[itemid], "tag_id": tag_ids[tag_name]}
+                for itemid, tag_names in tag_names_by_itemid.items()
+                for tag_name in set(tag_names)]
+            if tag_rows:
+                db_session.execute(at_ljentry_tag.insert(), tag_rows)
+        return len(new_rows), len(updated_rows)
+
 
 class LJComment(Base):
     """Class representing a comment retrieved from a LJ-like service."""
@@ -157,6 +277,8 @@ class LJComment(Base):
     body = Column(String)
     date = Column(TIMESTAMP)
     parent_id = Column(Integer, ForeignKey("lj_comments.id"))
+    # A(ctive), S(creened), D(eleted) or F(rozen), as LJ's export has it.
+    state = Column(String)
 
     __table_args__ = (
         UniqueConstraint(itemid, entry_id, user_id),
@@ -197,6 +319,64 @@ class LJComment(Base):
             parent_comment.add_child(lj_comment)
         return lj_comment
 
+    @classmethod
+    def get_itemid_map(cls, db_session, lj_user):
+        """
+        Returns a dict of LJ comment itemid to row id for every comment
+        stored on lj_user's journal.
+        """
+        return dict(
+            db_session.query(cls.itemid, cls.id).
+            join(LJEntry, cls.entry_id == LJEntry.id).
+            filter(LJEntry.user_id == lj_user.id))
+
+    @classmethod
+    def bulk_insert(cls, db_session, rows):
+        """
+        Inserts a list of column dicts with a single executemany. Leaves
+        committing to the caller.
+        """
+        if rows:
+            db_session.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def bulk_link_parents(cls, db_session, parent_ids):
+        """
+        Sets parent_id on many comments at once, from a dict of comment row
+        id to parent row id.
+        """
+        if parent_ids:
+            db_session.execute(
+                cls.__table__.update().
+                where(cls.__table__.c.id == bindparam("comment_id")).
+                values(parent_id=bindparam("parent_row_id")),
+                [{"comment_id": comment_id, "parent_row_id": parent_id}
+                 for comment_id, parent_id in parent_ids.items()])
+
+    @classmethod
+    def bulk_update_meta(cls, db_session, lj_user, comment_meta):
+        """
+        Refreshes the poster and state of lj_user's stored comments from a
+        dict of LJ comment itemid to (poster row id, state), with a single
+        executemany. Comments we don't have are ignored. Leaves committing to
+        the caller. Returns the number of comments updated.
+        """
+        comment_row_ids = cls.get_itemid_map(
+            db_session=db_session, lj_user=lj_user)
+        rows = [
+            {"comment_id": comment_row_ids[itemid],
+             "poster_row_id": user_row_id, "comment_state": state}
+            for itemid, (user_row_id, state) in comment_meta.items()
+            if itemid in comment_row_ids]
+        if rows:
+            db_session.execute(
+                cls.__table__.update().
+                where(cls.__table__.c.id == bindparam("comment_id")).
+                values(user_id=bindparam("poster_row_id"),
+                       state=bindparam("comment_state")),
+                rows)
+        return len(rows)
+
     def add_child(self, lj_comment):
         """Creates an instance, performing a safety check first."""
         if self in lj_comment.children:
@@ -0,0 +1,150 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+"""
+Module containing the bookkeeping for incremental Shotwell imports.
+"""
+
+import logging
+
+from sqlalchemy import (
+    Column, Integer, String, ForeignKey, UniqueConstraint, bindparam)
+
+from myarchive.db.tag_db.tables.base import Base
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Stay well under SQLite's limit on bound parameters.
+QUERY_CHUNK_SIZE = 500
+
+
+class ShotwellSyncedMedia(Base):
+    """
+    A PhotoTable/VideoTable/BackingPhotoTable row we have imported from a
+    Shotwell library, along with the file stats and description Shotwell had
+    for it at the time. Rows whose stats haven't changed since are skipped on
+    the next import.
+    """
+
+    __tablename__ = 'shotwell_synced_media'
+
+    id = Column(Integer, index=True, primary_key=True)
+    library = Column(
+        String, nullable=False,
+        doc="Path of the Shotwell DB this row was imported from.")
+    source_id = Column(
+        String, nullable=False,
+        doc="Shotwell source ID, e.g. thumb000000000000002a. (Backing "
+            "photos, which Shotwell doesn't give IDs, use a backing prefix.)")
+    filepath = Column(String)
+    filesize = Column(Integer)
+    timestamp = Column(Integer)
+    md5sum = Column(String(32))
+    title = Column(String)
+    comment = Column(String)
+    file_id = Column(Integer, ForeignKey("files.id"))
+
+    __table_args__ = (
+        UniqueConstraint(library, source_id),
+    )
+
+    @classmethod
+    def get_synced(cls, db_session, library):
+        """Returns a dict of source_id to ShotwellSyncedMedia for library."""
+        return dict(
+            (synced_media.source_id, synced_media)
+            for synced_media in
+            db_session.query(cls).filter(cls.library == library))
+
+    @classmethod
+    def bulk_save(cls, db_session, library, new_rows, changed_rows):
+        """
+        Records newly imported rows and refreshes changed ones, each as one
+        executemany. Rows are dicts of column values; changed rows also carry
+        the "row_id" of the entry they replace. Leaves committing to the
+        caller.
+        """
+        synced_table = cls.__table__
+        if new_rows:
+            for row in new_rows:
+                row["library"] = library
+            db_session.execute(synced_table.insert(), new_rows)
+        if changed_rows:
+            db_session.execute(
+                synced_table.update().
+                where(synced_table.c.id == bindparam("row_id")),
+                changed_rows)
+
+    @classmethod
+    def bulk_delete(cls, db_session, row_ids):
+        """Forgets about a list of synced rows."""
+        row_ids = list(row_ids)
+        for index in range(0, len(row_ids), QUERY_CHUNK_SIZE):
+            db_session.execute(
+                cls.__table__.delete().where(
+                    cls.__table__.c.id.in_(
+                        row_ids[index:index + QUERY_CHUNK_SIZE])))
+
+
+class ShotwellAppliedTag(Base):
+    """
+    A (file, tag) pair a Shotwell import added to at_file_tag. Only these
+    pairs are taken off again when Shotwell stops listing them, so tags of
+    the same name that other imports or the user applied are left alone.
+    """
+
+    __tablename__ = 'shotwell_applied_tags'
+
+    id = Column(Integer, index=True, primary_key=True)
+    library = Column(
+        String, nullable=False,
+        doc="Path of the Shotwell DB whose import applied the tag.")
+    file_id = Column(Integer, ForeignKey("files.id"), nullable=False)
+    tag_id = Column(Integer, ForeignKey("tags.tag_id"), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint(library, file_id, tag_id),
+    )
+
+    @classmethod
+    def get_pairs(cls, db_session, library):
+        """Returns the set of (file id, tag_id) pairs library applied."""
+        return set(
+            db_session.query(cls.file_id, cls.tag_id).
+            filter(cls.library == library))
+
+    @classmethod
+    def bulk_add(cls, db_session, library, file_tag_ids):
+        """
+        Records (file id, tag_id) pairs as applied by library with one
+        executemany. Leaves committing to the caller.
+        """
+        file_tag_ids = list(file_tag_ids)
+        if file_tag_ids:
+            db_session.execute(
+                cls.__table__.insert(),
+                [{"library": library, "file_id": file_id, "tag_id": tag_id}
+                 for file_id, tag_id in file_tag_ids])
+
+    @classmethod
+    def bulk_delete(cls, db_session, library, file_tag_ids):
+        """
+        Forgets about (file id, tag_id) pairs library applied with one
+        executemany. Leaves committing to the caller.
+        """
+        applied_table = cls.__table__
+        file_tag_ids = list(file_tag_ids)
+        if file_tag_ids:
+            db_session.execute(
+                applied_table.delete().
+                where(applied_table.c.library == library).
+                where(applied_table.c.file_id == bindparam("applied_file_id")).
+                where(applied_table.c.tag_id == bindparam("applied_tag_id")),
+                [{"applied_file_id": file_id, "applied_tag_id": tag_id}
+                 for file_id, tag_id in file_tag_ids])
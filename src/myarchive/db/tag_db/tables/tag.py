@@ -19,6 +19,9 @@ from myarchive.db.tag_db.tables.base import Base
 
 RECENT_TAG_CACHE = dict()
 
+# Stay well under SQLite's limit on bound parameters.
+QUERY_CHUNK_SIZE = 500
+
 
 class CircularDependencyError(Exception):
     """
@@ -82,3 +85,30 @@ class Tag(Base):
             db_session.add(tag)
             db_session.commit()
             return tag
+
+    @classmethod
+    def get_tag_ids(cls, db_session, tag_names):
+        """
+        Returns a dict of tag name to tag_id for every name in tag_names,
+        adding the missing tags with a single executemany. Leaves committing
+        to the caller.
+        """
+        tag_names = list(set(tag_names))
+        tag_ids = dict()
+        for index in range(0, len(tag_names), QUERY_CHUNK_SIZE):
+            chunk_names = tag_names[index:index + QUERY_CHUNK_SIZE]
+            tag_ids.update(
+                db_session.query(cls.name, cls.tag_id).
+                filter(cls.name.in_(chunk_names)))
+        missing_names = [
+            tag_name for tag_name in tag_names if tag_name not in tag_ids]
+        if missing_names:
+            db_session.execute(
+                cls.__table__.insert(),
+                [{"name": tag_name} for tag_name in missing_names])
+            for index in range(0, len(missing_names), QUERY_CHUNK_SIZE):
+                chunk_names = missing_names[index:index + QUERY_CHUNK_SIZE]
+                tag_ids.update(
+                    db_session.query(cls.name, cls.tag_id).
+                    filter(cls.name.in_(chunk_names)))
+        return tag_ids
@@ -14,11 +14,11 @@ import logging
 import re
 
 from sqlalchemy import (
-    Boolean, Column, Integer, String, Text, ForeignKey)
+    Boolean, Column, Integer, String, Text, ForeignKey, true)
 from sqlalchemy.orm import backref, relationship
 
 from myarchive.db.tag_db.tables.association_tables import (
-    at_tweet_tag, at_tweet_file, at_twuser_file)
+    at_tweet_tag, at_tweet_file, at_tweet_reply, at_twuser_file)
 from myarchive.db.tag_db.tables.base import Base
 from myarchive.db.tag_db.tables.file import TrackedFile
 from myarchive.db.tag_db.tables.tag import Tag
@@ -29,6 +29,9 @@ LOGGER = logging.getLogger(__name__)
 
 HASHTAG_REGEX = r'#([\d\w]+)'
 
+# Stay well under SQLite's limit on bound parameters.
+QUERY_CHUNK_SIZE = 500
+
 
 class Tweet(Base):
     """Class representing a file tweet by the database."""
@@ -77,20 +80,96 @@ class Tweet(Base):
     def __repr__(self):
         return "<Tweet(id='%s', text='%s')>" % (self.id, self.text)
 
-    def download_media(self, db_session, media_path):
+    @classmethod
+    def get_thread(cls, db_session, tweet_id):
+        """
+        Returns every archived tweet in tweet_id's conversation, oldest
+        first, using a single query against the reply closure table.
+        """
+        ancestors = at_tweet_reply.alias("ancestors")
+        descendants = at_tweet_reply.alias("descendants")
+        root = db_session.query(ancestors.c.ancestor_id).\
+            filter(ancestors.c.descendant_id == tweet_id).\
+            order_by(ancestors.c.depth.desc()).\
+            limit(1).subquery()
+        return db_session.query(cls).\
+            join(descendants, descendants.c.descendant_id == cls.id).\
+            join(root, root.c.ancestor_id == descendants.c.ancestor_id).\
+            order_by(cls.id).all()
+
+    @classmethod
+    def bulk_add_tags(cls, db_session, tag_names):
+        """
+        Tags newly added tweets from a dict of tweet ID to tag names, looking
+        the names up together and inserting the at_tweet_tag rows with a
+        single executemany. Leaves committing to the caller.
+        """
+        tag_ids = Tag.get_tag_ids(
+            db_session=db_session,
+            tag_names=[
+                tag_name for tweet_tag_names in tag_names.values()
+                for tag_name in tweet_tag_names])
+        tag_rows = [
+            {"tweet_id": tweet_id, "tag_id": tag_ids[tag_name]}
+            for tweet_id, tweet_tag_names in tag_names.items()
+            for tag_name in set(tweet_tag_names)]
+        if tag_rows:
+            db_session.execute(at_tweet_tag.insert(), tag_rows)
+
+    @classmethod
+    def bulk_download_media(cls, db_session, media_path, tweets,
+                            workers=None):
+        """
+        Retrieves the media files of several tweets at once, fetching them
+        in workers' thread pool via TrackedFile.download_files, and copies
+        each tweet's tags onto its files. Leaves committing to the caller.
+        """
+        tweets = [tweet for tweet in tweets if tweet.files_downloaded is False]
+        tracked_files_by_url = TrackedFile.download_files(
+            db_session=db_session,
+            media_path=media_path,
+            urls=[media_url for tweet in tweets
+                  for media_url in tweet.media_urls],
+            file_source="twitter",
+            workers=workers)
+        for tweet in tweets:
+            for media_url in tweet.media_urls:
+                tracked_file = tracked_files_by_url.get(media_url)
+                if (tracked_file is not None and
+                        tracked_file not in tweet.files):
+                    tweet.files.append(tracked_file)
+                    for tag in tweet.tags:
+                        if tag not in tracked_file.tags:
+                            tracked_file.tags.append(tag)
+            tweet.files_downloaded = True
+
+    def download_media(self, db_session, media_path, workers=None):
         """Retrieve media files."""
-        if self.files_downloaded is False:
-            for media_url in self.media_urls:
-                if media_url != "":
-                    tracked_file, existing = TrackedFile.download_file(
-                        db_session, media_path, media_url, "twitter")
-                    if (tracked_file is not None and
-                            tracked_file not in self.files):
-                        self.files.append(tracked_file)
-                        for tag in self.tags:
-                            if tag not in tracked_file.tags:
-                                tracked_file.tags.append(tag)
-            self.files_downloaded = True
+        self.bulk_download_media(
+            db_session=db_session, media_path=media_path, tweets=[self],
+            workers=workers)
+
+
+class UnavailableTweet(Base):
+    """
+    A reply chain ancestor that statuses/lookup didn't return (deleted,
+    protected or suspended), so backfills don't ask for it again.
+    """
+
+    __tablename__ = 'unavailable_tweets'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+
+    @classmethod
+    def bulk_add(cls, db_session, tweet_ids):
+        """
+        Records tweet IDs as unavailable. Leaves committing to the caller.
+        """
+        tweet_ids = set(tweet_ids)
+        if tweet_ids:
+            db_session.execute(
+                cls.__table__.insert(),
+                [{"id": tweet_id} for tweet_id in tweet_ids])
 
 
 class TwitterUser(Base):
@@ -107,6 +186,10 @@ class TwitterUser(Base):
     time_zone = Column(String)
     created_at = Column(String)
     files_downloaded = Column(Boolean, default=False)
+    profile_status_id = Column(
+        Integer,
+        doc="ID of the archived status the profile was last copied from, so "
+            "replaying older ones doesn't roll it back.")
 
     profile_sidebar_fill_color = Column(String)
     profile_text_color = Column(String)
@@ -122,51 +205,235 @@ class TwitterUser(Base):
         secondary=at_twuser_file
     )
 
+    # Profile fields copied straight from API user dicts.
+    PROFILE_FIELDS = (
+        "name",
+        "screen_name",
+        "url",
+        "description",
+        "created_at",
+        "location",
+        "time_zone",
+        "profile_sidebar_fill_color",
+        "profile_text_color",
+        "profile_background_color",
+        "profile_link_color",
+        "profile_image_url",
+        "profile_banner_url",
+        "profile_background_image_url",
+    )
+    # Profile fields pointing at images we archive.
+    MEDIA_URL_FIELDS = (
+        "profile_image_url",
+        "profile_background_image_url",
+        "profile_banner_url",
+    )
+
     def __init__(self, user_dict):
         self.id = int(user_dict["id"])
-        self.name = user_dict["name"]
-        self.screen_name = user_dict["screen_name"]
-        self.url = user_dict.get("url")
-        self.description = user_dict.get("description")
-        self.created_at = user_dict["created_at"]
-        self.location = user_dict.get("location")
-        self.time_zone = user_dict.get("time_zone")
-        self.profile_sidebar_fill_color = user_dict[
-            "profile_sidebar_fill_color"]
-        self.profile_text_color = user_dict[
-            "profile_text_color"]
-        self.profile_background_color = user_dict[
-            "profile_background_color"]
-        self.profile_link_color = user_dict[
-            "profile_link_color"]
-        self.profile_image_url = user_dict.get(
-            "profile_image_url")
-        self.profile_banner_url = user_dict.get(
-            "profile_banner_url")
-        self.profile_background_image_url = user_dict.get(
-            "profile_background_image_url")
+        self.update_profile(user_dict)
+        self.files_downloaded = False
+
+    def update_profile(self, user_dict):
+        """
+        Copies profile fields from an API user dict, only touching the ones
+        that changed. If an image URL changed, the user's media is flagged
+        for download again. Returns True if anything changed.
+        """
+        changed = False
+        for field in self.PROFILE_FIELDS:
+            value = user_dict.get(field)
+            if getattr(self, field) != value:
+                setattr(self, field, value)
+                changed = True
+                if field in self.MEDIA_URL_FIELDS:
+                    self.files_downloaded = False
+        return changed
 
     def __repr__(self):
         return (
             "<TwitterUser(id='%s', name='%s' screen_name='%s')>" %
             (self.id, self.name, self.screen_name))
 
-    def download_media(self, db_session, media_path):
-        if self.files_downloaded is False:
-            for media_url in (
-                    self.profile_image_url,
-                    self.profile_background_image_url,
-                    self.profile_banner_url):
-                if media_url is None:
-                    continue
-
-                # Add file to DB (runs a sha1sum).
-                tracked_file, existing = TrackedFile.download_file(
-                    db_session=db_session,
-                    media_path=media_path,
-                    url=media_url,
-                    file_source="twitter",
-                )
-                self.files.append(tracked_file)
-            db_session.commit()
-            self.files_downloaded = True
+    @classmethod
+    def bulk_download_media(cls, db_session, media_path, users,
+                            workers=None):
+        """
+        Retrieves the profile images of several users at once, fetching them
+        in workers' thread pool via TrackedFile.download_files. Leaves
+        committing to the caller.
+        """
+        users = [user for user in users if user.files_downloaded is False]
+        tracked_files_by_url = TrackedFile.download_files(
+            db_session=db_session,
+            media_path=media_path,
+            urls=[getattr(user, field) for user in users
+                  for field in cls.MEDIA_URL_FIELDS],
+            file_source="twitter",
+            workers=workers)
+        for user in users:
+            for field in cls.MEDIA_URL_FIELDS:
+                tracked_file = tracked_files_by_url.get(getattr(user, field))
+                # Unchanged URLs come back as files we already have.
+                if (tracked_file is not None and
+                        tracked_file not in user.files):
+                    user.files.append(tracked_file)
+            user.files_downloaded = True
+
+    def download_media(self, db_session, media_path, workers=None):
+        self.bulk_download_media(
+            db_session=db_session, media_path=media_path, users=[self],
+            workers=workers)
+        db_session.commit()
+
+
+class TwitterUserCache(object):
+    """
+    Session-scoped cache of TwitterUser rows keyed by user ID.
+
+    preload() fetches every author of a page of statuses with one IN query
+    and upserts their profiles, so per-status lookups never hit the DB.
+    """
+
+    def __init__(self, db_session):
+        self.db_session = db_session
+        self._users_by_id = dict()
+
+    def preload(self, user_dicts, status_ids=None):
+        """
+        Loads the users for a sequence of API user dicts, adding any we
+        haven't seen and updating changed profile fields on the rest. When a
+        user appears more than once, the first dict wins, so pass pages in
+        newest-first order.
+
+        Archived statuses come in any order, so pass the ID of the status
+        each dict came with as status_ids. The dict from a user's newest
+        status then wins, and profiles copied from an even newer status are
+        left alone.
+        """
+        user_dicts_by_id = dict()
+        if status_ids is None:
+            for user_dict in user_dicts:
+                user_dicts_by_id.setdefault(
+                    int(user_dict["id"]), (user_dict, None))
+        else:
+            for user_dict, status_id in zip(user_dicts, status_ids):
+                user_id = int(user_dict["id"])
+                if (user_id not in user_dicts_by_id or
+                        user_dicts_by_id[user_id][1] < status_id):
+                    user_dicts_by_id[user_id] = (user_dict, status_id)
+
+        # Re-query cached users too; committing expires them, and one IN
+        # query refreshes them all at once.
+        user_ids = list(user_dicts_by_id.keys())
+        for index in range(0, len(user_ids), QUERY_CHUNK_SIZE):
+            chunk_ids = user_ids[index:index + QUERY_CHUNK_SIZE]
+            for user in self.db_session.query(TwitterUser).filter(
+                    TwitterUser.id.in_(chunk_ids)):
+                self._users_by_id[user.id] = user
+
+        for user_id, (user_dict, status_id) in user_dicts_by_id.items():
+            user = self._users_by_id.get(user_id)
+            if user is None:
+                user = TwitterUser(user_dict)
+                self.db_session.add(user)
+                self._users_by_id[user_id] = user
+            elif (status_id is not None and
+                    user.profile_status_id is not None and
+                    user.profile_status_id > status_id):
+                continue
+            else:
+                user.update_profile(user_dict)
+            if status_id is not None:
+                user.profile_status_id = status_id
+
+    def get(self, user_dict):
+        """Returns the TwitterUser for an API user dict."""
+        user_id = int(user_dict["id"])
+        if user_id not in self._users_by_id:
+            self.preload([user_dict])
+        return self._users_by_id[user_id]
+
+
+def index_tweet_replies(db_session, reply_pairs):
+    """
+    Adds tweets to the at_tweet_reply closure table.
+
+    reply_pairs holds (tweet_id, in_reply_to_status_id) tuples for tweets
+    not indexed yet, with None for tweets that aren't replies. Parents we
+    haven't fetched get a placeholder row, so chains join up correctly
+    whichever end arrives first.
+    """
+    reply_pairs = list(reply_pairs)
+    node_ids = set()
+    for tweet_id, parent_id in reply_pairs:
+        node_ids.add(tweet_id)
+        if parent_id is not None:
+            node_ids.add(parent_id)
+    if not node_ids:
+        return
+
+    # Every node needs its depth 0 self row before it can be linked.
+    node_id_list = list(node_ids)
+    indexed_ids = set()
+    for index in range(0, len(node_id_list), QUERY_CHUNK_SIZE):
+        chunk_ids = node_id_list[index:index + QUERY_CHUNK_SIZE]
+        indexed_ids.update(
+            returned_tuple[0] for returned_tuple in
+            db_session.query(at_tweet_reply.c.ancestor_id).filter(
+                at_tweet_reply.c.depth == 0,
+                at_tweet_reply.c.ancestor_id.in_(chunk_ids)))
+    unindexed_ids = node_ids - indexed_ids
+    if unindexed_ids:
+        db_session.execute(
+            at_tweet_reply.insert(),
+            [dict(ancestor_id=node_id, descendant_id=node_id, depth=0)
+             for node_id in unindexed_ids])
+
+    # Link each reply's subtree under every ancestor of its parent.
+    ancestors = at_tweet_reply.alias("ancestors")
+    descendants = at_tweet_reply.alias("descendants")
+    for tweet_id, parent_id in reply_pairs:
+        if parent_id is None:
+            continue
+        db_session.execute(
+            at_tweet_reply.insert().from_select(
+                ["ancestor_id", "descendant_id", "depth"],
+                db_session.query(
+                    ancestors.c.ancestor_id,
+                    descendants.c.descendant_id,
+                    ancestors.c.depth + descendants.c.depth + 1).
+                # Every ancestor pairs with every descendant on purpose.
+                select_from(ancestors.join(descendants, true())).filter(
+                    ancestors.c.descendant_id == parent_id,
+                    descendants.c.ancestor_id == tweet_id).statement))
+
+
+def index_unthreaded_tweets(db_session):
+    """Indexes tweets added before the reply closure table existed."""
+    indexed_ids = db_session.query(at_tweet_reply.c.descendant_id).filter(
+        at_tweet_reply.c.depth == 0)
+    # Placeholders have self rows but still need linking once fetched.
+    linked_ids = db_session.query(at_tweet_reply.c.descendant_id).filter(
+        at_tweet_reply.c.depth == 1)
+    reply_pairs = db_session.query(
+        Tweet.id, Tweet.in_reply_to_status_id).filter(
+        ~Tweet.id.in_(indexed_ids) |
+        (Tweet.in_reply_to_status_id.isnot(None) &
+         ~Tweet.id.in_(linked_ids))).all()
+    index_tweet_replies(db_session=db_session, reply_pairs=reply_pairs)
+    return len(reply_pairs)
+
+
+def get_missing_thread_ancestor_ids(db_session):
+    """
+    Returns IDs of reply chain ancestors we don't have tweets for and that
+    haven't been found unavailable before.
+    """
+    return [
+        returned_tuple[0] for returned_tuple in
+        db_session.query(at_tweet_reply.c.ancestor_id).filter(
+            at_tweet_reply.c.depth == 0,
+            ~at_tweet_reply.c.ancestor_id.in_(db_session.query(Tweet.id)),
+            ~at_tweet_reply.c.ancestor_id.in_(
+                db_session.query(UnavailableTweet.id)))]
@@ -15,7 +15,8 @@ import logging
 from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
 from sqlalchemy.orm import backref, relationship
 
-from myarchive.db.tag_db.tables.association_tables import at_ytvideo_tag
+from myarchive.db.tag_db.tables.association_tables import (
+    at_ytplaylist_ytvideo, at_ytvideo_tag)
 from myarchive.db.tag_db.tables.base import Base
 
 
@@ -23,7 +24,9 @@ LOGGER = logging.getLogger(__name__)
 
 
 EXISTING_USERNAME_CACHE = list()
+EXISTING_VIDEOID_CACHE = set()
 HASHTAG_REGEX = r'#([\d\w]+)'
+QUERY_CHUNK_SIZE = 500
 
 
 class YTPlaylist(Base):
@@ -39,7 +42,11 @@ class YTPlaylist(Base):
 
     videos = relationship(
         "YTVideo",
+        backref=backref(
+            "playlists",
+            doc="Playlists this video is part of."),
         doc="List of videos in the playlist.",
+        secondary=at_ytplaylist_ytvideo,
     )
 
     def __init__(self, title, author, description, plid):
@@ -51,6 +58,20 @@ class YTPlaylist(Base):
     def __repr__(self):
         return "<%s('%r')>" % (self.__class__, self.__dict)
 
+    def update_membership(self, db_session, videoids):
+        """
+        Makes the playlist's videos exactly the archived ones among videoids.
+        Only the association rows change; no media is touched.
+        """
+        videoids = list(set(videoids))
+        ytvideos = []
+        for index in range(0, len(videoids), QUERY_CHUNK_SIZE):
+            ytvideos.extend(
+                db_session.query(YTVideo).filter(
+                    YTVideo.videoid.in_(
+                        videoids[index:index + QUERY_CHUNK_SIZE])))
+        self.videos = ytvideos
+
 
 class YTVideo(Base):
     """Class representing a Youtube video stored by the database."""
@@ -62,8 +83,7 @@ class YTVideo(Base):
     description = Column(String)
     duration = Column(String)
     publish_time = Column(DateTime)
-    videoid = Column(String)
-    playlist_id = Column(Integer, ForeignKey("ytplaylists.id"), nullable=True)
+    videoid = Column(String, unique=True, index=True)
     file_id = Column(Integer, ForeignKey("files.id"))
 
     file = relationship(
@@ -86,3 +106,14 @@ class YTVideo(Base):
         self.duration = duration
         self.publish_time = publish_time
         self.videoid = videoid
+
+
+def get_existing_videoids(db_session):
+    """
+    Returns the set of archived videoids, loading it from the DB on first
+    use. Callers add to it as they archive new videos.
+    """
+    if len(EXISTING_VIDEOID_CACHE) == 0:
+        EXISTING_VIDEOID_CACHE.update(
+            videoid for (videoid,) in db_session.query(YTVideo.videoid))
+    return EXISTING_VIDEOID_CACHE
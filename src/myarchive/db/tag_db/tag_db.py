@@ -12,13 +12,30 @@ import logging
 import fnmatch
 import os
 
+from sqlalchemy import inspect, text
+
 from myarchive.db.db import DB
 
 from myarchive.db.tag_db.tables import Base, TrackedFile, Tweet
+from myarchive.db.tag_db.tables.file import get_md5sum_by_filename
+from myarchive.util.workers import borrow_workers
 
 # Get the module logger.
 LOGGER = logging.getLogger(__name__)
 
+IMPORT_COMMIT_INTERVAL = 1000
+
+# Columns added to tables after they first shipped. create_all never alters a
+# table that already exists, so these are added to older DBs by hand.
+ADDED_COLUMNS = (
+    ("lj_users", ("last_entry", "last_comment", "last_comment_meta")),
+    ("lj_entries", ("synctime",)),
+    ("lj_comments", ("state",)),
+    ("files", ("title", "comment")),
+    ("shotwell_synced_media", ("title", "comment")),
+    ("twitter_users", ("profile_status_id",)),
+)
+
 
 class TagDB(DB):
 
@@ -31,8 +48,94 @@ class TagDB(DB):
             pool_size=pool_size
         )
         self.metadata.create_all(self.engine)
+        self.add_missing_columns()
+        self.migrate_ytvideos()
         self.existing_tweet_ids = None
 
+    def add_missing_columns(self):
+        """Brings tables created by older versions up to date."""
+        inspector = inspect(self.engine)
+        with self.engine.begin() as connection:
+            for table_name, column_names in ADDED_COLUMNS:
+                table = self.metadata.tables[table_name]
+                existing_columns = set(
+                    column["name"]
+                    for column in inspector.get_columns(table_name))
+                for column_name in column_names:
+                    if column_name in existing_columns:
+                        continue
+                    LOGGER.info(
+                        "Adding column %s to %s...", column_name, table_name)
+                    column_type = table.c[column_name].type.compile(
+                        dialect=self.engine.dialect)
+                    connection.execute(text(
+                        "ALTER TABLE %s ADD COLUMN %s %s" %
+                        (table_name, column_name, column_type)))
+
+    def migrate_ytvideos(self):
+        """
+        Moves the playlist older versions kept in ytvideos.playlist_id into
+        at_ytplaylist_ytvideo, merges rows sharing a videoid and adds the
+        unique videoid index create_all skips on an existing table.
+        """
+        inspector = inspect(self.engine)
+        existing_columns = set(
+            column["name"] for column in inspector.get_columns("ytvideos"))
+        existing_indexes = set(
+            index["name"] for index in inspector.get_indexes("ytvideos"))
+        missing_indexes = [
+            index for index in self.metadata.tables["ytvideos"].indexes
+            if index.name not in existing_indexes]
+        with self.engine.begin() as connection:
+            if "playlist_id" in existing_columns:
+                # The column stays behind, emptied, so this only runs once.
+                moved = connection.execute(text(
+                    "INSERT INTO at_ytplaylist_ytvideo "
+                    "(ytplaylist_id, ytvideo_id) "
+                    "SELECT playlist_id, id FROM ytvideos "
+                    "WHERE playlist_id IS NOT NULL AND NOT EXISTS ("
+                    "SELECT 1 FROM at_ytplaylist_ytvideo "
+                    "WHERE ytplaylist_id = ytvideos.playlist_id "
+                    "AND ytvideo_id = ytvideos.id)")).rowcount
+                connection.execute(text(
+                    "UPDATE ytvideos SET playlist_id = NULL "
+                    "WHERE playlist_id IS NOT NULL"))
+                if moved:
+                    LOGGER.info(
+                        "Moved %s videos into at_ytplaylist_ytvideo.", moved)
+            if not missing_indexes:
+                return
+            duplicates = connection.execute(text(
+                "SELECT videoid, MIN(id) FROM ytvideos "
+                "WHERE videoid IS NOT NULL "
+                "GROUP BY videoid HAVING COUNT(*) > 1")).fetchall()
+            for videoid, keep_id in duplicates:
+                LOGGER.info("Merging duplicate rows for video %s...", videoid)
+                params = {"videoid": videoid, "keep_id": keep_id}
+                for table_name, column_name in (
+                        ("at_ytplaylist_ytvideo", "ytplaylist_id"),
+                        ("at_ytvideo_tag", "tag_id")):
+                    duplicate_rows = (
+                        "FROM %s WHERE ytvideo_id IN ("
+                        "SELECT id FROM ytvideos "
+                        "WHERE videoid = :videoid AND id != :keep_id)" %
+                        table_name)
+                    connection.execute(text(
+                        "INSERT INTO %(table)s (%(column)s, ytvideo_id) "
+                        "SELECT DISTINCT %(column)s, :keep_id %(rows)s "
+                        "AND %(column)s NOT IN (SELECT %(column)s "
+                        "FROM %(table)s WHERE ytvideo_id = :keep_id)" % {
+                            "table": table_name, "column": column_name,
+                            "rows": duplicate_rows}), params)
+                    connection.execute(
+                        text("DELETE " + duplicate_rows), params)
+                connection.execute(text(
+                    "DELETE FROM ytvideos "
+                    "WHERE videoid = :videoid AND id != :keep_id"), params)
+            for index in missing_indexes:
+                LOGGER.info("Adding index %s...", index.name)
+                index.create(connection)
+
     def get_existing_tweet_ids(self):
         tweet_ids = [
             returned_tuple[0]
@@ -41,40 +144,49 @@ class TagDB(DB):
         tweet_id_set = set(tweet_ids)
         return tweet_id_set
 
-    def import_files(self, import_path, media_path, glob_ignores):
+    def import_files(self, import_path, media_path, glob_ignores,
+                     workers=None):
+        """
+        Copies a file, or every file under a folder not matching glob_ignores,
+        into media_path. Files are hashed in workers' process pool as the
+        folder is walked.
+        """
         if os.path.isdir(import_path):
-            for root, dirnames, filenames in os.walk(import_path):
-                for filename in sorted(filenames):
-                    full_filepath = os.path.join(root, filename)
-                    if any(fnmatch.fnmatch(full_filepath, pattern)
-                           for pattern in glob_ignores):
-                        continue
-                    LOGGER.debug("Importing %s...", full_filepath)
-                    db_file, existing = TrackedFile.add_file(
-                        file_source="file_import",
-                        db_session=self.session,
-                        media_path=media_path,
-                        copy_from_filepath=full_filepath,
-                        original_filename=filename)
-                    if existing is False:
-                        self.session.add(db_file)
-                self.session.commit()
+            filepaths = self._iter_import_filepaths(
+                import_path=import_path, glob_ignores=glob_ignores)
         elif os.path.isfile(import_path):
-            LOGGER.debug("Importing %s...", import_path)
-            directory, filename = os.path.split(import_path)
-            db_file, existing = TrackedFile.add_file(
-                file_source="file_import",
-                db_session=self.session,
-                media_path=media_path,
-                copy_from_filepath=import_path,
-                original_filename=filename)
-            if existing is False:
-                self.session.add(db_file)
+            filepaths = [import_path]
         else:
             LOGGER.error("Path does not exist: %s", import_path)
+            return
+        with borrow_workers(workers) as hash_workers:
+            for index, (filepath, md5sum) in enumerate(
+                    hash_workers.process_imap_unordered(
+                        _get_md5sum, filepaths), start=1):
+                LOGGER.debug("Importing %s...", filepath)
+                db_file, existing = TrackedFile.add_file(
+                    file_source="file_import",
+                    db_session=self.session,
+                    media_path=media_path,
+                    copy_from_filepath=filepath,
+                    md5sum_override=md5sum)
+                if existing is False:
+                    self.session.add(db_file)
+                if index % IMPORT_COMMIT_INTERVAL == 0:
+                    self.session.commit()
         self.session.commit()
         LOGGER.debug("Import Complete!")
 
+    @staticmethod
+    def _iter_import_filepaths(import_path, glob_ignores):
+        for root, dirnames, filenames in os.walk(import_path):
+            for filename in sorted(filenames):
+                full_filepath = os.path.join(root, filename)
+                if any(fnmatch.fnmatch(full_filepath, pattern)
+                       for pattern in glob_ignores):
+                    continue
+                yield full_filepath
+
     def clean_db_and_close(self):
         # Run VACUUM.
         self.session.close()
@@ -83,3 +195,9 @@ class TagDB(DB):
         cursor.execute("VACUUM")
         connection.commit()
         cursor.close()
+
+
+def _get_md5sum(filepath):
+    """Pool worker hashing one file to import."""
+    _, _, md5sum = get_md5sum_by_filename(file_id=None, filepath=filepath)
+    return filepath, md5sum
@@ -9,12 +9,16 @@
 
 from __future__ import absolute_import
 
+import json
+import threading
+import time
+from datetime import datetime
+
 try:
-    from urllib import urlencode
     from urllib2 import HTTPError
 except ImportError:
-    from urllib.parse import urlencode
     from urllib.error import HTTPError
+import requests
 from sanction import Client
 
 from .deviation import Deviation
@@ -32,6 +36,12 @@ class DeviantartError(Exception):
         return self.args[0]
 
 
+# HTTP statuses worth retrying: rate limiting and server side hiccups.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Seconds before its stated expiry that an access token gets refreshed.
+TOKEN_EXPIRY_MARGIN = 60
+
+
 class Api(object):
 
     """The API Interface (handles requests to the DeviantArt API)
@@ -40,6 +50,12 @@ class Api(object):
        :param client_secret: client_secret provided by DeviantArt
        :param standard_grant_type: The used authorization type | client_credentials (read-only) or authorization_code
        :param scope: The scope of data the application can access    
+       :param max_retries: How often a rate limited or failed request is
+           retried
+       :param backoff_factor: Seconds to wait before the first retry, doubled
+           for each one after
+       :param response_cache: Optional cache with lookup/store/revalidated
+           methods, keyed by namespace "deviantart"
     """
 
     def __init__(
@@ -48,7 +64,11 @@ class Api(object):
         client_secret,
         redirect_uri="",
         standard_grant_type="client_credentials",
-        scope="browse feed message note stash user user.manage comment.post collection"
+        scope=("browse feed message note stash user user.manage "
+               "comment.post collection"),
+        max_retries=5,
+        backoff_factor=1,
+        response_cache=None
     ):
 
         """Instantiate Class and create OAuth Client"""
@@ -64,6 +84,15 @@ class Api(object):
         self.scope = scope
         self.access_token = None
         self.refresh_token = None
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.response_cache = response_cache
+
+        # One keep-alive session for every API call. requests asks for and
+        # transparently decodes gzipped responses.
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        self._token_lock = threading.Lock()
 
         self.oauth = Client(
             auth_endpoint=self.auth_endpoint,
@@ -1715,24 +1744,139 @@ class Api(object):
 
         """Helper method to make API calls
 
+        Expired tokens are refreshed up front, a 401 triggers one refresh and
+        retry, and 429/5xx responses are retried with exponential backoff.
+        Responses for endpoints the response_cache covers are served from it
+        while fresh and revalidated with ETag/Last-Modified once stale.
+
         :param endpoint: The endpoint to make the API call to
         :param get_data: data send through GET
         :param post_data: data send through POST
         """
 
-        if get_data:
-            request_parameter = "{}?{}".format(endpoint, urlencode(get_data))
-        else:
-            request_parameter = endpoint
+        url = "{}{}".format(self.resource_endpoint, endpoint)
+        method = "POST" if post_data else "GET"
+        refreshed = False
+        attempt = 0
+
+        cached = None
+        cache_params = [get_data, post_data]
+        if self.response_cache is not None:
+            cached = self.response_cache.lookup(
+                "deviantart", endpoint, cache_params)
+            if cached is not None and cached.fresh:
+                return json.loads(cached.body)
+
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+
+        while True:
+            if self._token_expired():
+                self._refresh_token()
+
+            headers['Authorization'] = 'Bearer {}'.format(
+                self.oauth.access_token)
+
+            try:
+                http_response = self.session.request(
+                    method,
+                    url,
+                    params=get_data or None,
+                    data=post_data or None,
+                    headers=headers
+                )
+            except requests.RequestException as e:
+                if attempt >= self.max_retries:
+                    raise DeviantartError(e)
+                self._backoff(attempt)
+                attempt += 1
+                continue
+
+            if http_response.status_code == 304 and cached is not None:
+                self.response_cache.revalidated(
+                    "deviantart", endpoint, cache_params)
+                return json.loads(cached.body)
+
+            if http_response.status_code == 401 and not refreshed:
+                self._refresh_token()
+                refreshed = True
+                continue
+
+            if (http_response.status_code in RETRY_STATUS_CODES and
+                    attempt < self.max_retries):
+                self._backoff(
+                    attempt, http_response.headers.get('Retry-After'))
+                attempt += 1
+                continue
+
+            try:
+                response = http_response.json()
+            except ValueError:
+                http_response.raise_for_status()
+                raise DeviantartError(
+                    "Unparseable response from {}".format(endpoint))
 
-        try:
-            encdata = urlencode(post_data, True).encode('utf-8')
-            response = self.oauth.request(request_parameter, data=encdata)
             self._checkResponseForErrors(response)
-        except HTTPError as e:
-            raise DeviantartError(e)
+            if not http_response.ok:
+                raise DeviantartError("HTTP Error {}: {}".format(
+                    http_response.status_code, http_response.reason))
 
-        return response
+            if self.response_cache is not None:
+                self.response_cache.store(
+                    "deviantart", endpoint, cache_params, http_response.text,
+                    etag=http_response.headers.get('ETag'),
+                    last_modified=http_response.headers.get('Last-Modified'))
+
+            return response
+
+    def _token_expired(self):
+
+        """Checks whether the access token is missing or expired"""
+
+        if not self.oauth.access_token:
+            return True
+
+        # sanction stores the expiry as a UTC timetuple run through mktime,
+        # or -1 if the provider never told us.
+        token_expires = getattr(self.oauth, 'token_expires', -1)
+        if token_expires < 0:
+            return False
+
+        now = time.mktime(datetime.utcnow().timetuple())
+        return now + TOKEN_EXPIRY_MARGIN >= token_expires
+
+    def _refresh_token(self):
+
+        """Fetches a new access token, once, however many threads ask"""
+
+        stale_token = self.oauth.access_token
+
+        with self._token_lock:
+            if self.oauth.access_token != stale_token:
+                return
+
+            if self.refresh_token:
+                self.auth(refresh_token=self.refresh_token)
+            elif self.standard_grant_type == "client_credentials":
+                self.auth()
+            else:
+                raise DeviantartError(
+                    "Access token expired and no refresh_token is available.")
+
+    def _backoff(self, attempt, retry_after=None):
+
+        """Sleeps before a retry, honouring the server's Retry-After"""
+
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = self.backoff_factor * (2 ** attempt)
+
+        time.sleep(delay)
 
 
 
@@ -10,8 +10,12 @@ import datetime
 import time
 import os.path
 import sys
+from collections import deque
 from optparse import OptionParser
-import lj
+try:
+    from . import lj
+except ImportError:
+    import lj
 
 
 """
@@ -20,6 +24,7 @@ journal backup dictionary structure:
       'last_comment': id of the last comment sync'd,
       'login': the dictionary returned by the last login (useful information such as friend groups),
       'comment_posters': { [posterid]: [postername] }
+      'entry_synctimes': { [entryid]: time of its latest syncitems change }
       'entries': { [entryid]: {
           eventtime: timestamp,
           security: 'private' or 'usemask',
@@ -47,6 +52,7 @@ DEFAULT_JOURNAL = {
     'last_comment': '0',
     'last_comment_meta': None,
     'entries': {},
+    'entry_synctimes': {},
     'comments': {},
     'comment_posters': {},
 }
@@ -58,7 +64,7 @@ def datetime_from_string(s):
 
 
 def days_ago(s):
-    return (datetime.datetime.today() - datetime_from_string(s)).days
+    return (datetime.datetime.today() - datetime_from_string(s[:19])).days
 
 
 def one_second_before(s):
@@ -109,17 +115,43 @@ def save_journal(f, journal):
 
 
 def update_journal_entries(server, journal):
+    """Fetches every entry listed by syncitems, oldest first.
+
+    Each getevents_syncitems call returns a window of entries changed since
+    the oldest item still outstanding. Whatever itemids come back are
+    crossed off, so overlapping windows never refetch anything. If a window
+    doesn't cross off a single outstanding item (e.g. the entry was deleted
+    after syncitems listed it), that item is dropped instead of looping on it.
+    """
     syncitems = built_syncitems_list(server, journal)
-    howmany = len(syncitems)
+    pending = deque()
+    remaining = set()
+    for itemid, synctime in syncitems:
+        if itemid not in remaining:
+            remaining.add(itemid)
+            pending.append((itemid, synctime))
+    howmany = len(remaining)
+    journal.setdefault('entry_synctimes', {}).update(syncitems)
     print(howmany, "entries to download")
-    while len(syncitems) > 0:
-        print("getting entries starting at", syncitems[0][1])
-        sync = server.getevents_syncitems(one_second_before(syncitems[0][1]))
+    while pending:
+        itemid, synctime = pending[0]
+        if itemid not in remaining:
+            pending.popleft()
+            continue
+        print("getting entries starting at", synctime)
+        sync = server.getevents_syncitems(one_second_before(synctime))
+        progress = False
         for entry in sync['events']:
             if hasattr(entry, 'data'):
                 entry = entry.data
             journal['entries'][entry['itemid']] = entry
-            del(syncitems[0])
+            if entry['itemid'] in remaining:
+                remaining.discard(entry['itemid'])
+                progress = True
+        if not progress:
+            print("entry", itemid, "was not returned by the server, skipping")
+            remaining.discard(itemid)
+            pending.popleft()
     return howmany
 
 
@@ -142,28 +174,33 @@ def update_journal_comments(server, journal):
     session = server.sessiongenerate()
     initial_meta = get_meta_since(journal['last_comment'], server, session)
     journal['comment_posters'].update(initial_meta['usermaps'])
-    if initial_meta['maxid'] > journal['last_comment']:
+    if int(initial_meta['maxid']) > int(journal['last_comment']):
         bodies = get_bodies_since(journal['last_comment'], initial_meta['maxid'], server, session)
         journal['comments'].update(bodies)
-    if len(journal['comments']) == 0 or days_ago(journal['last_comment_meta']) > 30:
+    if (journal['last_comment_meta'] is None or
+            days_ago(journal['last_comment_meta']) > 30):
         # update metadata every 30 days
         all_meta = get_meta_since('0', server, session)
         journal['comment_posters'].update(all_meta['usermaps'])
         if len(journal['comments']) > 0:
             for id, data in list(all_meta['comments'].items()):
+                if id not in journal['comments']:
+                    continue
                 journal['comments'][id]['posterid'] = data[0]
                 journal['comments'][id]['state'] = data[1]
         journal['last_comment_meta'] = str(datetime.datetime.today())
     howmany = int(initial_meta['maxid']) - int(journal['last_comment'])
     journal['last_comment'] = initial_meta['maxid']
-    server.sessionexpire(session)
+    server.sessionexpire([lj.session_id(session)])
     return howmany
 
 
 def get_meta_since(highest, server, session):
+    """Collects comment metadata and usermaps for comments after highest"""
     all = {'comments': {}, 'usermaps': {}}
     maxid = str(int(highest) + 1)
-    while highest < maxid:
+    while int(highest) < int(maxid or 0):
+        startid = int(highest)
         meta = server.fetch_comment_meta(highest, session)
         maxid = meta['maxid']
         for id, data in list(meta['comments'].items()):
@@ -171,22 +208,34 @@ def get_meta_since(highest, server, session):
                 highest = id
             all['comments'][id] = data
         all['usermaps'].update(meta['usermaps'])
+        if int(highest) == startid:
+            # Nothing new came back, so there is nothing left to fetch.
+            break
     all['maxid'] = maxid
     return all
 
 
 def get_bodies_since(highest, maxid, server, session):
-    all = {}
-    while highest != maxid:
-        meta = server.fetch_comment_bodies(highest, session)
-        for id, data in list(meta.items()):
-            if int(id) > int(highest):
-                highest = id
-            all[id] = data
-        if maxid in meta:
+    return dict(iter_bodies_since(highest, maxid, server, session))
+
+
+def iter_bodies_since(highest, maxid, server, session):
+    """Yields (id, comment) for comments after highest, up to maxid, by ID"""
+    highest = int(highest)
+    maxid = int(maxid)
+    count = 0
+    while highest < maxid:
+        startid = highest
+        for id, data in server.iter_comment_bodies(startid, session):
+            if int(id) <= startid:
+                continue
+            highest = max(highest, int(id))
+            count += 1
+            yield id, data
+        if highest == startid:
+            # Nothing new came back, so there is nothing left to fetch.
             break
-        print("Downloaded %d comments so far" % len(all))
-    return all
+        print("Downloaded %d comments so far" % count)
 
 
 def __dispatch():
@@ -21,21 +21,56 @@ try:
 except ImportError:
     import xmlrpclib
 try:
-    import urllib.request as urllib2
+    import http.client as httplib
 except ImportError:
-    import urllib2
-import io
+    import httplib
+try:
+    import urllib.parse as urlparse
+except ImportError:
+    import urlparse
 import gzip
+import socket
 import datetime
-from xml.dom.minidom import parse
+from xml.etree.ElementTree import iterparse
 
 
 class LJException(Exception):
     pass
 
 
-class LJTransport(xmlrpclib.Transport):
-    pass
+def session_id(session):
+    """Returns the session id of a session cookie, for sessionexpire
+
+    A cookie like "ws:test:124:zfFG136kSz" has the session id "124".
+    """
+    return session.split(':')[2]
+
+
+class LJTransport(xmlrpclib.SafeTransport):
+    """XML-RPC transport for LJServer
+
+    The stock transports already hold their connection open between
+    requests (HTTP/1.1 keep-alive); this one also picks HTTP or HTTPS to
+    match the server (a plain Transport would talk cleartext to an https://
+    host), and sends the ljsession cookie when cookie auth is in use.
+    """
+
+    def __init__(self, use_https=True):
+        xmlrpclib.SafeTransport.__init__(self)
+        self.use_https = use_https
+        self.session = None
+
+    def make_connection(self, host):
+        if self.use_https:
+            return xmlrpclib.SafeTransport.make_connection(self, host)
+        return xmlrpclib.Transport.make_connection(self, host)
+
+    def send_headers(self, connection, headers):
+        if self.session:
+            headers = list(headers) + [
+                ('Cookie', 'ljsession=' + self.session),
+                ('X-LJ-Auth', 'cookie')]
+        xmlrpclib.SafeTransport.send_headers(self, connection, headers)
 
 
 class LJServer:
@@ -49,18 +84,26 @@ class LJServer:
     host: server to connect to.  Defaults to the official LiveJournal server.  Note that
         it is assumed everything on this server is in the same location as it is on
         livejournal.com.
+    session_auth: if true, login() generates a long session and later
+        requests authenticate with its cookie instead of fetching a fresh
+        challenge first, halving the round-trips.  Falls back to
+        challenge-response if the server turns the cookie down.
 
     All data transmitted should be in UTF-8.  All data received WILL be in UTF-8.
     """
 
-    def __init__(self, clientversion, user_agent, host='https://www.livejournal.com/'):
-        transport = LJTransport()
-        transport.user_agent = user_agent
+    def __init__(self, clientversion, user_agent,
+                 host='https://www.livejournal.com/', session_auth=False):
+        self.transport = LJTransport(use_https=host.startswith('https:'))
+        self.transport.user_agent = user_agent
         self.user_agent = user_agent
         self.host = host
         self.server = xmlrpclib.ServerProxy(
-            host + 'interface/xmlrpc', transport)
+            host + 'interface/xmlrpc', self.transport)
         self.clientversion = clientversion
+        self.session_auth = session_auth
+        self.__session_auth_verified = False
+        self.__web_connection = None
 
         self.user = None
         self.password = None
@@ -75,7 +118,21 @@ class LJServer:
         """
         method = getattr(self.server.LJ.XMLRPC, methodname)
 
-        response = method(args)
+        try:
+            response = method(args)
+        except xmlrpclib.Fault:
+            if (args.get('auth_method') != 'cookie' or
+                    self.__session_auth_verified):
+                raise
+            # The server won't take cookie auth after all, so go back to
+            # challenge-response.
+            self.transport.session = None
+            self.session_auth = False
+            args.update(self.__headers())
+            response = method(args)
+        else:
+            if args.get('auth_method') == 'cookie':
+                self.__session_auth_verified = True
         return response
 
     def __loggedin(self):
@@ -84,6 +141,12 @@ class LJServer:
 
     def __headers(self):
         self.__loggedin()
+        if self.transport.session:
+            return {'ver': 1,
+                    'clientversion': self.clientversion,
+                    'auth_method': 'cookie',
+                    'username': self.user,
+                    }
         challenge = self.getchallenge()
         args = {'ver': 1,
                 'clientversion': self.clientversion,
@@ -169,8 +232,25 @@ class LJServer:
             self.valid['usejournals'] = response['usejournals']
         if 'pickws' in response:
             self.valid['pickws'] = response['pickws']
+        if self.session_auth and not self.transport.session:
+            try:
+                self.transport.session = self.sessiongenerate(
+                    expiration='long')
+            except LJException:
+                self.session_auth = False
         return response
 
+    def close(self):
+        """Expires the cookie auth session, if any, and closes connections"""
+        if self.transport.session:
+            try:
+                self.sessionexpire([session_id(self.transport.session)])
+            except (LJException, socket.error, xmlrpclib.Error):
+                pass
+            self.transport.session = None
+        self.transport.close()
+        self.__close_web_connection()
+
     def checkfriends(self, mask=None):
         """Check for friend updates
         One optional arguments:
@@ -515,19 +595,76 @@ class LJServer:
         return response
 
     def __request_with_cookie(self, url, session=None):
+        """Opens url with the session cookie, returning a binary file object
+        that decompresses the body as it is read if the server gzipped it.
+        Requests share one keep-alive connection to the server."""
         if not session:
-            session = self.sessiongenerate()
-
-        request = urllib2.Request(url)
-        request.add_header('Accept-encoding', 'gzip')
-        request.add_header('User-agent', self.user_agent)
-        request.add_header('Cookie', 'ljsession=' + session)
-        response = urllib2.urlopen(request)
-        data = io.StringIO(response.read().decode('utf8'))
-        response.close()
-        if response.headers.get('content-encoding', '') == 'gzip':
-            data = gzip.GzipFile(fileobj=data, mode='w')
-        return data
+            session = self.transport.session or self.sessiongenerate()
+
+        parts = urlparse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        headers = {
+            'Accept-encoding': 'gzip',
+            'User-agent': self.user_agent,
+            'Cookie': 'ljsession=' + session,
+        }
+        for attempt in range(2):
+            if self.__web_connection is None:
+                if parts.scheme == 'https':
+                    self.__web_connection = httplib.HTTPSConnection(
+                        parts.netloc)
+                else:
+                    self.__web_connection = httplib.HTTPConnection(
+                        parts.netloc)
+            try:
+                self.__web_connection.request('GET', path, headers=headers)
+                response = self.__web_connection.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                # The server may have closed the idle connection; reconnect
+                # once.
+                self.__close_web_connection()
+                if attempt:
+                    raise
+        if response.status != 200:
+            response.read()
+            raise LJException('%s returned HTTP %d %s' % (
+                url, response.status, response.reason))
+        if response.getheader('content-encoding', '') == 'gzip':
+            return gzip.GzipFile(fileobj=response, mode='rb')
+        return response
+
+    def __close_web_connection(self):
+        if self.__web_connection is not None:
+            self.__web_connection.close()
+            self.__web_connection = None
+
+    def __iter_export(self, url, session, tags):
+        """Streams an export_comments.bml response, yielding each element
+        named in tags once it has been completely parsed.  Elements are
+        cleared once the caller is done with them, so memory use doesn't
+        grow with the size of the export."""
+        response = self.__request_with_cookie(url, session)
+        finished = False
+        try:
+            open_elements = []
+            for event, element in iterparse(response, events=('start', 'end')):
+                if event == 'start':
+                    open_elements.append(element)
+                    continue
+                open_elements.pop()
+                if element.tag in tags:
+                    yield element
+                    element.clear()
+                    if open_elements:
+                        open_elements[-1].remove(element)
+            finished = True
+        finally:
+            response.close()
+            if not finished:
+                # The rest of the response is still on the wire, so the
+                # connection can't be reused.
+                self.__close_web_connection()
 
     def fetch_comment_meta(self, startid=0, session=None):
         """Fetch comment metadata
@@ -552,21 +689,42 @@ class LJServer:
 
         LJ encourages you to cache this data, but it can change occasionally.
         """
-        response = self.__request_with_cookie(
-            self.host + "export_comments.bml?get=comment_meta&startid=%d" % int(startid), session)
-        d = parse(response).getElementsByTagName('livejournal')[0]
-        response.close()
-        data = {'comments': {}, 'usermaps': {}, 'maxid': get_text_from_single(d, 'maxid')}
-        for comment in d.getElementsByTagName('comment'):
-            state = comment.getAttribute('state')
-            if state == '':
-                state = 'A'
-            data['comments'][comment.getAttribute('id')] = (comment.getAttribute('posterid'), state)
-        for usermap in d.getElementsByTagName('usermap'):
-            data['usermaps'][usermap.getAttribute('id')] = usermap.getAttribute('user')
-        d.unlink()
+        data = {'comments': {}, 'usermaps': {}, 'maxid': ''}
+        for element in self.__iter_export(
+                self.host + "export_comments.bml?get=comment_meta"
+                "&startid=%d" % int(startid), session,
+                ('maxid', 'comment', 'usermap')):
+            if element.tag == 'maxid':
+                data['maxid'] = element.text or ''
+            elif element.tag == 'comment':
+                data['comments'][element.get('id')] = (
+                    element.get('posterid', ''), element.get('state') or 'A')
+            else:
+                data['usermaps'][element.get('id')] = element.get('user', '')
         return data
 
+    def iter_comment_bodies(self, startid=0, session=None):
+        """Stream comment bodies
+
+        Takes the same arguments as fetch_comment_bodies, but yields
+        (comment id, comment dictionary) pairs as they are parsed instead of
+        building the whole batch in memory.
+        """
+        for element in self.__iter_export(
+                self.host + "export_comments.bml?get=comment_body"
+                "&startid=%d" % int(startid), session,
+                ('comment',)):
+            c = {
+                'posterid': element.get('posterid', ''),
+                'state': element.get('state') or 'A',
+                'jitemid': element.get('jitemid', ''),
+                'parentid': element.get('parentid', ''),
+                'body': element.findtext('body', ''),
+                'subject': element.findtext('subject', ''),
+                'date': element.findtext('date', ''),
+            }
+            yield element.get('id'), c
+
     def fetch_comment_bodies(self, startid=0, session=None):
         """Fetch comment bodies
 
@@ -589,44 +747,8 @@ class LJServer:
 
         This should be very, very cached.  All information that might change is returned by fetch_comment_meta.
         """
-        response = self.__request_with_cookie(
-            self.host + "export_comments.bml?get=comment_body&startid=%d" % int(startid), session)
-        d = parse(response).getElementsByTagName('livejournal')[0]
-        response.close()
-        data = {}
-        for comment in d.getElementsByTagName('comment'):
-            c = {
-                'posterid': comment.getAttribute('posterid'),
-                'state': comment.getAttribute('state'),
-                'jitemid': comment.getAttribute('jitemid'),
-                'parentid': comment.getAttribute('parentid'),
-                'body': get_text_from_single(comment, 'body'),
-                'subject': get_text_from_single(comment, 'subject'),
-                'date': get_text_from_single(comment, 'date'),
-            }
-            if c['subject'] == '':
-                c['subject'] = 'A'
-            data[comment.getAttribute('id')] = c
-        d.unlink()
-        return data
-
-
-# Stole this function wholesale from the python.org minidom example.
-# The necessity of this function helps explain why I hate the DOM.
-def get_text(nodelist):
-    rc = ""
-    for node in nodelist:
-        if node.nodeType == node.TEXT_NODE:
-            rc = rc + node.data
-    return rc
-
+        return dict(self.iter_comment_bodies(startid, session))
 
-def get_text_from_single(dom, tag):
-    l = dom.getElementsByTagName(tag)
-    if l:
-        return get_text(l[0].childNodes)
-    else:
-        return ''
 
 if __name__ == "__main__":
     LJ = LJServer('lj.py; kemayo@gmail.com', 'Python-PyLJ/0.0.1')
@@ -9,12 +9,15 @@
 """Handles deviantart calls."""
 
 import logging
+import threading
+import time
 
 from sqlalchemy.orm.exc import NoResultFound
 
 from myarchive.db.tag_db.tables import Deviation, Tag, TrackedFile
-from myarchive.db.tag_db.tables.datables import get_da_user
+from myarchive.db.tag_db.tables.datables import get_da_user, get_da_users
 from myarchive.libs import deviantart
+from myarchive.util.workers import borrow_workers
 
 LOGGER = logging.getLogger(__name__)
 
@@ -25,214 +28,377 @@ GALLERY_RSS = "http://backend.deviantart.com/rss.xml?q=gallery%%3A%(username)s"
 GALLERY = "GALLERY"
 FAVORITES = "FAVORITES"
 
-
-def download_user_data(database, config, media_storage_path):
-    """Grabs user galleries and favorites."""
-    for config_section in config.sections():
-        if config_section.startswith("DeviantArt_"):
-            username = config_section[11:]
-            client_id = config.get(
-                section=config_section, option="client_id"),
-            client_secret = config.get(
-                section=config_section, option="client_secret"),
-
-            da_api = deviantart.Api(
-                client_id=client_id[0],
-                client_secret=client_secret[0],
-            )
-            da_api.oauth.request_token(grant_type="client_credentials")
-            if not da_api.access_token:
-                raise Exception("Access token not acquired!")
-
-            # Grab user data.
-            LOGGER.info("Pulling data for user: %s...", username)
-            get_da_user(
-                db_session=database.session,
-                da_api=da_api,
-                username=username,
-                media_storage_path=media_storage_path)
-
-            for sync_type in (GALLERY, FAVORITES):
-                __download_user_deviations(
+# Largest page sizes the DA API will honour for folder listings and folder
+# contents respectively.
+FOLDER_PAGE_SIZE = 50
+DEVIATION_PAGE_SIZE = 24
+METADATA_BATCH_SIZE = 50
+REQUESTS_PER_SECOND = 4
+
+
+class RateLimiter(object):
+    """
+    Spaces out API calls made from any number of threads so that, taken
+    together, they never exceed requests_per_second.
+    """
+
+    def __init__(self, requests_per_second=REQUESTS_PER_SECOND):
+        self._interval = 1.0 / requests_per_second
+        self._lock = threading.Lock()
+        self._next_request_time = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_request_time:
+                time.sleep(self._next_request_time - now)
+                now = self._next_request_time
+            self._next_request_time = now + self._interval
+
+
+class DeviationMetadataCache(object):
+    """
+    Fetches deviation metadata in batches and keeps it by deviationid, so a
+    deviation showing up in several folders (or in both the gallery and the
+    favourites pass) is only ever looked up once.
+    """
+
+    def __init__(self, da_api, rate_limiter):
+        self._da_api = da_api
+        self._rate_limiter = rate_limiter
+        self._lock = threading.Lock()
+        self._metadata_by_id = dict()
+
+    def _fetch(self, deviationids):
+        self._rate_limiter.wait()
+        metadata_list = self._da_api.get_deviation_metadata(
+            deviationids=deviationids,
+            ext_submission=True, ext_camera=True)
+        with self._lock:
+            for metadata in metadata_list:
+                self._metadata_by_id[metadata["deviationid"]] = metadata
+
+    def prefetch(self, deviationids):
+        """Fetches metadata for any of the given deviations not yet cached."""
+        with self._lock:
+            missing_ids = list(
+                deviationid for deviationid in set(deviationids)
+                if deviationid not in self._metadata_by_id)
+        for index in range(0, len(missing_ids), METADATA_BATCH_SIZE):
+            try:
+                self._fetch(
+                    missing_ids[index:index + METADATA_BATCH_SIZE])
+            except deviantart.api.DeviantartError as error:
+                LOGGER.error("Error querying DA API for metadata: %s", error)
+
+    def get(self, deviationid):
+        """
+        Returns the metadata for a deviation, falling back to a single lookup
+        if it wasn't prefetched. Returns None if the API won't give it to us.
+        """
+        if deviationid not in self._metadata_by_id:
+            try:
+                self._fetch([deviationid])
+            except deviantart.api.DeviantartError as error:
+                LOGGER.error("Error querying DA API for metadata: %s", error)
+        return self._metadata_by_id.get(deviationid)
+
+
+def download_user_data(database, config, media_storage_path,
+                       response_cache=None, workers=None):
+    """
+    Grabs user galleries and favorites. API responses are kept in
+    response_cache (a ResponseCacheDB) if one is given. Folder crawls and
+    icon downloads run in workers' thread pool.
+    """
+    with borrow_workers(workers) as io_workers:
+        for config_section in config.sections():
+            if config_section.startswith("DeviantArt_"):
+                __download_account_data(
                     database=database,
-                    da_api=da_api,
-                    username=username,
-                    sync_type=sync_type,
+                    config=config,
+                    config_section=config_section,
                     media_storage_path=media_storage_path,
-                )
-
-
-def __download_user_deviations(
-        database, media_storage_path, da_api, username, sync_type,
-        force_full_scan=False):
-
+                    workers=io_workers,
+                    response_cache=response_cache)
+
+
+def __download_account_data(database, config, config_section,
+                            media_storage_path, workers,
+                            response_cache):
+    username = config_section[11:]
+    client_id = config.get(
+        section=config_section, option="client_id"),
+    client_secret = config.get(
+        section=config_section, option="client_secret"),
+
+    da_api = deviantart.Api(
+        client_id=client_id[0],
+        client_secret=client_secret[0],
+        response_cache=response_cache,
+    )
+    da_api.oauth.request_token(grant_type="client_credentials")
+    if not da_api.access_token:
+        raise Exception("Access token not acquired!")
+    rate_limiter = RateLimiter()
+    metadata_cache = DeviationMetadataCache(
+        da_api=da_api, rate_limiter=rate_limiter)
+
+    # Grab user data.
+    LOGGER.info("Pulling data for user: %s...", username)
+    get_da_user(
+        db_session=database.session,
+        da_api=da_api,
+        username=username,
+        media_storage_path=media_storage_path,
+        workers=workers,
+        rate_limiter=rate_limiter)
+
+    for sync_type in (GALLERY, FAVORITES):
+        __download_user_deviations(
+            database=database,
+            da_api=da_api,
+            username=username,
+            sync_type=sync_type,
+            media_storage_path=media_storage_path,
+            rate_limiter=rate_limiter,
+            metadata_cache=metadata_cache,
+            workers=workers,
+        )
+
+
+def __list_folders(da_api, username, sync_type, rate_limiter):
+    """Pages through every gallery folder or collection the user has."""
     if sync_type == GALLERY:
-        collections = da_api.get_gallery_folders(username=username)
+        get_folders = da_api.get_gallery_folders
     elif sync_type == FAVORITES:
-        collections = da_api.get_collections(username=username)
+        get_folders = da_api.get_collections
     else:
         raise Exception("Type of sync not supported: %s" % sync_type)
 
-    for collection in collections["results"]:
-        collection_name = collection["name"]
-        LOGGER.info("Scanning %s (%s) for deviations...",
-                    sync_type, collection_name)
-        folderid = collection["folderid"]
-
-        # Grab list of existing deviationids.
-        query_results = database.session.query(Deviation.deviationid).all()
-        existing_deviationids = [item for (item,) in query_results]
-
-        deviations = []
-        offset = 0
-        has_more = True
-        # while there are more deviations to fetch
-        while has_more:
-            try:
-                # fetch deviations from user
-                fetched_deviations = da_api.get_collection(
-                    folderid=folderid,
-                    username=username,
-                    offset=offset,
-                    limit=10)
-                # Add fetched deviations to list.
-                deviations.extend(fetched_deviations['results'])
-                # Update offset
-                offset = fetched_deviations['next_offset']
-
-                # Check if there are any deviations left that we can
-                # fetch (if yes => repeat)
-                has_more = fetched_deviations['has_more']
-
-                # Normally, we only check
+    folders = []
+    offset = 0
+    has_more = True
+    while has_more:
+        rate_limiter.wait()
+        fetched_folders = get_folders(
+            username=username, offset=offset, limit=FOLDER_PAGE_SIZE)
+        folders.extend(fetched_folders["results"])
+        offset = fetched_folders["next_offset"]
+        has_more = fetched_folders["has_more"]
+    return folders
+
+
+def __crawl_folder(da_api, username, sync_type, folder,
+                   existing_deviationids, rate_limiter, metadata_cache,
+                   force_full_scan):
+    """
+    Pages through a single folder, newest first, and returns the folder along
+    with the deviations not yet in the DB. Unless force_full_scan is set,
+    paging stops at the first deviation we already have, since everything
+    after it was picked up by a previous run. Metadata for the new deviations
+    is prefetched before returning.
+    """
+    if sync_type == GALLERY:
+        def get_page(offset):
+            return da_api.get_gallery_folder(
+                username=username, folderid=folder["folderid"], mode="newest",
+                offset=offset, limit=DEVIATION_PAGE_SIZE)
+    else:
+        def get_page(offset):
+            return da_api.get_collection(
+                folderid=folder["folderid"], username=username,
+                offset=offset, limit=DEVIATION_PAGE_SIZE)
+
+    new_deviations = []
+    offset = 0
+    has_more = True
+    while has_more:
+        try:
+            rate_limiter.wait()
+            fetched_deviations = get_page(offset)
+        except deviantart.api.DeviantartError as error:
+            LOGGER.error("Error querying DA API for collection: %s" % error)
+            break
+        offset = fetched_deviations["next_offset"]
+        has_more = fetched_deviations["has_more"]
+        for deviation in fetched_deviations["results"]:
+            if deviation.deviationid in existing_deviationids:
                 if force_full_scan is False:
-                    for deviation in fetched_deviations["results"]:
-                        if deviation.deviationid in existing_deviationids:
-                            break
+                    has_more = False
+                    break
+            else:
+                new_deviations.append(deviation)
+    metadata_cache.prefetch(
+        deviationids=[deviation.deviationid for deviation in new_deviations])
+    return folder, new_deviations
 
-            except deviantart.api.DeviantartError as error:
-                # catch and print API exception and stop loop
-                LOGGER.error("Error querying DA API for collection: %s" % error)
-                has_more = False
 
-        new_deviations = []
-        for deviation in deviations:
-            if deviation.deviationid not in existing_deviationids:
-                new_deviations.append(deviation)
-        LOGGER.info("%s new deviations found.", len(new_deviations))
-
-        # Only pull all tags ahead of time if we have a lot of new files.
-        existing_tags_by_name = dict()
-        if len(new_deviations) > 50:
-            existing_tags = database.session.query(Tag).all()
-            existing_tags_by_name = {
-                tag.name: tag for tag in existing_tags
-            }
-
-        # Loop through deviations and save author data.
-        for deviation in new_deviations:
-            # Grab user data.
-            get_da_user(
-                db_session=database.session,
-                da_api=da_api,
-                username=deviation.author.username,
-                media_storage_path=media_storage_path)
-
-        # Loop through and save deviations.
-        for deviation in new_deviations:
-            # If there's no content (if it's a story), skip for now.
-            deviation_name = (
-                str(deviation.title) + "." + str(deviation.author)). \
-                replace(" ", "_")
-            deviation_url = deviation.url
-
-            # Text based deviations need another API call to grab them.
-            file_url = None
-            if deviation.content is None:
-                # Flash files get handled specially.
-                if deviation.__dict__.get("flash"):
-                    file_url = deviation.__dict__.get("flash")["src"]
-                # Otherwise it's probably a text file. We'll catch (and report)
-                # the error if something blows up.
-                else:
-                    try:
-                        text_buffer = da_api.get_deviation_content(
-                            deviationid=deviation.deviationid)["html"]
-                    except deviantart.api.DeviantartError:
-                        LOGGER.error("Unable to download %s", deviation_name)
-                        LOGGER.error(deviation.__dict__)
-                        continue
-                    tracked_file, existing = TrackedFile.add_file(
-                        file_source="deviantart",
-                        db_session=database.session,
-                        media_path=media_storage_path,
-                        file_buffer=text_buffer.encode('utf-8'),
-                        original_filename=(deviation_name + ".html")
-                    )
+def __download_user_deviations(
+        database, media_storage_path, da_api, username, sync_type,
+        rate_limiter, metadata_cache, workers, force_full_scan=False):
+
+    # Grab set of existing deviationids.
+    existing_deviationids = set(
+        deviationid for (deviationid,) in
+        database.session.query(Deviation.deviationid))
+
+    folders = __list_folders(
+        da_api=da_api,
+        username=username,
+        sync_type=sync_type,
+        rate_limiter=rate_limiter)
+    LOGGER.info("Scanning %s %s folders for deviations...",
+                len(folders), sync_type)
+
+    # Folders are crawled in worker threads. Results are handed back as each
+    # folder finishes so the DB work below overlaps the remaining crawls.
+    crawled_folders = workers.thread_imap_unordered(
+        lambda folder: __crawl_folder(
+            da_api=da_api,
+            username=username,
+            sync_type=sync_type,
+            folder=folder,
+            existing_deviationids=existing_deviationids,
+            rate_limiter=rate_limiter,
+            metadata_cache=metadata_cache,
+            force_full_scan=force_full_scan),
+        folders)
+    for collection, new_deviations in crawled_folders:
+        __save_deviations(
+            database=database,
+            media_storage_path=media_storage_path,
+            da_api=da_api,
+            username=username,
+            sync_type=sync_type,
+            collection_name=collection["name"],
+            new_deviations=new_deviations,
+            metadata_cache=metadata_cache,
+            workers=workers,
+            rate_limiter=rate_limiter)
+
+
+def __save_deviations(database, media_storage_path, da_api, username,
+                      sync_type, collection_name, new_deviations,
+                      metadata_cache, workers, rate_limiter):
+    LOGGER.info("%s new deviations found in %s (%s).",
+                len(new_deviations), sync_type, collection_name)
+
+    # Only pull all tags ahead of time if we have a lot of new files.
+    existing_tags_by_name = dict()
+    if len(new_deviations) > 50:
+        existing_tags = database.session.query(Tag).all()
+        existing_tags_by_name = {
+            tag.name: tag for tag in existing_tags
+        }
+
+    # Save author data for the whole folder at once.
+    get_da_users(
+        db_session=database.session,
+        da_api=da_api,
+        usernames=[deviation.author.username for deviation in new_deviations],
+        media_storage_path=media_storage_path,
+        workers=workers,
+        rate_limiter=rate_limiter)
+
+    # Loop through and save deviations.
+    for deviation in new_deviations:
+        # If there's no content (if it's a story), skip for now.
+        deviation_name = (
+            str(deviation.title) + "." + str(deviation.author)). \
+            replace(" ", "_")
+        deviation_url = deviation.url
+
+        # Grab metadata for the deviation. This was normally prefetched
+        # along with the rest of the folder.
+        deviation_metadata = metadata_cache.get(
+            deviationid=deviation.deviationid)
+        if deviation_metadata is None:
+            LOGGER.error("Unable to obtain metadata for %s", deviation_name)
+            continue
+
+        # Text based deviations need another API call to grab them.
+        file_url = None
+        if deviation.content is None:
+            # Flash files get handled specially.
+            if deviation.__dict__.get("flash"):
+                file_url = deviation.__dict__.get("flash")["src"]
+            # Otherwise it's probably a text file. We'll catch (and report)
+            # the error if something blows up.
             else:
-                file_url = deviation.content["src"]
-
-            # Grab the file if we were handed a URL.
-            if file_url is not None:
-                tracked_file, existing = TrackedFile.download_file(
+                try:
+                    text_buffer = da_api.get_deviation_content(
+                        deviationid=deviation.deviationid)["html"]
+                except deviantart.api.DeviantartError:
+                    LOGGER.error("Unable to download %s", deviation_name)
+                    LOGGER.error(deviation.__dict__)
+                    continue
+                tracked_file, existing = TrackedFile.add_file(
+                    file_source="deviantart",
                     db_session=database.session,
                     media_path=media_storage_path,
-                    url=file_url,
-                    file_source="deviantart",
-                    filename_override=deviation_name,
-                    saved_url_override=deviation_url,
+                    file_buffer=text_buffer.encode('utf-8'),
+                    original_filename=(deviation_name + ".html")
                 )
+        else:
+            file_url = deviation.content["src"]
 
-            # Grab metadata for the deviation.
-            deviation_metadata = da_api.get_deviation_metadata(
-                deviationids=[deviation.deviationid],
-                ext_submission=True, ext_camera=True)[0]
-
-            # Create the Deviation DB entry. If we already have it, skip all
-            # this madness.
-            try:
-                database.session.query(Deviation).\
-                    filter_by(deviationid=str(deviation.deviationid)).one()
-                continue
-            except NoResultFound:
-                db_deviation = Deviation(
-                    title=deviation.title,
-                    description=deviation_metadata["description"],
-                    deviationid=deviation.deviationid,
-                )
-                db_deviation.file = tracked_file
-                database.session.add(db_deviation)
+        # Grab the file if we were handed a URL.
+        if file_url is not None:
+            tracked_file, existing = TrackedFile.download_file(
+                db_session=database.session,
+                media_path=media_storage_path,
+                url=file_url,
+                file_source="deviantart",
+                filename_override=deviation_name,
+                saved_url_override=deviation_url,
+            )
 
-            # Handle tags, category, and author tags.
-            if sync_type == GALLERY:
-                sync_type_tag_name = "gallery"
-            else:
-                sync_type_tag_name = "favorite"
-            tags_names = [
-                "da.user.%s.%s" % (username, sync_type_tag_name),
-                "da.user.%s.%s.%s" % (
-                    username, sync_type_tag_name, collection_name),
-                "da.author." + str(deviation.author),
-                collection_name,
-            ]
-            tags_names.extend(str(deviation.category_path).split("/"))
-            tags_names.extend(
-                [tag_dict["tag_name"]
-                 for tag_dict in deviation_metadata["tags"]]
+        # Create the Deviation DB entry. If we already have it, skip all
+        # this madness.
+        try:
+            database.session.query(Deviation).\
+                filter_by(deviationid=str(deviation.deviationid)).one()
+            continue
+        except NoResultFound:
+            db_deviation = Deviation(
+                title=deviation.title,
+                description=deviation_metadata["description"],
+                deviationid=deviation.deviationid,
             )
-            if deviation_metadata["is_mature"]:
-                tags_names.append("nsfw")
-            for tag_name in tags_names:
-                if tag_name in existing_tags_by_name:
-                    tag = existing_tags_by_name[tag_name]
-                else:
-                    tag = Tag.get_tag(
-                        db_session=database.session,
-                        tag_name=tag_name)
-                    existing_tags_by_name[tag_name] = tag
-                if tag_name not in tracked_file.tag_names:
-                    tracked_file.tags.append(tag)
-                if tag_name not in db_deviation.tag_names:
-                    db_deviation.tags.append(tag)
-
-            database.session.commit()
+            db_deviation.file = tracked_file
+            database.session.add(db_deviation)
+
+        # Handle tags, category, and author tags.
+        if sync_type == GALLERY:
+            sync_type_tag_name = "gallery"
+        else:
+            sync_type_tag_name = "favorite"
+        tags_names = [
+            "da.user.%s.%s" % (username, sync_type_tag_name),
+            "da.user.%s.%s.%s" % (
+                username, sync_type_tag_name, collection_name),
+            "da.author." + str(deviation.author),
+            collection_name,
+        ]
+        tags_names.extend(str(deviation.category_path).split("/"))
+        tags_names.extend(
+            [tag_dict["tag_name"]
+             for tag_dict in deviation_metadata["tags"]]
+        )
+        if deviation_metadata["is_mature"]:
+            tags_names.append("nsfw")
+        for tag_name in tags_names:
+            if tag_name in existing_tags_by_name:
+                tag = existing_tags_by_name[tag_name]
+            else:
+                tag = Tag.get_tag(
+                    db_session=database.session,
+                    tag_name=tag_name)
+                existing_tags_by_name[tag_name] = tag
+            if tag_name not in tracked_file.tag_names:
+                tracked_file.tags.append(tag)
+            if tag_name not in db_deviation.tag_names:
+                db_deviation.tags.append(tag)
+
+        database.session.commit()
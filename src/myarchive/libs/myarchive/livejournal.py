@@ -6,13 +6,15 @@
 # @Last modified time: 2017/07/21
 # @License MIT
 
+import copy
 import logging
+import socket
 
 from datetime import datetime
 from myarchive.libs.livejournal import lj
 from myarchive.libs.livejournal.backup import (
-    DEFAULT_JOURNAL, update_journal_entries, update_journal_comments,
-    datetime_from_string)
+    DEFAULT_JOURNAL, update_journal_entries, get_meta_since,
+    iter_bodies_since, datetime_from_string, days_ago)
 from sqlalchemy.orm.exc import NoResultFound
 
 from myarchive.db.tag_db.tables.ljtables import (
@@ -21,6 +23,9 @@ from myarchive.db.tag_db.tables.ljtables import (
 
 LOGGER = logging.getLogger(__name__)
 
+# Comment rows are sent to the DB this many at a time.
+COMMENT_BATCH_SIZE = 1000
+
 
 class LJAPIConnection(object):
 
@@ -34,11 +39,12 @@ class LJAPIConnection(object):
         :param username:
         :param password:
         """
-        self.journal = DEFAULT_JOURNAL.copy()
+        self.journal = copy.deepcopy(DEFAULT_JOURNAL)
         self._server = lj.LJServer(
             "Python-Blog3/1.0",
             user_agent=user_agent,
-            host=host)
+            host=host,
+            session_auth=True)
         self.journal['login'] = self.login = self._server.login(
             user=username,
             password=password)
@@ -49,6 +55,20 @@ class LJAPIConnection(object):
             db_session.add(self.ljhost)
             db_session.commit()
 
+    def close(self):
+        """Expires our LJ session and closes the connections to the host."""
+        self._server.close()
+
+    def _expire_session(self, session):
+        """
+        Expires a session we generated. Failing to is only logged, so that
+        it neither hides an error already being raised nor ends the import.
+        """
+        try:
+            self._server.sessionexpire([lj.session_id(session)])
+        except (lj.LJException, socket.error) as error:
+            LOGGER.warning("Unable to expire LJ session: %s", error)
+
     def post_journal(self, subject, post, tags):
         """
         Posts a journal to the specified LJ server.
@@ -61,67 +81,165 @@ class LJAPIConnection(object):
     def download_journals_and_comments(self, db_session):
         """Downloads journals and comments to a defined dictionary."""
 
+        # Pick up where the last sync of this journal left off.
+        poster = LJUser.get_user(
+            db_session=db_session,
+            user_id=int(self.journal['login']["userid"]),
+            username=self.journal['login']["fullname"],
+            lj_host=self.ljhost)
+        self.ljhost.users.append(poster)
+        db_session.commit()
+        poster.load_sync_state(journal=self.journal)
+        LOGGER.debug(
+            "Syncing LJ entries since %s.", self.journal['last_entry'])
+
         # Sync entries from the server
         print("Downloading journal entries")
         new_journals = \
             update_journal_entries(server=self._server, journal=self.journal)
 
+        entries = []
+        for itemid, entry in self.journal["entries"].items():
+            props = entry.get("props", {})
+            taglist = props.get("taglist")
+            entries.append({
+                "itemid": int(itemid),
+                "eventtime": datetime_from_string(entry["eventtime"]),
+                "subject": entry.get("subject"),
+                "text": str(entry["event"]),
+                "current_music": props.get("current_music"),
+                "synctime": self.journal["entry_synctimes"].get(int(itemid)),
+                "tag_names": taglist.split(", ") if taglist else [],
+            })
+        inserted, updated = LJEntry.bulk_upsert(
+            db_session=db_session, lj_user=poster, entries=entries)
+        LOGGER.info(
+            "Added %s and updated %s LJ entries.", inserted, updated)
+        db_session.commit()
+
         # Sync comments from the server
-        # print("Downloading comments")
-        # new_comments = update_journal_comments(
-        #     server=self._server, journal=self.journal)
-
-        # print("Updated %d entries and %d comments" % (nj, nc))
-        print(self.journal['login'])
-
-        users = {
-            int(self.journal['login']["userid"]):
-                self.journal['login']["fullname"],
-                # self.journal['login']["username"],
-        }
-        # for user_id, username in self.journal["comment_posters"].items():
-        #     users[int(user_id)] = username
-
-        poster = None
-        lj_users = dict()
-        for user_id, username in users.items():
-            ljuser = LJUser.get_user(
-                db_session=db_session, user_id=user_id, username=username)
-            self.ljhost.users.append(ljuser)
-            lj_users[user_id] = ljuser
-            if user_id == int(self.journal['login']["userid"]):
-                poster = ljuser
+        print("Downloading comments")
+        new_comments = self._download_comments(
+            db_session=db_session, poster=poster)
+        print("Updated %d entries and %d comments" % (
+            new_journals, new_comments))
+
+        # Only record the new sync state once everything it covers is saved.
+        poster.save_sync_state(journal=self.journal)
         db_session.commit()
 
-        lj_entries = dict()
-        for entry_id, entry in self.journal["entries"].items():
-            LOGGER.critical(entry)
-            LOGGER.critical(entry["event"])
-            lj_entry = LJEntry.get_or_add_entry(
+    def _download_comments(self, db_session, poster):
+        """
+        Streams comments posted since the last sync straight into the DB.
+        Posters are resolved in one pass from the export's usermaps, rows are
+        inserted in batches as the bodies arrive (in ID order), and replies
+        are linked to their parents by LJ itemid once every row exists.
+        Nothing is committed here, so a failed run leaves no partial import.
+
+        Every 30 days the metadata of all comments is read again, so that
+        posters and states (screened, deleted...) changed since are updated.
+        Comments on entries we don't have are logged and skipped.
+        """
+        refresh_meta = (
+            self.journal['last_comment_meta'] is None or
+            days_ago(self.journal['last_comment_meta']) > 30)
+        # Reuse the cookie auth session login() set up if there is one.
+        session = self._server.transport.session
+        generated_session = session is None
+        if generated_session:
+            session = self._server.sessiongenerate()
+        try:
+            meta = get_meta_since(
+                '0' if refresh_meta else self.journal['last_comment'],
+                self._server, session)
+            self.journal['comment_posters'].update(meta['usermaps'])
+            lj_users = LJUser.get_users(
                 db_session=db_session,
-                lj_user=poster,
-                itemid=entry_id,
-                eventtime=datetime_from_string(entry["eventtime"]),
-                subject=entry["subject"],
-                text=str(entry["event"]),
-                current_music=entry["props"].get("current_music"),
-                tag_list=entry["props"].get("taglist")
-            )
-            lj_entries[entry_id] = lj_entry
-        db_session.commit()
+                lj_host=self.ljhost,
+                usernames=dict(
+                    (int(user_id), username)
+                    for user_id, username in meta['usermaps'].items()))
+            user_row_ids = dict(
+                (user_id, lj_user.id) for user_id, lj_user in lj_users.items())
+            user_row_ids.setdefault(poster.user_id, poster.id)
+            entry_row_ids = dict(
+                db_session.query(LJEntry.itemid, LJEntry.id).
+                filter(LJEntry.user_id == poster.id))
+            comment_row_ids = LJComment.get_itemid_map(
+                db_session=db_session, lj_user=poster)
 
-        # for comment_id, comment in self.journal["comments"].items():
-        #     LJComment.get_or_add_comment(
-        #         db_session=db_session,
-        #         lj_user=lj_users[int(comment["posterid"])],
-        #         lj_entry=lj_entries[int(comment["jitemid"])],
-        #         itemid=int(comment_id),
-        #         subject=comment["subject"],
-        #         body=comment["body"],
-        #         date=datetime.strptime(comment["date"], "%Y-%m-%dT%H:%M:%SZ"),
-        #         parent_id=comment["parentid"]
-        #     )
-        db_session.commit()
+            new_comments = 0
+            rows = []
+            parent_itemids = dict()
+            orphaned_itemids = []
+            if int(meta['maxid'] or 0) <= int(self.journal['last_comment']):
+                comment_bodies = []
+            else:
+                comment_bodies = iter_bodies_since(
+                    highest=self.journal['last_comment'],
+                    maxid=meta['maxid'],
+                    server=self._server,
+                    session=session)
+            for comment_id, comment in comment_bodies:
+                itemid = int(comment_id)
+                if itemid in comment_row_ids:
+                    continue
+                entry_row_id = entry_row_ids.get(int(comment["jitemid"] or 0))
+                if entry_row_id is None:
+                    orphaned_itemids.append(itemid)
+                    continue
+                rows.append({
+                    "itemid": itemid,
+                    "entry_id": entry_row_id,
+                    "user_id": user_row_ids.get(int(comment["posterid"] or 0)),
+                    "subject": comment["subject"],
+                    "body": comment["body"],
+                    "date": datetime.strptime(
+                        comment["date"], "%Y-%m-%dT%H:%M:%SZ")
+                    if comment["date"] else None,
+                    "state": comment.get("state"),
+                })
+                if int(comment["parentid"] or 0):
+                    parent_itemids[itemid] = int(comment["parentid"])
+                new_comments += 1
+                if len(rows) >= COMMENT_BATCH_SIZE:
+                    LJComment.bulk_insert(db_session=db_session, rows=rows)
+                    rows = []
+            LJComment.bulk_insert(db_session=db_session, rows=rows)
+        finally:
+            if generated_session:
+                self._expire_session(session)
+
+        if parent_itemids:
+            comment_row_ids = LJComment.get_itemid_map(
+                db_session=db_session, lj_user=poster)
+            LJComment.bulk_link_parents(
+                db_session=db_session,
+                parent_ids=dict(
+                    (comment_row_ids[itemid], comment_row_ids[parent_itemid])
+                    for itemid, parent_itemid in parent_itemids.items()
+                    if parent_itemid in comment_row_ids))
+        if refresh_meta:
+            updated = LJComment.bulk_update_meta(
+                db_session=db_session,
+                lj_user=poster,
+                comment_meta=dict(
+                    (int(comment_id),
+                     (user_row_ids.get(int(posterid or 0)), state))
+                    for comment_id, (posterid, state) in
+                    meta['comments'].items()))
+            LOGGER.info("Refreshed the metadata of %s LJ comments.", updated)
+            self.journal['last_comment_meta'] = str(datetime.today())
+        if orphaned_itemids:
+            # Entries missing after the entry sync are gone from the
+            # journal, so these comments won't find a home later either.
+            LOGGER.warning(
+                "Skipped %s LJ comments on entries we don't have: %s",
+                len(orphaned_itemids),
+                ", ".join(str(itemid) for itemid in orphaned_itemids))
+        if int(meta['maxid'] or 0) > int(self.journal['last_comment']):
+            self.journal['last_comment'] = meta['maxid']
+        return new_comments
 
 
 def download_journals_and_comments(config, db_session):
@@ -140,4 +258,7 @@ def download_journals_and_comments(config, db_session):
                 password=config.get(
                     section=config_section, option="password"),
             )
-            ljapi.download_journals_and_comments(db_session=db_session)
+            try:
+                ljapi.download_journals_and_comments(db_session=db_session)
+            finally:
+                ljapi.close()
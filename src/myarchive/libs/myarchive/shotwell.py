@@ -8,16 +8,25 @@
 
 """Handles imports from shotwell databases."""
 
-from multiprocessing import Pool
+import os
+import re
 
 from collections import defaultdict
 from logging import getLogger
 from os.path import expanduser
 
+from sqlalchemy.orm import aliased
+
 from myarchive.db.tag_db.tables import TrackedFile, Tag
-from myarchive.db.tag_db.tables.file import get_md5sum_by_filename
+from myarchive.db.tag_db.tables.file import (
+    QUERY_CHUNK_SIZE, get_md5sum_by_filename)
+from myarchive.db.tag_db.tables.shotwelltables import (
+    ShotwellAppliedTag, ShotwellSyncedMedia)
 from myarchive.db.shotwell.shotwell_db import ShotwellDB
-from myarchive.db.shotwell.tables import PhotoTable, VideoTable, TagTable
+from myarchive.db.shotwell.tables import (
+    BackingPhotoTable, EventTable, PhotoTable, VideoTable, TagTable,
+    TombstoneTable)
+from myarchive.util.workers import borrow_workers
 
 
 LOGGER = getLogger("myarchive")
@@ -25,24 +34,70 @@ LOGGER = getLogger("myarchive")
 
 DEFAULT_STORAGE_FILEPATH = expanduser("~/.local/share/shotwell/images/")
 
+# TagTable.photo_id_list is a comma separated list of source IDs: "thumb" or
+# "video-" (for PhotoTable or VideoTable) then the row id as 16 hex digits.
+SOURCE_ID_REGEX = re.compile(r"(?:thumb|video-)[0-9a-fA-F]{16}")
+SOURCE_ID_PREFIXES = {
+    "PhotoTable": "thumb",
+    "VideoTable": "video-",
+    "BackingPhotoTable": "backing",
+}
+
+# PhotoTable columns pointing at BackingPhotoTable rows: the external editor
+# copy and the RAW developments.
+BACKING_PHOTO_COLUMNS = (
+    PhotoTable.editable_id,
+    PhotoTable.develop_shotwell_id,
+    PhotoTable.develop_camera_id,
+    PhotoTable.develop_embedded_id,
+)
+
+RATING_TAG_NAMES = {
+    -1: "rating:rejected",
+    1: "rating:1",
+    2: "rating:2",
+    3: "rating:3",
+    4: "rating:4",
+    5: "rating:5",
+}
+EVENT_TAG_FORMAT = "event:%s"
+
+STREAM_BATCH_SIZE = 1000
+
 
 def import_from_shotwell_db(
-        tag_db, media_storage_path, sw_database_path, sw_media_path):
-    """Imports images from the shotwell DB into ours."""
+        tag_db, media_storage_path, sw_database_path, sw_media_path,
+        workers=None):
+    """
+    Imports images from the shotwell DB into ours, along with their events,
+    ratings, titles, comments and backing photos (RAW developments and
+    editor copies). Rows whose file stats match the last import are skipped,
+    and files Shotwell has since dropped (or tombstoned) lose their shotwell
+    tag. Tags Shotwell stops listing only come off files an earlier import
+    put them on. Files without a usable Shotwell md5sum are hashed in workers'
+    process pool.
+    """
     sw_db = ShotwellDB(
         db_name=sw_database_path,
     )
+    synced_media = ShotwellSyncedMedia.get_synced(
+        db_session=tag_db.session, library=sw_database_path)
 
     # if sw_media_path != DEFAULT_STORAGE_FILEPATH:
     #     pass
 
-    shotwell_tag = Tag.get_tag(db_session=tag_db.session, tag_name="shotwell")
-    tag_db.session.commit()
-
-    LOGGER.info("Importing images... [Part 1 of 3]")
-    # Grab all the photos and add them.
-    files_by_id = dict()
-    for table in (PhotoTable, VideoTable):
+    LOGGER.info("Importing images... [Part 1 of 4]")
+    # Find the photos and videos that are new or changed since the last
+    # import, keying everything by Shotwell source ID.
+    file_ids_by_source_id = dict()
+    source_ids = set()
+    parent_source_ids = dict()
+    extra_tag_names = dict()
+    descriptions = dict()
+    redescribed_source_ids = []
+    changed_media = []
+    for (source_id, filepath, filesize, timestamp, md5sum, rating, title,
+         comment, event_name, parent_source_id) in _iter_library_media(sw_db):
 
         # if sw_media_path != DEFAULT_STORAGE_FILEPATH:
         #     pass
@@ -50,53 +105,242 @@ def import_from_shotwell_db(
         #     filepath = original_storage_path.replace(
         #         original_storage_path, sw_storage_folder_override)
 
-        # Calculate md5sums ahead of time and in parallel to speed this all up
-        # dramatically. (Also fix file extensions here.)
-        row_tuples = [
-            (photo_row[0], photo_row[1]) for photo_row in
-            sw_db.session.query(table.id, table.filename).all()]
-        md5sum_pool = Pool()
-        media_tuples = md5sum_pool.starmap(get_md5sum_by_filename, row_tuples)
-
-        for media_tuple in media_tuples:
-            media_id, media_path, media_md5sum = media_tuple
-            tracked_file, existing = TrackedFile.add_file(
-                file_source="shotwell",
-                db_session=tag_db.session,
-                media_path=media_storage_path,
-                copy_from_filepath=media_path,
-                md5sum_override=media_md5sum,
-            )
-            files_by_id[media_id] = tracked_file
-            if shotwell_tag not in tracked_file.tags:
-                tracked_file.tags.append(shotwell_tag)
-            if not existing:
-                tag_db.session.add(tracked_file)
-    tag_db.session.commit()
+        if source_id in source_ids:
+            continue
+        source_ids.add(source_id)
+        if parent_source_id is not None:
+            parent_source_ids[source_id] = parent_source_id
+        extra_tag_names[source_id] = [
+            tag_name for tag_name in (
+                RATING_TAG_NAMES.get(rating),
+                EVENT_TAG_FORMAT % event_name if event_name else None)
+            if tag_name is not None]
+        descriptions[source_id] = (title, comment)
 
-    LOGGER.info("Reading in tags... [Part 2 of 3]")
-    # Grab all the tags and apply them to the photos.
-    tags_by_id = defaultdict(list)
-    tags_by_tag_name = dict()
-    for tag_tuple in sw_db.session.query(
-            TagTable.name, TagTable.photo_id_list).all():
-        tag_name = tag_tuple[0]
-        tag_ids = list()
-        photo_id_str = tag_tuple[1]
-        if not photo_id_str:
+        synced = synced_media.get(source_id)
+        if (synced is not None and synced.file_id is not None and
+                synced.filepath == filepath and
+                synced.filesize == filesize and
+                synced.timestamp == timestamp):
+            file_ids_by_source_id[source_id] = synced.file_id
+            if (synced.title, synced.comment) != (title, comment):
+                redescribed_source_ids.append(source_id)
             continue
-        for photo_id in photo_id_str.split(","):
-            if not photo_id:
-                continue
-            tag_ids.append(int(photo_id[5:], 16))
-        for tag_id in tag_ids:
-            tags_by_id[tag_id].append(tag_name)
-        tags_by_tag_name[tag_name] = \
-            Tag.get_tag(db_session=tag_db.session, tag_name=tag_name)
-
-    LOGGER.info("Attaching tags... [Part 3 of 3]")
-    for photo_id, tracked_file in files_by_id.items():
-        for tag_name in tags_by_id[photo_id]:
-            tag = tags_by_tag_name[tag_name]
-            tracked_file.tags.append(tag)
+        try:
+            file_stat = os.stat(filepath)
+        except OSError:
+            LOGGER.warning(
+                "Shotwell file %s is missing, skipping it.", filepath)
+            continue
+        # Shotwell's md5 is only good if the file hasn't changed under it.
+        if (file_stat.st_size != filesize or
+                int(file_stat.st_mtime) != timestamp):
+            md5sum = None
+        changed_media.append(
+            [source_id, filepath, filesize, timestamp, md5sum or None])
+    LOGGER.info(
+        "%s of %s Shotwell files are new or changed.",
+        len(changed_media), len(source_ids))
+
+    # Hash the files Shotwell has no usable md5sum for.
+    unhashed = [
+        (index, media[1]) for index, media in enumerate(changed_media)
+        if media[4] is None]
+    if unhashed:
+        with borrow_workers(workers) as hash_workers:
+            for index, _, md5sum in hash_workers.process_imap_unordered(
+                    _get_md5sum, unhashed):
+                changed_media[index][4] = md5sum
+
+    imported_media = []
+    for source_id, filepath, filesize, timestamp, md5sum in changed_media:
+        tracked_file, existing = TrackedFile.add_file(
+            file_source="shotwell",
+            db_session=tag_db.session,
+            media_path=media_storage_path,
+            copy_from_filepath=filepath,
+            md5sum_override=md5sum,
+        )
+        if not existing:
+            tag_db.session.add(tracked_file)
+        imported_media.append(
+            (source_id, filepath, filesize, timestamp, md5sum, tracked_file))
+    # Read the ids off before committing expires them.
+    tag_db.session.flush()
+    new_rows = []
+    changed_rows = []
+    for source_id, filepath, filesize, timestamp, md5sum, tracked_file in \
+            imported_media:
+        file_ids_by_source_id[source_id] = tracked_file._id
+        title, comment = descriptions[source_id]
+        row = {
+            "source_id": source_id,
+            "filepath": filepath,
+            "filesize": filesize,
+            "timestamp": timestamp,
+            "md5sum": md5sum,
+            "title": title,
+            "comment": comment,
+            "file_id": tracked_file._id,
+        }
+        if source_id in synced_media:
+            row["row_id"] = synced_media[source_id].id
+            changed_rows.append(row)
+        else:
+            new_rows.append(row)
+    # Files whose description changed but whose contents didn't only need
+    # their sync rows refreshed.
+    for source_id in redescribed_source_ids:
+        synced = synced_media[source_id]
+        title, comment = descriptions[source_id]
+        changed_rows.append({
+            "source_id": source_id,
+            "filepath": synced.filepath,
+            "filesize": synced.filesize,
+            "timestamp": synced.timestamp,
+            "md5sum": synced.md5sum,
+            "title": title,
+            "comment": comment,
+            "file_id": synced.file_id,
+            "row_id": synced.id,
+        })
+    ShotwellSyncedMedia.bulk_save(
+        db_session=tag_db.session, library=sw_database_path,
+        new_rows=new_rows, changed_rows=changed_rows)
+    TrackedFile.bulk_set_descriptions(
+        db_session=tag_db.session,
+        descriptions=dict(
+            (file_ids_by_source_id[source_id], descriptions[source_id])
+            for source_id in redescribed_source_ids + [
+                media[0] for media in imported_media]))
+    tag_db.session.commit()
+
+    LOGGER.info("Reading in tags... [Part 2 of 4]")
+    # Decode every tag's photo_id_list in one pass.
+    tag_names_by_source_id = defaultdict(list)
+    for tag_name, photo_id_str in sw_db.session.query(
+            TagTable.name, TagTable.photo_id_list):
+        for source_id in SOURCE_ID_REGEX.findall(photo_id_str or ""):
+            tag_names_by_source_id[source_id.lower()].append(tag_name)
+    for source_id, tag_names in extra_tag_names.items():
+        tag_names_by_source_id[source_id].extend(tag_names)
+    # Backing photos share the tags of the photo they belong to.
+    for source_id, parent_source_id in parent_source_ids.items():
+        tag_names_by_source_id[source_id] = \
+            tag_names_by_source_id[parent_source_id]
+    tag_ids = Tag.get_tag_ids(
+        db_session=tag_db.session,
+        tag_names=list(set(
+            tag_name for tag_names in tag_names_by_source_id.values()
+            for tag_name in tag_names)) + ["shotwell"])
+    shotwell_tag_id = tag_ids["shotwell"]
+
+    LOGGER.info("Handling deletions... [Part 3 of 4]")
+    # Rows that are gone from Shotwell, and files it has tombstoned, are no
+    # longer part of the library. We keep the files, but drop the tag.
+    vanished_media = [
+        synced for source_id, synced in synced_media.items()
+        if source_id not in source_ids]
+    removed_file_ids = set(
+        synced.file_id for synced in vanished_media
+        if synced.file_id is not None)
+    tombstoned_md5sums = [
+        md5sum for (md5sum,) in
+        sw_db.session.query(TombstoneTable.md5).
+        filter(TombstoneTable.md5.isnot(None))]
+    for index in range(0, len(tombstoned_md5sums), QUERY_CHUNK_SIZE):
+        removed_file_ids.update(
+            file_id for (file_id,) in
+            tag_db.session.query(TrackedFile._id).filter(
+                TrackedFile.md5sum.in_(
+                    tombstoned_md5sums[index:index + QUERY_CHUNK_SIZE])))
+    removed_file_ids.difference_update(file_ids_by_source_id.values())
+    TrackedFile.detach_tags(
+        db_session=tag_db.session, file_ids=removed_file_ids,
+        tag_id=shotwell_tag_id)
+    ShotwellSyncedMedia.bulk_delete(
+        db_session=tag_db.session,
+        row_ids=[synced.id for synced in vanished_media])
+    LOGGER.info(
+        "%s files were removed from Shotwell since the last import.",
+        len(removed_file_ids))
+
+    LOGGER.info("Attaching tags... [Part 4 of 4]")
+    file_tag_ids = set()
+    for source_id, file_id in file_ids_by_source_id.items():
+        file_tag_ids.add((file_id, shotwell_tag_id))
+        for tag_name in tag_names_by_source_id.get(source_id, ()):
+            file_tag_ids.add((file_id, tag_ids[tag_name]))
+    # Only take off tags an earlier import put on, and only from files that
+    # are still in the library; anything else was applied by someone else.
+    current_file_ids = set(file_ids_by_source_id.values())
+    applied_pairs = ShotwellAppliedTag.get_pairs(
+        db_session=tag_db.session, library=sw_database_path)
+    stale_pairs = set(
+        pair for pair in applied_pairs - file_tag_ids
+        if pair[0] in current_file_ids)
+    TrackedFile.detach_tag_pairs(
+        db_session=tag_db.session, file_tag_ids=stale_pairs)
+    ShotwellAppliedTag.bulk_delete(
+        db_session=tag_db.session, library=sw_database_path,
+        file_tag_ids=stale_pairs.union(
+            pair for pair in applied_pairs
+            if pair[0] in removed_file_ids and pair[1] == shotwell_tag_id))
+    added = TrackedFile.attach_tags(
+        db_session=tag_db.session, file_tag_ids=file_tag_ids)
+    ShotwellAppliedTag.bulk_add(
+        db_session=tag_db.session, library=sw_database_path,
+        file_tag_ids=added - applied_pairs)
+    LOGGER.info(
+        "Attached %s new tags to Shotwell files and removed %s.",
+        len(added), len(stale_pairs))
     tag_db.session.commit()
+
+
+def _iter_library_media(sw_db):
+    """
+    Streams every photo, video and backing photo in a Shotwell library,
+    joined with its event, as tuples of (source_id, filepath, filesize,
+    timestamp, md5, rating, title, comment, event name, parent source_id).
+    Backing photos come right after the photo they belong to.
+    """
+    backing_photos = [
+        aliased(BackingPhotoTable) for _ in BACKING_PHOTO_COLUMNS]
+    photo_query = sw_db.session.query(
+        PhotoTable.id, PhotoTable.filename, PhotoTable.filesize,
+        PhotoTable.timestamp, PhotoTable.md5, PhotoTable.rating,
+        PhotoTable.title, PhotoTable.comment, EventTable.name,
+        *[column
+          for backing_photo in backing_photos
+          for column in (backing_photo.id, backing_photo.filepath,
+                         backing_photo.filesize, backing_photo.timestamp)]
+    ).outerjoin(EventTable, PhotoTable.event_id == EventTable.id)
+    for column, backing_photo in zip(BACKING_PHOTO_COLUMNS, backing_photos):
+        photo_query = photo_query.outerjoin(
+            backing_photo, column == backing_photo.id)
+    for row in photo_query.yield_per(STREAM_BATCH_SIZE):
+        source_id = "%s%016x" % (SOURCE_ID_PREFIXES["PhotoTable"], row[0])
+        yield (source_id,) + tuple(row[1:9]) + (None,)
+        for index in range(9, len(row), 4):
+            backing_id, filepath, filesize, timestamp = row[index:index + 4]
+            if backing_id is None:
+                continue
+            yield (
+                "%s%016x" % (SOURCE_ID_PREFIXES["BackingPhotoTable"],
+                             backing_id),
+                filepath, filesize, timestamp, None, None, None, None, None,
+                source_id)
+
+    video_query = sw_db.session.query(
+        VideoTable.id, VideoTable.filename, VideoTable.filesize,
+        VideoTable.timestamp, VideoTable.md5, VideoTable.rating,
+        VideoTable.title, VideoTable.comment, EventTable.name,
+    ).outerjoin(EventTable, VideoTable.event_id == EventTable.id)
+    for row in video_query.yield_per(STREAM_BATCH_SIZE):
+        source_id = "%s%016x" % (SOURCE_ID_PREFIXES["VideoTable"], row[0])
+        yield (source_id,) + tuple(row[1:9]) + (None,)
+
+
+def _get_md5sum(media):
+    """Pool worker hashing one (index, filepath) pair."""
+    return get_md5sum_by_filename(*media)
@@ -14,23 +14,31 @@ import csv
 import logging
 import json
 import os
+import queue
 import sys
+import threading
 import time
 
 from collections import namedtuple
-from sqlalchemy.orm.exc import NoResultFound
 from time import sleep
 
-from myarchive.db.tag_db.tables.twittertables import Tweet, TwitterUser
+from myarchive.db.tag_db.tables.twittertables import (
+    Tweet, TwitterUser, TwitterUserCache, UnavailableTweet,
+    get_missing_thread_ancestor_ids, index_tweet_replies,
+    index_unthreaded_tweets)
 from myarchive.db.tag_db.tables.tag import Tag
 from myarchive.libs import twitter
 from myarchive.libs.twitter import TwitterError
+from myarchive.libs.twitter.twitter_utils import enf_type
+from myarchive.util.workers import borrow_workers
 
 LOGGER = logging.getLogger(__name__)
 
 
 USER = "USER"
 FAVORITES = "FAVORITES"
+# Tweets fetched only to complete a reply chain.
+THREAD = "THREAD"
 
 KEYS = [
     u'user',
@@ -61,6 +69,19 @@ KEYS = [
 ]
 
 
+# statuses/lookup takes up to 100 IDs per call and allows 60 calls per 15
+# minutes for each set of credentials.
+LOOKUP_BATCH_SIZE = 100
+LOOKUP_SLEEP_TIME = 15
+LOOKUP_REQUESTS_BEFORE_SLEEPS = 60 - 1
+
+# Statuses added per commit when replaying the local JSON archive.
+REPLAY_BATCH_SIZE = 1000
+
+# Tweets or users whose media is fetched together, and committed per batch.
+MEDIA_BATCH_SIZE = 100
+
+
 CSVTweet = namedtuple(
     'CSVTweet',
     ["id",
@@ -76,11 +97,158 @@ CSVTweet = namedtuple(
 )
 
 
+class RawStatus(object):
+    """
+    A status as parsed from the API's JSON, with lazily decoded views of the
+    fields we store.
+
+    Stands in for twitter.Status, which copies the dict on the way in and
+    rebuilds it on every AsDict() call. The flattened AsDict() form found in
+    older tweet_storage_path files is accepted as well.
+    """
+
+    __slots__ = ("data", "_id", "_hashtags", "_media_urls")
+
+    def __init__(self, data):
+        self.data = data
+        self._id = None
+        self._hashtags = None
+        self._media_urls = None
+
+    def __repr__(self):
+        return "<RawStatus(id='%s')>" % self.id
+
+    @classmethod
+    def from_status(cls, status):
+        """Wraps a twitter.Status, passing RawStatus objects through."""
+        if isinstance(status, cls):
+            return status
+        return cls(status.AsDict())
+
+    @property
+    def id(self):
+        if self._id is None:
+            self._id = int(self.data["id"])
+        return self._id
+
+    @property
+    def text(self):
+        return self.data.get("full_text") or self.data.get("text")
+
+    @property
+    def created_at(self):
+        return self.data.get("created_at")
+
+    @property
+    def in_reply_to_status_id(self):
+        return self.data.get("in_reply_to_status_id")
+
+    @property
+    def user_dict(self):
+        return self.data["user"]
+
+    @property
+    def favorited(self):
+        return bool(self.data.get("favorited"))
+
+    @property
+    def hashtags(self):
+        """Hashtag texts, without the leading #."""
+        if self._hashtags is None:
+            hashtag_dicts = self.data.get("hashtags")
+            if hashtag_dicts is None:
+                hashtag_dicts = self.data.get(
+                    "entities", {}).get("hashtags", [])
+            self._hashtags = [
+                hashtag_dict["text"] for hashtag_dict in hashtag_dicts]
+        return self._hashtags
+
+    @property
+    def media_urls(self):
+        if self._media_urls is None:
+            media_dicts = self.data.get("media")
+            if media_dicts is None:
+                # extended_entities lists every image, entities only the
+                # first.
+                entities = (self.data.get("extended_entities") or
+                            self.data.get("entities", {}))
+                media_dicts = entities.get("media", [])
+            self._media_urls = [
+                media_dict["media_url_https"] for media_dict in media_dicts]
+        return self._media_urls
+
+    def AsDict(self):
+        return self.data
+
+
 class TwitterAPI(twitter.Api):
-    """API with an extra call."""
+    """
+    API with an extra call.
+
+    With fast_decode set (the default), statuses come back as RawStatus
+    objects wrapping the parsed JSON instead of twitter.Status models.
+    """
 
-    def __init__(self, **kwargs):
+    def __init__(self, fast_decode=True, **kwargs):
         super(TwitterAPI, self).__init__(sleep_on_rate_limit=True, **kwargs)
+        self.fast_decode = fast_decode
+        self._lookup_request_index = 0
+        self._lookup_start_time = -1
+
+    def _decode_statuses(self, data):
+        if self.fast_decode:
+            return [RawStatus(status_dict) for status_dict in data]
+        return [twitter.Status.NewFromJsonDict(x) for x in data]
+
+    def GetUserTimeline(self, user_id=None, screen_name=None, since_id=None,
+                        max_id=None, count=None, include_rts=True,
+                        trim_user=False, exclude_replies=False):
+        """twitter.Api.GetUserTimeline, decoded per fast_decode."""
+        url = '%s/statuses/user_timeline.json' % self.base_url
+        parameters = dict()
+        if user_id:
+            parameters['user_id'] = enf_type('user_id', int, user_id)
+        elif screen_name:
+            parameters['screen_name'] = screen_name
+        if since_id:
+            parameters['since_id'] = enf_type('since_id', int, since_id)
+        if max_id:
+            parameters['max_id'] = enf_type('max_id', int, max_id)
+        if count:
+            parameters['count'] = enf_type('count', int, count)
+        parameters['include_rts'] = enf_type(
+            'include_rts', bool, include_rts)
+        parameters['trim_user'] = enf_type('trim_user', bool, trim_user)
+        parameters['exclude_replies'] = enf_type(
+            'exclude_replies', bool, exclude_replies)
+
+        resp = self._RequestUrl(url, 'GET', data=parameters)
+        data = self._ParseAndCheckTwitter(resp.content.decode('utf-8'))
+
+        return self._decode_statuses(data)
+
+    def GetFavorites(self, user_id=None, screen_name=None, count=None,
+                     since_id=None, max_id=None, include_entities=True):
+        """twitter.Api.GetFavorites, decoded per fast_decode."""
+        url = '%s/favorites/list.json' % self.base_url
+        parameters = dict()
+        if user_id:
+            parameters['user_id'] = enf_type('user_id', int, user_id)
+        elif screen_name:
+            parameters['screen_name'] = screen_name
+        if since_id:
+            parameters['since_id'] = enf_type('since_id', int, since_id)
+        if max_id:
+            parameters['max_id'] = enf_type('max_id', int, max_id)
+        if count:
+            parameters['count'] = enf_type('count', int, count)
+        parameters['include_entities'] = enf_type(
+            'include_entities', bool, include_entities)
+
+        resp = self._RequestUrl(url, 'GET', data=parameters)
+        data = self._ParseAndCheckTwitter(resp.content.decode('utf-8'))
+
+        return self._decode_statuses(data)
 
     def LookupStatuses(self, status_ids, trim_user=False,
                        include_entities=True):
@@ -101,7 +269,8 @@ class TwitterAPI(twitter.Api):
             discreet structure, including: user_mentions, urls, and
             hashtags. [Optional]
         Returns:
-          A twitter.Status instance representing that status message
+          A list of twitter.Status (or RawStatus, with fast_decode)
+          instances
         """
         url = '%s/statuses/lookup.json' % self.base_url
 
@@ -121,16 +290,104 @@ class TwitterAPI(twitter.Api):
         resp = self._RequestUrl(url, 'GET', data=parameters)
         data = self._ParseAndCheckTwitter(resp.content.decode('utf-8'))
 
-        return [twitter.Status.NewFromJsonDict(x) for x in data]
+        return self._decode_statuses(data)
+
+    def PacedLookupStatuses(self, status_ids):
+        """
+        LookupStatuses, spaced out to stay under the rate limit for these
+        credentials and retried if we overrun it anyway.
+        """
+        status_ids = [str(status_id) for status_id in status_ids]
+        while True:
+            # Twitter rate-limits us. Space this out a bit to avoid a
+            # super-long sleep at the end doesn't kill the connection.
+            if self._lookup_request_index >= LOOKUP_REQUESTS_BEFORE_SLEEPS:
+                duration = time.time() - self._lookup_start_time
+                if duration < LOOKUP_SLEEP_TIME:
+                    sleep_duration = LOOKUP_SLEEP_TIME - duration
+                    LOGGER.debug(
+                        "Sleeping for %s seconds to avoid hitting Twitter's "
+                        "API rate limit...", sleep_duration)
+                    sleep(sleep_duration)
+            self._lookup_request_index += 1
+            self._lookup_start_time = time.time()
+            try:
+                return self.LookupStatuses(
+                    status_ids=status_ids,
+                    trim_user=False,
+                    include_entities=True)
+            except TwitterError as e:
+                # If we overran the rate limit, try again.
+                if e.message[0][u'code'] == 88:
+                    LOGGER.warning(
+                        "Overran rate limit. Sleeping %s seconds in an "
+                        "attempt to recover...", LOOKUP_SLEEP_TIME)
+                    self._lookup_request_index = \
+                        LOOKUP_REQUESTS_BEFORE_SLEEPS
+                    sleep(LOOKUP_SLEEP_TIME)
+                    continue
+                raise
+
+    def backfill_thread_ancestors(self, database, tweet_storage_path):
+        """
+        Fetches tweets that archived tweets reply to but we don't have yet,
+        100 at a time, until every reply chain is complete or only
+        unavailable (deleted or protected) tweets are left. Unavailable
+        tweets are recorded so that later runs don't look them up again.
+        """
+        user_cache = TwitterUserCache(db_session=database.session)
+        num_indexed = index_unthreaded_tweets(db_session=database.session)
+        if num_indexed:
+            LOGGER.info("Indexed %s tweets into reply chains.", num_indexed)
+        database.session.commit()
+
+        while True:
+            missing_ids = get_missing_thread_ancestor_ids(
+                db_session=database.session)
+            if not missing_ids:
+                break
+            LOGGER.info(
+                "Fetching %s missing reply chain tweets...", len(missing_ids))
+            for index in range(0, len(missing_ids), LOOKUP_BATCH_SIZE):
+                sliced_ids = missing_ids[index:index + LOOKUP_BATCH_SIZE]
+                statuses = [
+                    RawStatus.from_status(status) for status in
+                    self.PacedLookupStatuses(status_ids=sliced_ids)]
+                UnavailableTweet.bulk_add(
+                    db_session=database.session,
+                    tweet_ids=set(sliced_ids).difference(
+                        status.id for status in statuses))
+                user_cache.preload([status.user_dict for status in statuses])
+                new_tweets = []
+                for status in statuses:
+                    # Dump the tweet as a JSON file in case something goes
+                    # wrong.
+                    tweet_filepath = os.path.join(
+                        tweet_storage_path, "%s.json" % status.id)
+                    with open(tweet_filepath, 'w') as fptr:
+                        json.dump(status.data, fptr)
+                    new_tweets.append(
+                        add_status_to_db(
+                            db_session=database.session,
+                            status=status,
+                            tweet_type=THREAD,
+                            username=None,
+                            user_cache=user_cache))
+                index_tweet_replies(
+                    db_session=database.session,
+                    reply_pairs=get_reply_pairs(new_tweets))
+                database.session.commit()
 
     def import_tweets(
             self, database, username, tweet_storage_path,
-            media_storage_path, tweet_type):
+            media_storage_path, tweet_type, workers=None):
         """
         Archives several types of new tweets along with their associated
-        content.
+        content. Media is downloaded in workers' thread pool while we wait
+        out the rate limit.
         """
         existing_tweet_ids = database.get_existing_tweet_ids()
+        user_cache = TwitterUserCache(db_session=database.session)
 
         new_tweets = []
         # Always start with None to pick up max number of new tweets.
@@ -141,7 +398,6 @@ class TwitterAPI(twitter.Api):
         early_termination = False
         request_index = 0
         requests_before_sleeps = 1
-        statuses = []
         while not early_termination:
             # Twitter rate-limits us. Space this out a bit to avoid a
             # super-long sleep at the end doesn't kill the connection.
@@ -149,10 +405,11 @@ class TwitterAPI(twitter.Api):
                 # If we hit the rate limit, download media while we wait.
                 duration = time.time() - start_time
                 if duration < sleep_time:
-                    for new_tweet in new_tweets:
-                        new_tweet.download_media(
-                            db_session=database.session,
-                            media_path=media_storage_path)
+                    Tweet.bulk_download_media(
+                        db_session=database.session,
+                        media_path=media_storage_path,
+                        tweets=new_tweets,
+                        workers=workers)
                     # If we're still too fast, wait however long we need to.
                     duration = time.time() - start_time
                     if duration < sleep_time:
@@ -206,8 +463,10 @@ class TwitterAPI(twitter.Api):
             # Check for early termination condition. We'll kick out if we
             # pass since_id, or if we're pulling user tweets and we've hit
             # this ID previously.
+            statuses = []
             for loop_status in loop_statuses:
-                status_id = int(loop_status.AsDict()["id"])
+                loop_status = RawStatus.from_status(loop_status)
+                status_id = loop_status.id
                 if ((since_id is not None and status_id >= since_id) or
                         (tweet_type == "USER" and
                          status_id in existing_tweet_ids)):
@@ -219,7 +478,7 @@ class TwitterAPI(twitter.Api):
                 tweet_filepath = os.path.join(
                     tweet_storage_path, "%s.json" % status_id)
                 with open(tweet_filepath, 'w') as fptr:
-                    json.dump(loop_status.AsDict(), fptr)
+                    json.dump(loop_status.data, fptr)
                 statuses.append(loop_status)
                 # Capture new max_id
                 if max_id is None or status_id < max_id:
@@ -227,253 +486,298 @@ class TwitterAPI(twitter.Api):
 
             # Format things the way we want and handle max_id changes.
             LOGGER.info("Adding %s tweets to DB...", len(statuses))
-            existing_tweet_ids = [
-                returned_tuple[0]
-                for returned_tuple in database.session.query(Tweet.id).all()]
-            user = None
+            existing_tweet_ids = database.get_existing_tweet_ids()
+            user_cache.preload(
+                [status.user_dict for status in statuses])
+            page_tweets = []
             for status in statuses:
-                status_dict = status.AsDict()
-                status_id = int(status_dict["id"])
-                if status_id not in existing_tweet_ids:
-                    # Add the user to the DB if needed.
-                    # Only really query if we absolutely have to.
-                    user_dict = status_dict["user"]
-                    user_id = int(user_dict["id"])
-                    if user and user.id == user_id:
-                        pass
-                    else:
-                        try:
-                            user = database.session.query(TwitterUser). \
-                                filter_by(id=user_id).one()
-                        except NoResultFound:
-                            user = TwitterUser(user_dict)
-                            database.session.add(user)
-
-                    # Add the tweet to the DB.
-                    media_urls_list = list()
-                    if status_dict.get("media"):
-                        media_urls_list = [
-                            media_dict["media_url_https"]
-                            for media_dict in status_dict["media"]
-                        ]
-                    tweet = Tweet(
-                        id=status_id,
-                        text=status_dict["text"],
-                        in_reply_to_status_id=
-                        status_dict.get("in_reply_to_status_id"),
-                        created_at=status_dict["created_at"],
-                        media_urls_list=media_urls_list,
-                    )
-                    new_tweets.append(tweet)
-                    database.session.add(tweet)
-
-                    apply_tags_to_tweet(
+                if status.id not in existing_tweet_ids:
+                    tweet = add_status_to_db(
                         db_session=database.session,
-                        tweet=tweet,
+                        status=status,
                         tweet_type=tweet_type,
-                        status_dict=status_dict,
                         username=username,
-                        author_username=user.name)
+                        user_cache=user_cache)
+                    page_tweets.append(tweet)
+            index_tweet_replies(
+                db_session=database.session,
+                reply_pairs=get_reply_pairs(page_tweets))
+            new_tweets.extend(page_tweets)
             database.session.commit()
 
     def import_from_csv(self, database, tweet_storage_path, csv_filepath,
-                        username, media_storage_path):
-        existing_tweet_ids = database.get_existing_tweet_ids()
+                        username, media_storage_path, lookup_apis=(),
+                        workers=None):
+        """
+        Imports tweets listed in a Twitter archive CSV export.
 
-        csv_tweets_by_id = dict()
-        LOGGER.debug("Scanning CSV for new tweets...")
-        with open(csv_filepath) as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                tweet_id = int(row['tweet_id'])
-                if tweet_id not in existing_tweet_ids:
-                    csv_tweet = CSVTweet(
-                        id=tweet_id,
-                        username=username,
-                        in_reply_to_status_id=row["in_reply_to_status_id"],
-                        in_reply_to_user_id=row["in_reply_to_user_id"],
-                        timestamp=row["timestamp"],
-                        text=row["text"],
-                        retweeted_status_id=row["retweeted_status_id"],
-                        retweeted_status_user_id=
-                        row["retweeted_status_user_id"],
-                        retweeted_status_timestamp=
-                        row["retweeted_status_timestamp"],
-                        expanded_urls=row["expanded_urls"]
-                    )
-                    csv_tweets_by_id[tweet_id] = csv_tweet
-
-        csv_ids = list(csv_tweets_by_id.keys())
-        num_imports = len(csv_ids)
-        LOGGER.info(
-            "Attempting API import of %s tweets based on CSV file...",
-            num_imports)
-
-        # API allows 60 requests per 15 minutes.
-        sleep_time = 15
-        requests_before_sleeps = 60 - 1
-
-        api_calls = num_imports / 100
-        subsequent_api_calls = api_calls - requests_before_sleeps
-        if subsequent_api_calls <= 0:
-            # Rough estimate, but we basically won't hit the API limit.
-            time_to_complete = api_calls * 2
-        else:
-            time_to_complete = api_calls * 2 + subsequent_api_calls * sleep_time
+        The CSV is streamed in batches of up to 100 IDs, which are looked up
+        by one thread per set of credentials (this API plus any passed in
+        lookup_apis), each pacing itself against its own rate limit. DB work
+        stays on this thread and runs while the lookups are in flight.
+        Tweets the API no longer returns are imported from the CSV alone.
+        """
+        existing_tweet_ids = database.get_existing_tweet_ids()
+        user_cache = TwitterUserCache(db_session=database.session)
+        apis = [self] + list(lookup_apis)
         LOGGER.info(
-            "Estimated time to complete import: %s seconds.", time_to_complete)
+            "Attempting API import of tweets in %s using %s set(s) of "
+            "credentials...", csv_filepath, len(apis))
+
+        stop_event = threading.Event()
+        batch_queue = queue.Queue(maxsize=2 * len(apis))
+        result_queue = queue.Queue()
+        feeder_errors = []
+        feeder = threading.Thread(
+            target=_feed_csv_batches,
+            kwargs=dict(
+                csv_batches=iter_csv_tweet_batches(
+                    csv_filepath=csv_filepath,
+                    username=username,
+                    existing_tweet_ids=frozenset(existing_tweet_ids)),
+                batch_queue=batch_queue,
+                num_workers=len(apis),
+                stop_event=stop_event,
+                errors=feeder_errors),
+            daemon=True)
+        workers = [
+            StatusLookupWorker(
+                api=api,
+                batch_queue=batch_queue,
+                result_queue=result_queue,
+                stop_event=stop_event)
+            for api in apis]
+        feeder.start()
+        for worker in workers:
+            worker.start()
 
-        # Set loop starting values
         new_tweets = []
-        tweet_index = 0
-        request_index = 0
-        start_time = -1
-        sliced_ids = csv_ids[:100]
-        while sliced_ids:
-
-            # Sleep to not hit the rate limit.
-            # Twitter rate-limits us. Space this out a bit to avoid a
-            # super-long sleep at the end doesn't kill the connection.
-            if request_index >= requests_before_sleeps:
-                duration = time.time() - start_time
-                if duration < sleep_time:
-                    LOGGER.info("Switching to file download while we wait on "
-                                "the twitter API rate limit...")
-                    for new_tweet in new_tweets:
-                        if new_tweet.files_downloaded is False:
-                            new_tweet.download_media(
-                                db_session=database.session,
-                                media_path=media_storage_path)
-                    new_tweets = []
-                    # If we're still too fast, wait however long we need to.
-                    duration = time.time() - start_time
-                    if duration < sleep_time:
-                        sleep_duration = sleep_time - duration
-                        LOGGER.info(
-                            "Sleeping for %s seconds to avoid hitting "
-                            "Twitter's API rate limit...", sleep_duration)
-                        sleep(sleep_duration)
-            request_index += 1
-            start_time = time.time()
-
-            # Perform the import.
-            LOGGER.info(
-                "Attempting import of id %s to %s of %s...",
-                tweet_index + 1, min(tweet_index + 100, num_imports),
-                num_imports)
-            try:
-                statuses = self.LookupStatuses(
-                    status_ids=[str(sliced_id) for sliced_id in sliced_ids],
-                    trim_user=False,
-                    include_entities=True)
-                user = None
-                for status in statuses:
-                    status_dict = status.AsDict()
-
-                    # Dump the tweet as a JSON file in case something goes
-                    # wrong. Do none of this if we've passed the since_id
-                    # threhold.
-                    tweet_filepath = os.path.join(
-                        tweet_storage_path, "%s.json" % int(status_dict["id"]))
-                    with open(tweet_filepath, 'w') as fptr:
-                        json.dump(status_dict, fptr)
-
-                    # Add the user to the DB if needed.
-                    # Only really query if we absolutely have to.
-                    user_dict = status_dict["user"]
-                    user_id = int(user_dict["id"])
-                    if user and user.id == user_id:
-                        pass
-                    else:
-                        try:
-                            user = database.session.query(TwitterUser). \
-                                filter_by(id=user_id).one()
-                        except NoResultFound:
-                            user = TwitterUser(user_dict)
-                            database.session.add(user)
-
-                    status_id = int(status_dict["id"])
-                    media_urls_list = list()
-                    if status_dict.get("media"):
-                        media_urls_list = [
-                            media_dict["media_url_https"]
-                            for media_dict in status_dict["media"]
-                            ]
-                    tweet = Tweet(
-                        id=status_id,
-                        text=status_dict["text"],
-                        in_reply_to_status_id=
-                        status_dict.get("in_reply_to_status_id"),
-                        created_at=status_dict["created_at"],
-                        media_urls_list=media_urls_list,
-                    )
-                    new_tweets.append(tweet)
-                    database.session.add(tweet)
-
-                    apply_tags_to_tweet(
+        num_imported = 0
+        running_workers = len(workers)
+        try:
+            while running_workers > 0:
+                try:
+                    result = result_queue.get(timeout=1)
+                except queue.Empty:
+                    # Download media while we wait on the lookup threads.
+                    if new_tweets:
+                        new_tweets.pop().download_media(
+                            db_session=database.session,
+                            media_path=media_storage_path,
+                            workers=workers)
+                    continue
+                if result is None:
+                    running_workers -= 1
+                    continue
+                csv_batch, statuses = result
+                if isinstance(statuses, Exception):
+                    raise statuses
+                new_tweets.extend(
+                    _add_csv_batch_to_db(
                         db_session=database.session,
-                        tweet=tweet,
-                        tweet_type=USER,
-                        status_dict=status_dict,
+                        csv_batch=csv_batch,
+                        statuses=statuses,
+                        tweet_storage_path=tweet_storage_path,
                         username=username,
-                        author_username=username)
-
+                        existing_tweet_ids=existing_tweet_ids,
+                        user_cache=user_cache))
                 database.session.commit()
-
-            except TwitterError as e:
-                # If we overran the rate limit, try again.
-                if e.message[0][u'code'] == 88:
-                    LOGGER.warning(
-                        "Overran rate limit. Sleeping %s seconds in an "
-                        "attempt to recover...", sleep_time)
-                    request_index = requests_before_sleeps
-                    sleep(sleep_time)
-                    continue
-                raise
-            tweet_index += 100
-            sliced_ids = csv_ids[tweet_index:100 + tweet_index]
+                num_imported += len(csv_batch)
+                LOGGER.info("Imported %s tweets from CSV...", num_imported)
+            # Reading the CSV failed part way if the feeder left an error.
+            feeder.join()
+            if feeder_errors:
+                raise feeder_errors[0]
+        finally:
+            stop_event.set()
         database.session.commit()
 
-        LOGGER.info("Parsing out CSV-only tweets...")
-        # Refresh existing tweet ID list.
-        existing_tweet_ids = database.get_existing_tweet_ids()
-        for tweet_id, csv_only_tweet in csv_tweets_by_id.items():
-            if tweet_id not in existing_tweet_ids:
-                existing_tweet_ids.add(tweet_id)
-                tweet = Tweet(
-                    id=csv_only_tweet.id,
-                    text=csv_only_tweet.text,
-                    in_reply_to_status_id=csv_only_tweet.in_reply_to_status_id,
-                    created_at=csv_only_tweet.timestamp,
-                    media_urls_list=list(),
-                )
-                apply_tags_to_tweet(
-                    db_session=database.session,
-                    tweet=tweet,
-                    tweet_type=USER,
-                    status_dict=None,
+        download_media(
+            db_session=database.session, media_storage_path=media_storage_path,
+            workers=workers)
+
+
+class StatusLookupWorker(threading.Thread):
+    """
+    Looks up batches of CSV tweets pulled off a shared queue using a single
+    set of API credentials.
+    """
+
+    def __init__(self, api, batch_queue, result_queue, stop_event):
+        super(StatusLookupWorker, self).__init__(daemon=True)
+        self.api = api
+        self.batch_queue = batch_queue
+        self.result_queue = result_queue
+        self.stop_event = stop_event
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                csv_batch = self.batch_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if csv_batch is None:
+                break
+            try:
+                statuses = self.api.PacedLookupStatuses(
+                    status_ids=[csv_tweet.id for csv_tweet in csv_batch])
+            except Exception as e:
+                self.result_queue.put((csv_batch, e))
+                break
+            self.result_queue.put((csv_batch, statuses))
+        self.result_queue.put(None)
+
+
+def iter_csv_tweet_batches(csv_filepath, username, existing_tweet_ids,
+                           batch_size=LOOKUP_BATCH_SIZE):
+    """
+    Streams tweets not already in the DB out of a Twitter archive CSV in
+    lists of at most batch_size CSVTweets.
+    """
+    csv_batch = []
+    with open(csv_filepath) as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            tweet_id = int(row['tweet_id'])
+            if tweet_id in existing_tweet_ids:
+                continue
+            csv_batch.append(
+                CSVTweet(
+                    id=tweet_id,
                     username=username,
-                    author_username=username)
-        database.session.commit()
+                    in_reply_to_status_id=row["in_reply_to_status_id"],
+                    in_reply_to_user_id=row["in_reply_to_user_id"],
+                    timestamp=row["timestamp"],
+                    text=row["text"],
+                    retweeted_status_id=row["retweeted_status_id"],
+                    retweeted_status_user_id=
+                    row["retweeted_status_user_id"],
+                    retweeted_status_timestamp=
+                    row["retweeted_status_timestamp"],
+                    expanded_urls=row["expanded_urls"]
+                )
+            )
+            if len(csv_batch) >= batch_size:
+                yield csv_batch
+                csv_batch = []
+    if csv_batch:
+        yield csv_batch
+
+
+def _feed_csv_batches(csv_batches, batch_queue, num_workers, stop_event,
+                      errors):
+    """
+    Pushes CSV batches onto the lookup queue, then one stop per worker. The
+    stops are sent even if reading the CSV fails, in which case the error is
+    appended to errors for the main thread to raise.
+    """
+    try:
+        for csv_batch in csv_batches:
+            if not _put_unless_stopped(
+                    batch_queue=batch_queue, item=csv_batch,
+                    stop_event=stop_event):
+                return
+    except Exception as e:
+        errors.append(e)
+    finally:
+        for _ in range(num_workers):
+            if not _put_unless_stopped(
+                    batch_queue=batch_queue, item=None,
+                    stop_event=stop_event):
+                break
 
-        download_media(
-            db_session=database.session, media_storage_path=media_storage_path)
+
+def _put_unless_stopped(batch_queue, item, stop_event):
+    """Queues item, giving up if stop_event is set first."""
+    while not stop_event.is_set():
+        try:
+            batch_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _add_csv_batch_to_db(db_session, csv_batch, statuses, tweet_storage_path,
+                         username, existing_tweet_ids, user_cache):
+    """
+    Adds the looked up statuses for a CSV batch to the DB, falling back to
+    the CSV data for any the API didn't return. Returns the new tweets.
+    """
+    new_tweets = []
+    statuses = [RawStatus.from_status(status) for status in statuses]
+    user_cache.preload([status.user_dict for status in statuses])
+    for status in statuses:
+        status_id = status.id
+
+        # Dump the tweet as a JSON file in case something goes wrong.
+        tweet_filepath = os.path.join(
+            tweet_storage_path, "%s.json" % status_id)
+        with open(tweet_filepath, 'w') as fptr:
+            json.dump(status.data, fptr)
+
+        if status_id in existing_tweet_ids:
+            continue
+        existing_tweet_ids.add(status_id)
+        tweet = add_status_to_db(
+            db_session=db_session,
+            status=status,
+            tweet_type=USER,
+            username=username,
+            author_username=username,
+            user_cache=user_cache)
+        new_tweets.append(tweet)
+
+    # Deleted and protected tweets only exist in the CSV.
+    csv_only_tweets = []
+    for csv_tweet in csv_batch:
+        if csv_tweet.id in existing_tweet_ids:
+            continue
+        existing_tweet_ids.add(csv_tweet.id)
+        tweet = Tweet(
+            id=csv_tweet.id,
+            text=csv_tweet.text,
+            in_reply_to_status_id=csv_tweet.in_reply_to_status_id,
+            created_at=csv_tweet.timestamp,
+            media_urls_list=list(),
+        )
+        db_session.add(tweet)
+        apply_tags_to_tweet(
+            db_session=db_session,
+            tweet=tweet,
+            tweet_type=USER,
+            status=None,
+            username=username,
+            author_username=username)
+        csv_only_tweets.append(tweet)
+
+    index_tweet_replies(
+        db_session=db_session,
+        reply_pairs=get_reply_pairs(new_tweets + csv_only_tweets))
+    return new_tweets
+
+
+def get_api(config, config_section):
+    """Builds a TwitterAPI from the credentials in a Twitter_* section."""
+    return TwitterAPI(
+        consumer_key=config.get(
+            section=config_section, option="consumer_key"),
+        consumer_secret=config.get(
+            section=config_section, option="consumer_secret"),
+        access_token_key=config.get(
+            section=config_section, option="access_key"),
+        access_token_secret=config.get(
+            section=config_section, option="access_secret"),
+    )
 
 
 def import_tweets_from_api(
-        database, config, tweet_storage_path, media_storage_path):
+        database, config, tweet_storage_path, media_storage_path,
+        workers=None):
+    api = None
     for config_section in config.sections():
         if config_section.startswith("Twitter_"):
-            api = TwitterAPI(
-                consumer_key=config.get(
-                    section=config_section, option="consumer_key"),
-                consumer_secret=config.get(
-                    section=config_section, option="consumer_secret"),
-                access_token_key=config.get(
-                    section=config_section, option="access_key"),
-                access_token_secret=config.get(
-                    section=config_section, option="access_secret"),
-            )
+            api = get_api(config=config, config_section=config_section)
             for tweet_type in (USER, FAVORITES):
                 api.import_tweets(
                     database=database,
@@ -481,48 +785,204 @@ def import_tweets_from_api(
                         section=config_section, option="username"),
                     tweet_storage_path=tweet_storage_path,
                     media_storage_path=media_storage_path,
-                    tweet_type=tweet_type
+                    tweet_type=tweet_type,
+                    workers=workers,
                 )
+    # Any set of credentials can look up the tweets our replies answer.
+    if api is not None:
+        api.backfill_thread_ancestors(
+            database=database, tweet_storage_path=tweet_storage_path)
 
 
 def import_tweets_from_csv(database, config, tweet_storage_path,
-                           username, csv_filepath, media_storage_path):
+                           username, csv_filepath, media_storage_path,
+                           workers=None):
     for config_section in config.sections():
         if config_section.startswith("Twitter_%s" % username):
             break
     else:
         LOGGER.error("Username not found.")
         sys.exit(1)
-    api = TwitterAPI(
-        consumer_key=config.get(
-            section=config_section, option="consumer_key"),
-        consumer_secret=config.get(
-            section=config_section, option="consumer_secret"),
-        access_token_key=config.get(
-            section=config_section, option="access_key"),
-        access_token_secret=config.get(
-            section=config_section, option="access_secret"),
-    )
+    api = get_api(config=config, config_section=config_section)
+    # Every other set of credentials helps out with the lookups.
+    lookup_apis = [
+        get_api(config=config, config_section=other_section)
+        for other_section in config.sections()
+        if (other_section.startswith("Twitter_") and
+            other_section != config_section)
+    ]
     api.import_from_csv(
         database=database,
         tweet_storage_path=tweet_storage_path,
         csv_filepath=csv_filepath,
         username=username,
         media_storage_path=media_storage_path,
+        lookup_apis=lookup_apis,
+        workers=workers,
     )
 
 
-def apply_tags_to_tweet(
-        db_session, tweet, tweet_type, status_dict, username, author_username):
-    """Applies appropriate tags to the tweet."""
-    tag_names = set(
-        "twitter.%s.tweet" % author_username,
+def import_tweets_from_archive(database, tweet_storage_path, username,
+                               workers=None):
+    """
+    Rebuilds Tweet, TwitterUser and tag rows from the JSON files dumped
+    under tweet_storage_path without touching the API.
+
+    Files are parsed in workers' process pool and mapped to rows on this
+    process through add_status_to_db in batches of REPLAY_BATCH_SIZE
+    statuses, with one user preload and one commit per batch.
+    Since the archive doesn't record why a tweet was saved, statuses flagged
+    as favorited are tagged as favorites of username.
+    """
+    existing_tweet_ids = database.get_existing_tweet_ids()
+
+    # Files are named by tweet ID, so we can skip known tweets unread.
+    filepaths = []
+    for filename in os.listdir(tweet_storage_path):
+        tweet_id, extension = os.path.splitext(filename)
+        if (extension == ".json" and tweet_id.isdigit() and
+                int(tweet_id) not in existing_tweet_ids):
+            filepaths.append(os.path.join(tweet_storage_path, filename))
+    LOGGER.info(
+        "Replaying %s archived tweets from %s...",
+        len(filepaths), tweet_storage_path)
+
+    user_cache = TwitterUserCache(db_session=database.session)
+    num_imported = 0
+    statuses = []
+    with borrow_workers(workers) as parse_workers:
+        for status_dict in parse_workers.process_imap_unordered(
+                _load_status_file, sorted(filepaths)):
+            if status_dict is not None:
+                statuses.append(RawStatus(status_dict))
+            if len(statuses) >= REPLAY_BATCH_SIZE:
+                num_imported += _replay_statuses(
+                    db_session=database.session,
+                    statuses=statuses,
+                    username=username,
+                    existing_tweet_ids=existing_tweet_ids,
+                    user_cache=user_cache)
+                statuses = []
+                LOGGER.info("Replayed %s tweets...", num_imported)
+    num_imported += _replay_statuses(
+        db_session=database.session,
+        statuses=statuses,
+        username=username,
+        existing_tweet_ids=existing_tweet_ids,
+        user_cache=user_cache)
+    LOGGER.info("Replayed %s tweets in total.", num_imported)
+
+
+def _replay_statuses(db_session, statuses, username, existing_tweet_ids,
+                     user_cache):
+    """Adds a batch of archived statuses and commits, returning the count."""
+    user_cache.preload(
+        [status.user_dict for status in statuses],
+        status_ids=[status.id for status in statuses])
+    new_tweets = []
+    tag_names = dict()
+    for status in statuses:
+        if status.id in existing_tweet_ids:
+            continue
+        existing_tweet_ids.add(status.id)
+        if status.favorited:
+            tweet_type = FAVORITES
+        else:
+            tweet_type = USER
+        new_tweets.append(
+            add_status_to_db(
+                db_session=db_session,
+                status=status,
+                tweet_type=tweet_type,
+                username=username,
+                user_cache=user_cache,
+                tag_names=tag_names))
+    db_session.flush()
+    Tweet.bulk_add_tags(db_session=db_session, tag_names=tag_names)
+    index_tweet_replies(
+        db_session=db_session, reply_pairs=get_reply_pairs(new_tweets))
+    db_session.commit()
+    return len(new_tweets)
+
+
+def _load_status_file(filepath):
+    """Pool worker that reads a status dict dumped by the importers."""
+    try:
+        with open(filepath) as fptr:
+            return json.load(fptr)
+    except (OSError, ValueError) as e:
+        LOGGER.error("Unable to read archived tweet %s: %s", filepath, e)
+        return None
+
+
+def add_status_to_db(db_session, status, tweet_type, username, user_cache,
+                     author_username=None, tag_names=None):
+    """
+    Adds a Tweet (and its TwitterUser, if needed) for a RawStatus and tags
+    it. Preload user_cache with the page's authors first to avoid a user
+    query per status. If tag_names (a dict) is given, the tweet's tag names
+    are stored in it under the tweet ID for Tweet.bulk_add_tags instead.
+
+    Returns the new tweet.
+    """
+    user = user_cache.get(status.user_dict)
+
+    # Add the tweet to the DB.
+    tweet = Tweet(
+        id=status.id,
+        text=status.text,
+        in_reply_to_status_id=status.in_reply_to_status_id,
+        created_at=status.created_at,
+        media_urls_list=status.media_urls,
     )
-    if status_dict is not None and "hashtags" in status_dict:
-        for hashtag_dict in status_dict["hashtags"]:
-            tag_names.add(hashtag_dict["text"])
+    db_session.add(tweet)
+
+    if author_username is None:
+        author_username = user.name
+    if tag_names is not None:
+        tag_names[tweet.id] = get_tweet_tag_names(
+            tweet_type=tweet_type,
+            status=status,
+            username=username,
+            author_username=author_username)
+    else:
+        apply_tags_to_tweet(
+            db_session=db_session,
+            tweet=tweet,
+            tweet_type=tweet_type,
+            status=status,
+            username=username,
+            author_username=author_username)
+    return tweet
+
+
+def get_reply_pairs(tweets):
+    """Returns (tweet_id, in_reply_to_status_id) pairs for indexing."""
+    return [(tweet.id, tweet.in_reply_to_status_id) for tweet in tweets]
+
+
+def get_tweet_tag_names(tweet_type, status, username, author_username):
+    """
+    Returns the set of tag names a tweet gets. status is the tweet's
+    RawStatus, or None for CSV-only tweets.
+    """
+    tag_names = {"twitter.%s.tweet" % author_username}
+    if status is not None:
+        tag_names.update(status.hashtags)
     if tweet_type == FAVORITES:
         tag_names.add("twitter.%s.favorite" % username)
+    return tag_names
+
+
+def apply_tags_to_tweet(
+        db_session, tweet, tweet_type, status, username, author_username):
+    """
+    Applies appropriate tags to the tweet. status is the tweet's RawStatus,
+    or None for CSV-only tweets.
+    """
+    tag_names = get_tweet_tag_names(
+        tweet_type=tweet_type, status=status, username=username,
+        author_username=author_username)
     for tag_name in tag_names:
         tweet.tags.append(
             Tag.get_tag(
@@ -531,19 +991,33 @@ def apply_tags_to_tweet(
         )
 
 
-def download_media(db_session, media_storage_path):
-    for index, tweet in enumerate(
-            db_session.query(Tweet).
-            filter(Tweet.files_downloaded.is_(False))):
-        tweet.download_media(
-            db_session=db_session, media_path=media_storage_path)
-        if index % 100 == 0:
-            db_session.commit()
-    for index, user in enumerate(
-            db_session.query(TwitterUser).
-            filter(TwitterUser.files_downloaded.is_(False))):
-        user.download_media(
-            db_session=db_session, media_path=media_storage_path)
-        if index % 100 == 0:
-            db_session.commit()
-    db_session.commit()
+def download_media(db_session, media_storage_path, workers=None):
+    """
+    Downloads the media of every tweet and user still missing it, in batches
+    of MEDIA_BATCH_SIZE fetched in workers' thread pool, committing after
+    each batch.
+    """
+    for tweets in _iter_media_batches(db_session=db_session, model=Tweet):
+        Tweet.bulk_download_media(
+            db_session=db_session, media_path=media_storage_path,
+            tweets=tweets, workers=workers)
+        db_session.commit()
+    for users in _iter_media_batches(db_session=db_session, model=TwitterUser):
+        TwitterUser.bulk_download_media(
+            db_session=db_session, media_path=media_storage_path,
+            users=users, workers=workers)
+        db_session.commit()
+
+
+def _iter_media_batches(db_session, model):
+    """
+    Yields lists of model rows whose files haven't been downloaded yet.
+    Each batch must be marked downloaded before the next is asked for.
+    """
+    while True:
+        batch = db_session.query(model).\
+            filter(model.files_downloaded.is_(False)).\
+            limit(MEDIA_BATCH_SIZE).all()
+        if not batch:
+            return
+        yield batch
@@ -6,6 +6,7 @@
 # @Last modified time: 2017/07/21
 # @License MIT
 
+import hashlib
 import os
 
 from datetime import datetime
@@ -14,77 +15,158 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from myarchive.db.tag_db.tables.file import TrackedFile
 from myarchive.db.tag_db.tables.tag import Tag
-from myarchive.db.tag_db.tables.yttables import YTPlaylist, YTVideo
+from myarchive.db.tag_db.tables.yttables import (
+    YTPlaylist, YTVideo, get_existing_videoids)
 from myarchive.libs import pafy
+from myarchive.util.workers import borrow_workers
 
 LOGGER = getLogger(__name__)
 
+# Downloads are staged here, inside media_storage_path, so that filing them
+# away afterwards is a rename on the same filesystem.
+STAGING_DIRNAME = ".youtube_staging"
+# How many videos may be resolved ahead of the one being downloaded. Stream
+# URLs expire, so there's no point resolving the whole playlist up front.
+RESOLVE_LOOKAHEAD = 8
 
-def download_youtube_playlists(db_session, media_storage_path, playlist_urls):
+
+def _resolve_video(video):
+    """
+    Pool worker that picks the best stream for a video and probes its size.
+    The gdata fields needed for the DB are pulled here too, so that the main
+    thread only ever has to download.
+    """
+    try:
+        pafy_stream = video.getbest()
+        filesize = pafy_stream.get_filesize()
+        # pylint: disable=W0104
+        video.published, video.keywords, video.description
+    except Exception as whatwasthat:
+        LOGGER.error(whatwasthat)
+        return video, None, 0
+    return video, pafy_stream, filesize
+
+
+def filter_new_videos(playlist, existing_videoids, playlist_videoids):
+    """
+    Yields the videos of a playlist that aren't archived yet, collecting
+    every videoid seen (new or not) into playlist_videoids along the way.
+    Repeats within the playlist are only yielded once.
+    """
+    for video in playlist:
+        if (video.videoid not in existing_videoids and
+                video.videoid not in playlist_videoids):
+            playlist_videoids.add(video.videoid)
+            yield video
+        playlist_videoids.add(video.videoid)
+
+
+def resolve_playlist(playlist, workers):
+    """
+    Yields (video, stream, filesize) for each video of a playlist, in
+    playlist order, while workers' thread pool works on the next few. Stream
+    is None for videos that could not be resolved.
+    """
+    return workers.thread_imap(
+        _resolve_video, playlist, lookahead=RESOLVE_LOOKAHEAD)
+
+
+def download_youtube_playlists(db_session, media_storage_path, playlist_urls,
+                               workers=None):
     """Downloads videos"""
     LOGGER.warning(
         "Youtube downloads may take quite a lot of drive space! Make sure you "
         "have a good amount free before triggering video downloads.")
-    for playlist_url in playlist_urls:
-        playlist = pafy.get_playlist2(playlist_url=playlist_url)
-        LOGGER.info(
-            "Parsing playlist %s [%s]...", playlist.title, playlist.author)
+    staging_path = os.path.join(media_storage_path, STAGING_DIRNAME)
+    os.makedirs(staging_path, exist_ok=True)
+    existing_videoids = get_existing_videoids(db_session=db_session)
+    with borrow_workers(workers) as resolve_workers:
+        for playlist_url in playlist_urls:
+            _download_youtube_playlist(
+                db_session=db_session,
+                media_storage_path=media_storage_path,
+                staging_path=staging_path,
+                playlist_url=playlist_url,
+                existing_videoids=existing_videoids,
+                workers=resolve_workers)
+
+    db_session.commit()
+
+
+def _download_youtube_playlist(db_session, media_storage_path, staging_path,
+                               playlist_url, existing_videoids, workers):
+    playlist = pafy.get_playlist2(playlist_url=playlist_url)
+    LOGGER.info(
+        "Parsing playlist %s [%s]...", playlist.title, playlist.author)
+    try:
+        db_playlist = db_session.query(YTPlaylist).\
+            filter_by(plid=playlist.plid).one()
+    except NoResultFound:
+        db_playlist = YTPlaylist(
+            title=playlist.title,
+            author=playlist.author,
+            description=playlist.description,
+            plid=playlist.plid)
+        db_session.add(db_playlist)
+
+    # Videos we already have are dropped here, before anything is resolved.
+    playlist_videoids = set()
+    new_videos = filter_new_videos(
+        playlist=playlist,
+        existing_videoids=existing_videoids,
+        playlist_videoids=playlist_videoids)
+
+    total_bytes = 0
+    for video, stream, filesize in resolve_playlist(
+            playlist=new_videos, workers=workers):
+        if stream is None:
+            continue
+        total_bytes += filesize
+        LOGGER.info("Downloading %s...", stream.title)
+        staging_filepath = os.path.join(
+            staging_path, stream.generate_filename())
+        md5 = hashlib.md5()
+        stream.download(filepath=staging_filepath, hasher=md5)
         try:
-            db_playlist = db_session.query(YTPlaylist).\
-                filter_by(plid=playlist.plid).one()
-        except NoResultFound:
-            db_playlist = YTPlaylist(
-                title=playlist.title,
-                author=playlist.author,
-                description=playlist.description,
-                plid=playlist.plid)
-            db_session.add(db_playlist)
-
-        total_bytes = 0
-        video_stream_tuples = []
-        for video in playlist:
-            try:
-                pafy_stream = video.getbest()
-                video_stream_tuples.append([video, pafy_stream])
-                total_bytes += pafy_stream.get_filesize()
-            except Exception as whatwasthat:
-                LOGGER.error(whatwasthat)
-        LOGGER.info("Playlist DL size: %s MB" % int(total_bytes / 2 ** 20))
-
-        for video, stream in video_stream_tuples:
-            LOGGER.info("Downloading %s...", stream.title)
-            temp_filepath = "/tmp/" + stream.title + "." + stream.extension
-            stream.download(filepath=temp_filepath)
-            try:
-                tracked_file, existing = TrackedFile.add_file(
-                    db_session=db_session,
-                    media_path=media_storage_path,
-                    copy_from_filepath=temp_filepath,
-                    move_original_file=True,
-                )
-                if existing is True:
-                    os.remove(temp_filepath)
-                    continue
-                else:
-                    db_session.add(tracked_file)
-
-                ytvideo = YTVideo(
-                    uploader=video.username,
-                    description=video.description,
-                    duration=video.duration,
-                    publish_time=datetime.strptime(
-                        video.published, "%Y-%m-%d %H:%M:%S"    ),
-                    videoid=video.videoid
-                )
-                db_playlist.videos.append(ytvideo)
-                ytvideo.file = tracked_file
-                for keyword in video.keywords:
-                    tag = Tag.get_tag(db_session=db_session, tag_name=keyword)
-                    ytvideo.tags.append(tag)
+            tracked_file, existing = TrackedFile.add_file(
+                file_source="youtube",
+                db_session=db_session,
+                media_path=media_storage_path,
+                copy_from_filepath=staging_filepath,
+                md5sum_override=md5.hexdigest(),
+                move_original_file=True,
+            )
+            if existing is True:
+                os.remove(staging_filepath)
+            else:
+                db_session.add(tracked_file)
+
+            ytvideo = YTVideo(
+                uploader=video.username,
+                description=video.description,
+                duration=video.duration,
+                publish_time=datetime.strptime(
+                    video.published, "%Y-%m-%d %H:%M:%S"    ),
+                videoid=video.videoid
+            )
+            db_playlist.videos.append(ytvideo)
+            existing_videoids.add(video.videoid)
+            ytvideo.file = tracked_file
+            for keyword in video.keywords:
+                tag = Tag.get_tag(db_session=db_session, tag_name=keyword)
+                ytvideo.tags.append(tag)
+                if keyword not in tracked_file.tag_names:
                     tracked_file.tags.append(tag)
-                db_session.commit()
-            except:
-                db_session.rollback()
-                raise
+            db_session.commit()
+        except:
+            db_session.rollback()
+            raise
 
+    # The playlist has been fully enumerated by now, so sync which archived
+    # videos belong to it. This also picks up known videos that were added
+    # to (or dropped from) the playlist since the last run.
+    db_playlist.update_membership(
+        db_session=db_session, videoids=playlist_videoids)
     db_session.commit()
+    LOGGER.info("Playlist %s DL size: %s MB",
+                playlist.title, int(total_bytes / 2 ** 20))
@@ -6,6 +6,7 @@ __license__ = "LGPLv3"
 # External api
 from .pafy import new
 from .pafy import set_api_key
+from .pafy import set_response_cache
 from .pafy import load_cache, dump_cache
 from .pafy import get_categoryname
 from .pafy import backend
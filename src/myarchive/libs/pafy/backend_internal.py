@@ -6,6 +6,7 @@ import re
 import sys
 import time
 import logging
+import threading
 from xml.etree import ElementTree
 
 if sys.version_info[:2] >= (3, 0):
@@ -28,6 +29,11 @@ from .jsinterp import JSInterpreter
 
 funcmap = {}
 
+# Decipher op lists, loaded from g.sig_cache_file on first use. See
+# _get_sig_spec.
+sigspecs = None
+sigspecs_lock = threading.Lock()
+
 
 class InternPafy(BasePafy):
     def __init__(self, *args, **kwargs):
@@ -90,7 +96,6 @@ class InternPafy(BasePafy):
 
             if not self.age_ver:
                 smaps, js_url, mainfunc = get_js_sm(watchinfo, self.callback)
-                funcmap[js_url] = mainfunc
                 self.sm, self.asm = smaps
                 self.js_url = js_url
                 dashsig = re.search(r"/s/([\w\.]+)", self._dashurl).group(1)
@@ -334,17 +339,99 @@ def _get_mainfunc_from_js(js):
 
 def _decodesig(sig, js_url, callback):
     """  Return decrypted sig given an encrypted sig and js_url key. """
-    # lookup main function in funcmap dict
-    mainfunction = funcmap[js_url]
-
-    # fill in function argument with signature
     callback("Decrypting signature")
-    solved = mainfunction([sig])
+    spec = _get_sig_spec(sig, js_url, callback)
+
+    # the player only ever picks, drops and reorders characters, so the op
+    # list is just the source index of each output character
+    solved = "".join(sig[i] for i in spec)
     dbg("Decrypted sig = %s...", solved[:30])
     callback("Decrypted signature")
     return solved
 
 
+def _get_sig_spec(sig, js_url, callback):
+    """ Return the decipher op list for sigs shaped like sig from js_url.
+
+    The op list depends only on the player version and the lengths of the
+    signature's dot separated parts. It is worked out once by running the
+    player's main function on a probe string of distinct characters, then
+    kept in g.sig_cache_file so later runs never touch the javascript.
+
+    """
+    global sigspecs
+    key = "%s %s" % (_player_id(js_url),
+                     ".".join(str(len(part)) for part in sig.split(".")))
+
+    with sigspecs_lock:
+        if sigspecs is None:
+            sigspecs = _load_sigspecs()
+
+        spec = sigspecs.get(key)
+
+    if spec is None:
+        dbg("No cached decipher ops for %s, interpreting player js", key)
+        mainfunction = funcmap.get(js_url)
+
+        if not mainfunction:
+            mainfunction = _get_mainfunc(js_url, callback)
+
+        probe = "".join(chr(i) for i in range(len(sig)))
+        spec = [ord(c) for c in mainfunction([probe])]
+
+        with sigspecs_lock:
+            sigspecs[key] = spec
+            _save_sigspecs(sigspecs)
+
+    return spec
+
+
+def _player_id(js_url):
+    """ Return the player version part of a js url, or the whole url. """
+    m = re.search(r'player[-_]([\w.-]+?)(?:/|\.js|$)', js_url)
+    return m.group(1) if m else js_url
+
+
+def _load_sigspecs():
+    """ Return the decipher op lists saved in g.sig_cache_file. """
+    try:
+        with open(g.sig_cache_file) as f:
+            return json.load(f)
+
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_sigspecs(specs):
+    """ Write the decipher op lists to g.sig_cache_file, atomically. """
+    try:
+        cachedir = os.path.dirname(g.sig_cache_file)
+
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+
+        temp_filename = g.sig_cache_file + ".temp"
+
+        with open(temp_filename, "w") as f:
+            json.dump(specs, f)
+
+        os.rename(temp_filename, g.sig_cache_file)
+
+    except (IOError, OSError) as e:
+        dbg("Unable to save decipher ops: %s", e)
+
+
+def _get_mainfunc(js_url, callback):
+    """ Fetch player javascript and extract its main signature function. """
+    dbg("Fetching javascript")
+    callback("Fetching javascript")
+    javascript = fetch_cached(js_url, callback, encoding="utf8",
+                              dbg_ref="javascript", file_prefix="js-")
+    mainfunc = _get_mainfunc_from_js(javascript)
+    funcmap[js_url] = mainfunc
+    return mainfunc
+
+
 def fetch_cached(url, callback, encoding=None, dbg_ref="", file_prefix=""):
     """ Fetch url - from tmpdir if already retrieved. """
     tmpdir = os.path.join(tempfile.gettempdir(), "pafy")
@@ -405,11 +492,11 @@ def prune_files(path, prefix="", age_max=3600 * 24 * 14, count_max=4):
 
 
 def get_js_sm(watchinfo, callback):
-    """ Fetch watchinfo page and extract stream map and js funcs if not known.
+    """ Fetch watchinfo page and extract stream map and js funcs if known.
 
     This function is needed by videos with encrypted signatures.
     If the js url referred to in the watchv page is not a key in funcmap,
-    the javascript is fetched and functions extracted.
+    funcs is None; _decodesig fetches the javascript when it needs it.
 
     Returns streammap (list of dicts), js url (str)  and funcs (dict)
 
@@ -421,19 +508,10 @@ def get_js_sm(watchinfo, callback):
     asm = _extract_smap(g.AF, stream_info, False)
     js_url = myjson['assets']['js']
     js_url = "https:" + js_url if js_url.startswith("//") else js_url
+    # the javascript itself is only fetched by _decodesig, and only if the
+    # decipher ops for this player aren't cached yet
     mainfunc = funcmap.get(js_url)
 
-    if not mainfunc:
-        dbg("Fetching javascript")
-        callback("Fetching javascript")
-        javascript = fetch_cached(js_url, callback, encoding="utf8",
-                                  dbg_ref="javascript", file_prefix="js-")
-        mainfunc = _get_mainfunc_from_js(javascript)
-
-    elif mainfunc:
-        dbg("Using functions in memory extracted from %s", js_url)
-        dbg("Mem contains %s js func sets", len(funcmap))
-
     return (sm, asm), js_url, mainfunc
 
 
@@ -1,8 +1,10 @@
 import os
 import re
+import json
 import sys
 import time
 import logging
+import threading
 import subprocess
 
 if sys.version_info[:2] >= (3, 0):
@@ -26,6 +28,15 @@ from .util import xenc
 
 dbg = logging.debug
 
+# Segmented downloads: no segment is smaller than this, reads start small and
+# grow (or shrink) towards taking CHUNK_TARGET_TIME each, and progress is
+# reported at most once per PROGRESS_INTERVAL.
+SEGMENT_MIN_SIZE = 2 ** 20
+CHUNK_MIN_SIZE = 16384
+CHUNK_MAX_SIZE = 2 ** 20
+CHUNK_TARGET_TIME = 0.25
+PROGRESS_INTERVAL = 0.5
+
 
 def extract_video_id(url):
     """ Extract the video id from a url, return video id as str. """
@@ -565,12 +576,19 @@ class BaseStream(object):
             return True
 
     def download(self, filepath="", quiet=False, callback=lambda *x: None,
-                 meta=False, remux_audio=False):
+                 meta=False, remux_audio=False, connections=4, hasher=None):
         """ Download.  Use quiet=True to supress output. Return filename.
 
         Use meta=True to append video id and itag to generated filename
         Use remax_audio=True to remux audio file downloads
 
+        The file is fetched over up to `connections` concurrent Range
+        requests into a preallocated .temp file. Each segment's progress is
+        recorded next to it in a .parts file, so an interrupted download
+        (even a killed one) resumes where every segment left off. Pass a
+        hashlib object as `hasher` to have it fed the file contents, in
+        order, during the download.
+
         """
         # pylint: disable=R0912,R0914
         # Too many branches, too many local vars
@@ -587,6 +605,7 @@ class BaseStream(object):
 
         filepath = os.path.join(savedir, filename)
         temp_filepath = filepath + ".temp"
+        parts_filepath = temp_filepath + ".parts"
 
         status_string = ('  {:,} Bytes [{:.2%}] received. Rate: [{:4.0f} '
                          'KB/s].  ETA: [{:.0f} secs]')
@@ -597,44 +616,86 @@ class BaseStream(object):
 
         response = g.opener.open(self.url)
         total = int(response.info()['Content-Length'].strip())
-        chunksize, bytesdone, t0 = 16384, 0, time.time()
+        accepts_ranges = response.info().get('Accept-Ranges') == 'bytes'
 
-        fmode, offset = "wb", 0
+        offset = 0
+        segments = None
 
-        if os.path.exists(temp_filepath):
-            if os.stat(temp_filepath).st_size < total:
+        if os.path.exists(temp_filepath) and accepts_ranges:
+            segments = _load_segments(parts_filepath, total)
 
+            if segments is None and os.stat(temp_filepath).st_size < total:
+                # partial file without a progress record, which only ever
+                # holds a contiguous prefix; resume after it
                 offset = os.stat(temp_filepath).st_size
-                fmode = "ab"
 
-        outfh = open(temp_filepath, fmode)
+        if segments is None:
+            with open(temp_filepath, "r+b" if offset else "wb") as outfh:
+                _preallocate(outfh, total)
 
-        if offset:
-            # partial file exists, resume download
-            resuming_opener = build_opener()
-            resuming_opener.addheaders = [('User-Agent', g.user_agent),
-                                          ("Range", "bytes=%s-" % offset)]
-            response = resuming_opener.open(self.url)
-            bytesdone = offset
+            # Split whatever is left into segments, one per connection.
+            remaining = total - offset
+            nsegments = max(1, min(connections, remaining // SEGMENT_MIN_SIZE))
+            if not accepts_ranges:
+                nsegments = 1
+            bounds = [offset + remaining * i // nsegments
+                      for i in range(nsegments + 1)]
+            segments = [_Segment(start, end)
+                        for start, end in zip(bounds[:-1], bounds[1:])]
 
-        self._active = True
+        resumed = offset + sum(segment.done for segment in segments)
 
-        while self._active:
-            chunk = response.read(chunksize)
-            outfh.write(chunk)
+        # The first segment of a fresh download reuses the response we
+        # already have open.
+        if resumed:
+            response.close()
+            response = None
+
+        self._active = True
+        threads = []
+        for i, segment in enumerate(segments):
+            if segment.complete:
+                continue
+            thread = threading.Thread(
+                target=self._download_segment,
+                args=(segment, temp_filepath, response if i == 0 else None))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        t0 = time.time()
+        hashed = 0
+        # Unbuffered, as a read-ahead buffer would hold on to bytes from
+        # slots the segments haven't written yet.
+        hashfh = (open(temp_filepath, "rb", buffering=0)
+                  if hasher is not None else None)
+
+        while True:
+            alive = [thread for thread in threads if thread.is_alive()]
+            if alive:
+                alive[0].join(PROGRESS_INTERVAL)
+
+            if any(segment.error for segment in segments):
+                self._active = False
+
+            # Hash whatever has become contiguous since the last pass.
+            if hashfh is not None:
+                hashed = _hash_up_to(
+                    hashfh, hasher, hashed, _contiguous_end(segments, offset))
+
+            _save_segments(parts_filepath, total, segments)
+
+            bytesdone = offset + sum(segment.done for segment in segments)
             elapsed = time.time() - t0
-            bytesdone += len(chunk)
-            if elapsed:
-                rate = ((float(bytesdone) - float(offset)) / 1024.0) / elapsed
+            if elapsed and bytesdone > resumed:
+                rate = ((float(bytesdone) - float(resumed)) / 1024.0) / elapsed
                 eta = (total - bytesdone) / (rate * 1024)
             else: # Avoid ZeroDivisionError
                 rate = 0
                 eta = 0
-            progress_stats = (bytesdone, bytesdone * 1.0 / total, rate, eta)
-
-            if not chunk:
-                outfh.close()
-                break
+            progress_stats = (
+                bytesdone, bytesdone * 1.0 / total if total else 1.0, rate,
+                eta)
 
             if not quiet:
                 status = status_string.format(*progress_stats)
@@ -644,7 +705,13 @@ class BaseStream(object):
             if callback:
                 callback(total, *progress_stats)
 
-        if self._active:
+            if not alive:
+                break
+
+        if hashfh is not None:
+            hashfh.close()
+
+        if self._active and all(segment.complete for segment in segments):
 
             if remux_audio and self.mediatype == "audio":
                 remux(temp_filepath, filepath, quiet=quiet, muxer=remux_audio)
@@ -652,12 +719,171 @@ class BaseStream(object):
             else:
                 os.rename(temp_filepath, filepath)
 
+            if os.path.exists(parts_filepath):
+                os.remove(parts_filepath)
+
             return filepath
 
         else:  # download incomplete, return temp filepath
-            outfh.close()
+            # The .parts file lets a later call resume every segment.
+            _save_segments(parts_filepath, total, segments)
+
+            for segment in segments:
+                if segment.error:
+                    raise segment.error
+
             return temp_filepath
 
+    def _download_segment(self, segment, temp_filepath, response=None):
+        """ Fetch one segment of a download into its slot in temp_filepath. """
+        try:
+            if response is None:
+                ranged_opener = build_opener()
+                ranged_opener.addheaders = [
+                    ('User-Agent', g.user_agent),
+                    ("Range", "bytes=%s-%s" % (
+                        segment.position, segment.end - 1))]
+                response = ranged_opener.open(self.url)
+                if response.getcode() != 206:
+                    raise IOError("Server ignored Range request for %s" % self)
+
+            chunksize = CHUNK_MIN_SIZE
+
+            # Unbuffered, so the hashing pass sees every byte once it's
+            # counted as done.
+            with open(temp_filepath, "r+b", buffering=0) as outfh:
+                outfh.seek(segment.position)
+
+                while self._active and not segment.complete:
+                    t0 = time.time()
+                    chunk = response.read(min(chunksize, segment.remaining))
+
+                    if not chunk:
+                        raise IOError("Connection closed early for %s" % self)
+
+                    outfh.write(chunk)
+                    segment.done += len(chunk)
+
+                    # Aim for reads of about CHUNK_TARGET_TIME each.
+                    elapsed = time.time() - t0
+                    if elapsed < CHUNK_TARGET_TIME / 2:
+                        chunksize = min(chunksize * 2, CHUNK_MAX_SIZE)
+                    elif elapsed > CHUNK_TARGET_TIME * 2:
+                        chunksize = max(chunksize // 2, CHUNK_MIN_SIZE)
+
+        except Exception as e:  # pylint: disable=W0703
+            segment.error = e
+
+        finally:
+            if response is not None:
+                response.close()
+
+
+class _Segment(object):
+
+    """ One byte range [start, end) of a segmented download. """
+
+    def __init__(self, start, end, done=0):
+        self.start = start
+        self.end = end
+        self.done = done
+        self.error = None
+
+    @property
+    def position(self):
+        return self.start + self.done
+
+    @property
+    def remaining(self):
+        return self.end - self.start - self.done
+
+    @property
+    def complete(self):
+        return self.remaining <= 0
+
+
+def _contiguous_end(segments, offset):
+    """ Return the end of the fully downloaded prefix of the file. """
+    end = offset
+
+    for segment in segments:
+        end = segment.start + segment.done
+
+        if not segment.complete:
+            break
+
+    return end
+
+
+def _hash_up_to(fh, hasher, hashed, end):
+    """ Feed hasher the bytes of fh from hashed up to end. Return new mark. """
+    fh.seek(hashed)
+
+    while hashed < end:
+        data = fh.read(min(CHUNK_MAX_SIZE, end - hashed))
+
+        if not data:
+            break
+
+        hasher.update(data)
+        hashed += len(data)
+
+    return hashed
+
+
+def _save_segments(parts_filepath, total, segments):
+    """ Record segment progress, replacing the previous record atomically. """
+    with open(parts_filepath + ".new", "w") as partsfh:
+        json.dump({"total": total,
+                   "segments": [[segment.start, segment.end, segment.done]
+                                for segment in segments]}, partsfh)
+
+    os.replace(parts_filepath + ".new", parts_filepath)
+
+
+def _load_segments(parts_filepath, total):
+    """ Return the segments recorded for a download of total bytes.
+
+    Returns None if there is no usable record.
+
+    """
+    try:
+        with open(parts_filepath) as partsfh:
+            record = json.load(partsfh)
+
+        segments = [_Segment(start, end, done)
+                    for start, end, done in record["segments"]]
+
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    # The segments must tile the whole file.
+    end = 0
+
+    for segment in segments:
+        if (segment.start != end or
+                not 0 <= segment.done <= segment.end - segment.start):
+            return None
+
+        end = segment.end
+
+    if record["total"] != total or end != total:
+        return None
+
+    return segments
+
+
+def _preallocate(fh, size):
+    """ Reserve size bytes for fh, sparsely if nothing better is on hand. """
+    fh.truncate(size)
+
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fh.fileno(), 0, size)
+
+        except OSError:
+            pass
+
 
 def remux(infile, outfile, quiet=False, muxer="ffmpeg"):
     """ Remux audio. """
@@ -1,3 +1,4 @@
+import os
 import sys
 if sys.version_info[:2] >= (3, 0):
     # pylint: disable=E0611,F0401,I0011
@@ -27,6 +28,11 @@ lifespan = 60 * 60 * 5  # 5 hours
 opener = build_opener()
 opener.addheaders = [('User-Agent', user_agent)]
 cache = {}
+# Optional persistent cache for call_gdata, see pafy.set_response_cache.
+response_cache = None
+# Where the internal backend keeps decipher op lists, keyed by player version.
+sig_cache_file = os.path.join(
+    os.path.expanduser("~"), ".cache", "pafy", "sigcache.json")
 def_ydl_opts = {'quiet': True, 'prefer_insecure': True, 'no_warnings': True}
 
 # The following are specific to the internal backend
@@ -190,3 +190,12 @@ def dump_cache():
 def set_api_key(key):
     """Sets the api key to be used with youtube."""
     g.api_key = key
+
+
+def set_response_cache(response_cache):
+    """Sets a persistent cache for gdata responses (None disables it).
+
+    The cache needs lookup(), store() and revalidated() methods; category
+    names fetched through get_categoryname end up in it as well.
+    """
+    g.response_cache = response_cache
@@ -6,9 +6,10 @@ if sys.version_info[:2] >= (3, 0):
     # pylint: disable=E0611,F0401,I0011
     from urllib.error import HTTPError
     from urllib.parse import urlencode
+    from urllib.request import Request
 
 else:
-    from urllib2 import HTTPError
+    from urllib2 import HTTPError, Request
     from urllib import urlencode
 
 from . import g
@@ -25,14 +26,34 @@ class GdataError(Exception):
 
 
 def call_gdata(api, qs):
-    """Make a request to the youtube gdata api."""
+    """Make a request to the youtube gdata api.
+
+    Goes through g.response_cache when one is set: fresh responses are
+    served from it and stale ones are revalidated with their ETag.
+    """
     qs = dict(qs)
-    qs['key'] = g.api_key
-    url = g.urls['gdata'] + api + '?' + urlencode(qs)
+    cached = None
+    if g.response_cache is not None:
+        cached = g.response_cache.lookup('youtube', api, qs)
+        if cached is not None and cached.fresh:
+            return json.loads(cached.body)
+
+    headers = {}
+    if cached is not None:
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+
+    url = g.urls['gdata'] + api + '?' + urlencode(dict(qs, key=g.api_key))
 
     try:
-        data = g.opener.open(url).read().decode('utf-8')
+        response = g.opener.open(Request(url, headers=headers))
+        data = response.read().decode('utf-8')
     except HTTPError as e:
+        if e.getcode() == 304 and cached is not None:
+            g.response_cache.revalidated('youtube', api, qs)
+            return json.loads(cached.body)
         try:
             errdata = e.file.read().decode()
             error = json.loads(errdata)['error']['message']
@@ -41,6 +62,12 @@ def call_gdata(api, qs):
             errmsg = str(e)
         raise GdataError(errmsg)
 
+    if g.response_cache is not None:
+        g.response_cache.store(
+            'youtube', api, qs, data,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'))
+
     return json.loads(data)
 
 
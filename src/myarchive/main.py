@@ -8,18 +8,22 @@
 # @License MIT
 
 import argparse
+import atexit
 import configparser
 import os
 import re
 
 from logging import getLogger
 
+from myarchive.libs import pafy
 from myarchive.libs.myarchive import (
     deviantart, livejournal, shotwell, twitter, youtube)
 
+from myarchive.db.response_cache.response_cache_db import ResponseCacheDB
 from myarchive.db.tag_db.tag_db import TagDB
 from myarchive.db.tag_db.tables.file import TrackedFile
 from myarchive.util.logger import myarchive_LOGGER as logger
+from myarchive.util.workers import WorkerPools
 
 # from gui import Gtk, MainWindow
 
@@ -32,6 +36,10 @@ def check_tf_consistency(db_session, media_storage_path):
     # Grab the md5sum named files already in the media folder.
     file_md5sums = dict()
     for root, dirnames, filenames in os.walk(media_storage_path):
+        # Partial YouTube downloads are staged in here; they aren't ours yet.
+        dirnames[:] = [
+            dirname for dirname in dirnames
+            if dirname != youtube.STAGING_DIRNAME]
         for filename in sorted(filenames):
             full_filepath = os.path.join(root, filename)
             match = re.search(r"^([0-9a-f]{32})\.?.*$", filename)
@@ -80,6 +88,14 @@ def main():
              'from twitter exports can follow this argument. Regardless of '
              'whether any are provided, the API is polled for new tweets '
              'afterwards.')
+    parser.add_argument(
+        '--replay_tweet_archive',
+        type=str,
+        dest="replay_tweet_archive",
+        default=None,
+        help='Rebuilds tweets from the JSON files in tweet_storage_path '
+             'without calling the API. Takes the username to tag archived '
+             'favorites with.')
     parser.add_argument(
         '--import_from_shotwell_db',
         action="store_true",
@@ -122,12 +138,28 @@ def main():
         section="General", option="media_storage_path")
     tweet_storage_path = config.get(
         section="General", option="tweet_storage_path")
+    response_cache_filepath = config.get(
+        section="General", option="response_cache_filepath",
+        fallback=os.path.join(
+            os.path.dirname(database_filepath), "response_cache.sqlite"))
+
+    # Worker pools shared by every importer below. They are closed at the end
+    # of the run, or terminated on the way out if an import blows up. They're
+    # started before anything else so the worker processes are forked from a
+    # process with no other threads or open DB connections.
+    workers = WorkerPools.from_config(config)
+    workers.start()
+    atexit.register(workers.terminate)
 
     # Set up objects used everywhere.
     tag_db = TagDB(
         drivername='sqlite',
         db_name=database_filepath)
     tag_db.session.autocommit = False
+    response_cache = ResponseCacheDB(
+        drivername='sqlite',
+        db_name=response_cache_filepath)
+    pafy.set_response_cache(response_cache)
     os.makedirs(media_storage_path, exist_ok=True)
     os.makedirs(tweet_storage_path, exist_ok=True)
 
@@ -166,7 +198,8 @@ def main():
         tag_db.import_files(
             import_path=args.import_folder,
             media_path=media_storage_path,
-            glob_ignores=folder_import_glob_ignores)
+            glob_ignores=folder_import_glob_ignores,
+            workers=workers)
 
     """
     Shotwell Section
@@ -182,6 +215,7 @@ def main():
             media_storage_path=media_storage_path,
             sw_database_path=sw_db_path,
             sw_media_path=sw_media_path,
+            workers=workers,
         )
 
     """
@@ -193,12 +227,21 @@ def main():
             database=tag_db,
             config=config,
             media_storage_path=media_storage_path,
+            response_cache=response_cache,
+            workers=workers,
         )
 
     """
     Twitter Section
     """
 
+    if args.replay_tweet_archive is not None:
+        twitter.import_tweets_from_archive(
+            database=tag_db,
+            tweet_storage_path=tweet_storage_path,
+            username=args.replay_tweet_archive,
+            workers=workers)
+
     if args.import_from_twitter is not None:
         for csv_filepath in args.import_from_twitter:
             username = None
@@ -212,17 +255,20 @@ def main():
                 username=username,
                 csv_filepath=csv_filepath,
                 media_storage_path=media_storage_path,
+                workers=workers,
             )
         twitter.import_tweets_from_api(
             database=tag_db, config=config,
             tweet_storage_path=tweet_storage_path,
-            media_storage_path=media_storage_path)
+            media_storage_path=media_storage_path,
+            workers=workers)
 
     if args.import_from_youtube:
         youtube_playlist_urls = config.get(
             section="Youtube", option="youtube_playlist_urls").split(",")
         youtube.download_youtube_playlists(
-            tag_db.session, media_storage_path, youtube_playlist_urls)
+            tag_db.session, media_storage_path, youtube_playlist_urls,
+            workers=workers)
 
     """
     LiveJournal Section
@@ -237,6 +283,8 @@ def main():
     # MainWindow(tag_db)
     # Gtk.main()
 
+    workers.close()
+    response_cache.close()
     tag_db.clean_db_and_close()
 
 
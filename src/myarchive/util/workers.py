@@ -0,0 +1,205 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+"""
+Worker pools shared by the importers: a process pool for CPU-bound work
+(hashing, thumbnailing, parsing) and a thread pool for network I/O.
+"""
+
+import logging
+import queue
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+# Get the module logger.
+LOGGER = logging.getLogger(__name__)
+
+CONFIG_SECTION = "Workers"
+DEFAULT_PROCESSES = max(1, cpu_count() - 1)
+DEFAULT_THREADS = 4
+DEFAULT_CHUNK_SIZE = 16
+# How many chunks may be queued or waiting to be consumed before we stop
+# reading input. This is what keeps memory flat on large imports.
+DEFAULT_MAX_PENDING = 8
+
+
+class WorkerPools(object):
+    """
+    Process and thread pools, meant to be created once per run and handed to
+    every importer. Both start on first use unless start() is called first.
+    Work is fed in through the imap methods, which only ever read max_pending
+    chunks ahead of the consumer.
+    """
+
+    def __init__(self, processes=DEFAULT_PROCESSES, threads=DEFAULT_THREADS,
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_pending=DEFAULT_MAX_PENDING):
+        self.processes = max(1, processes)
+        self.threads = max(1, threads)
+        self.chunk_size = max(1, chunk_size)
+        self.max_pending = max(1, max_pending)
+        self._lock = threading.Lock()
+        self._process_pool = None
+        self._thread_pool = None
+
+    @classmethod
+    def from_config(cls, config):
+        """Reads pool settings from the [Workers] section, if there is one."""
+        return cls(
+            processes=config.getint(
+                section=CONFIG_SECTION, option="processes",
+                fallback=DEFAULT_PROCESSES),
+            threads=config.getint(
+                section=CONFIG_SECTION, option="threads",
+                fallback=DEFAULT_THREADS),
+            chunk_size=config.getint(
+                section=CONFIG_SECTION, option="chunk_size",
+                fallback=DEFAULT_CHUNK_SIZE),
+            max_pending=config.getint(
+                section=CONFIG_SECTION, option="max_pending",
+                fallback=DEFAULT_MAX_PENDING),
+        )
+
+    @property
+    def process_pool(self):
+        with self._lock:
+            if self._process_pool is None:
+                LOGGER.debug(
+                    "Starting %s worker processes...", self.processes)
+                self._process_pool = Pool(processes=self.processes)
+            return self._process_pool
+
+    @property
+    def thread_pool(self):
+        with self._lock:
+            if self._thread_pool is None:
+                LOGGER.debug("Starting %s worker threads...", self.threads)
+                self._thread_pool = ThreadPool(processes=self.threads)
+            return self._thread_pool
+
+    def start(self):
+        """
+        Starts both pools now, the process pool first. Forking once threads
+        exist can leave a child holding a lock no thread will ever release,
+        so call this before any other threads are started.
+        Returns (process_pool, thread_pool).
+        """
+        return self.process_pool, self.thread_pool
+
+    def process_imap_unordered(self, func, iterable, chunk_size=None):
+        """
+        Yields func(item) for each item, in completion order, computed in the
+        process pool. func and the items must be picklable.
+        """
+        return self._imap_unordered(
+            pool=self.process_pool, func=func, iterable=iterable,
+            chunk_size=chunk_size or self.chunk_size)
+
+    def thread_imap_unordered(self, func, iterable, chunk_size=1):
+        """
+        Yields func(item) for each item, in completion order, computed in the
+        thread pool. Network calls vary too much in length to be worth
+        chunking, so items go out one at a time by default.
+        """
+        return self._imap_unordered(
+            pool=self.thread_pool, func=func, iterable=iterable,
+            chunk_size=chunk_size)
+
+    def thread_imap(self, func, iterable, lookahead=None):
+        """
+        Yields func(item) for each item, in order, while the thread pool works
+        on up to lookahead (default max_pending) items ahead.
+        """
+        lookahead = lookahead or self.max_pending
+        pending = deque()
+        for item in iterable:
+            pending.append(self.thread_pool.apply_async(func, (item,)))
+            if len(pending) >= lookahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def _imap_unordered(self, pool, func, iterable, chunk_size):
+        """
+        Pool.imap_unordered reads its whole input up front and buffers every
+        result the consumer hasn't got to yet. This only submits another
+        chunk once one of the max_pending in flight has been handed back.
+        """
+        results = queue.Queue()
+        iterator = iter(iterable)
+        pending = 0
+        while True:
+            chunk = list(islice(iterator, chunk_size))
+            if chunk:
+                pool.apply_async(
+                    _run_chunk, (func, chunk),
+                    callback=results.put, error_callback=results.put)
+                pending += 1
+                if pending < self.max_pending:
+                    continue
+            elif pending == 0:
+                return
+            result = results.get()
+            pending -= 1
+            if not isinstance(result, list):
+                raise result
+            yield from result
+
+    def close(self):
+        """Lets queued work finish, then shuts both pools down."""
+        self._shutdown(terminate=False)
+
+    def terminate(self):
+        """Shuts both pools down, dropping any queued work."""
+        self._shutdown(terminate=True)
+
+    def _shutdown(self, terminate):
+        with self._lock:
+            pools = [
+                pool for pool in (self._process_pool, self._thread_pool)
+                if pool is not None]
+            self._process_pool = None
+            self._thread_pool = None
+        for pool in pools:
+            if terminate:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+@contextmanager
+def borrow_workers(workers=None):
+    """
+    Yields workers if given, otherwise a private WorkerPools that is shut down
+    on exit. Lets importers run on their own as well as from main.
+    """
+    if workers is not None:
+        yield workers
+    else:
+        with WorkerPools() as private_workers:
+            yield private_workers
+
+
+def _run_chunk(func, chunk):
+    """Pool worker running func over one chunk of items."""
+    return [func(item) for item in chunk]
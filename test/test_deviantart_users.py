@@ -0,0 +1,79 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+from collections import namedtuple
+
+import pytest
+
+from myarchive.db.tag_db.tag_db import TagDB
+from myarchive.db.tag_db.tables import datables
+from myarchive.db.tag_db.tables.datables import DeviantArtUser, get_da_users
+
+
+FakeUser = namedtuple(
+    "FakeUser",
+    ["userid", "username", "profile", "stats", "details", "usericon"])
+
+
+class FakeDAApi(object):
+
+    def __init__(self, standard_grant_type):
+        self.standard_grant_type = standard_grant_type
+        self.calls = []
+
+    def _user(self, username):
+        return FakeUser(
+            userid=username, username=username, profile=None, stats=None,
+            details=None, usericon=None)
+
+    def get_users(self, usernames):
+        self.calls.append(("get_users", list(usernames)))
+        return [self._user(username) for username in usernames]
+
+    def get_user(self, username):
+        self.calls.append(("get_user", username))
+        return self._user(username)
+
+
+class CountingRateLimiter(object):
+
+    def __init__(self):
+        self.waits = 0
+
+    def wait(self):
+        self.waits += 1
+
+
+@pytest.fixture(autouse=True)
+def empty_username_cache(monkeypatch):
+    monkeypatch.setattr(datables, "EXISTING_USERNAME_CACHE", set())
+
+
+@pytest.mark.parametrize("grant_type, expected_calls", [
+    ("client_credentials",
+     [("get_user", "a"), ("get_user", "b"), ("get_user", "c")]),
+    ("authorization_code", [("get_users", ["a", "b", "c"])]),
+])
+def test_get_da_users(grant_type, expected_calls):
+    tag_db = TagDB()
+    da_api = FakeDAApi(standard_grant_type=grant_type)
+    rate_limiter = CountingRateLimiter()
+    get_da_users(
+        db_session=tag_db.session, da_api=da_api,
+        usernames=["c", "a", "b", "a"], media_storage_path=None,
+        rate_limiter=rate_limiter)
+    assert da_api.calls == expected_calls
+    assert rate_limiter.waits == len(expected_calls)
+    assert sorted(name for (name,) in
+                  tag_db.session.query(DeviantArtUser.name)) == ["a", "b", "c"]
+
+    # Known users aren't looked up again.
+    get_da_users(
+        db_session=tag_db.session, da_api=da_api, usernames=["a", "b"],
+        media_storage_path=None, rate_limiter=rate_limiter)
+    assert da_api.calls == expected_calls
@@ -0,0 +1,93 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+import pytest
+
+from myarchive.db.tag_db.tag_db import TagDB
+from myarchive.db.tag_db.tables import file, tag
+from myarchive.db.tag_db.tables.association_tables import at_file_tag
+from myarchive.db.tag_db.tables.file import TrackedFile
+from myarchive.db.tag_db.tables.tag import Tag
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # Make sure the chunked queries get more than one chunk.
+    monkeypatch.setattr(file, "QUERY_CHUNK_SIZE", 2)
+    monkeypatch.setattr(tag, "QUERY_CHUNK_SIZE", 2)
+
+
+def add_files(db_session, count):
+    tracked_files = [
+        TrackedFile(
+            file_source="test", original_filename="%d.jpg" % index,
+            filepath="/media/%d.jpg" % index, md5sum="%032d" % index)
+        for index in range(count)]
+    db_session.add_all(tracked_files)
+    db_session.flush()
+    return [tracked_file._id for tracked_file in tracked_files]
+
+
+def get_pairs(db_session):
+    return sorted(
+        db_session.query(at_file_tag.c.file_id, at_file_tag.c.tag_id))
+
+
+def test_get_tag_ids():
+    tag_db = TagDB()
+    tag_db.session.add(Tag(name="b"))
+    tag_db.session.flush()
+    existing_id = tag_db.session.query(Tag.tag_id).filter_by(name="b").scalar()
+
+    tag_ids = Tag.get_tag_ids(
+        db_session=tag_db.session, tag_names=["a", "b", "c", "d", "e", "a"])
+    assert sorted(tag_ids) == ["a", "b", "c", "d", "e"]
+    assert tag_ids["b"] == existing_id
+    assert len(set(tag_ids.values())) == 5
+    assert tag_db.session.query(Tag).count() == 5
+    assert Tag.get_tag_ids(db_session=tag_db.session, tag_names=[]) == {}
+    # Asking again adds nothing.
+    assert Tag.get_tag_ids(
+        db_session=tag_db.session, tag_names=["e", "d", "c"]) == dict(
+        (name, tag_ids[name]) for name in "cde")
+    assert tag_db.session.query(Tag).count() == 5
+
+
+def test_attach_tags():
+    tag_db = TagDB()
+    file_ids = add_files(tag_db.session, 5)
+    tag_ids = Tag.get_tag_ids(
+        db_session=tag_db.session, tag_names=["event", "keep"])
+
+    pairs = [(file_id, tag_ids["event"]) for file_id in file_ids]
+    assert TrackedFile.attach_tags(
+        db_session=tag_db.session, file_tag_ids=pairs + pairs[:2]) == \
+        set(pairs)
+    assert TrackedFile.attach_tags(
+        db_session=tag_db.session, file_tag_ids=pairs) == set()
+    keep_pair = (file_ids[0], tag_ids["keep"])
+    TrackedFile.attach_tags(
+        db_session=tag_db.session, file_tag_ids=[keep_pair])
+    assert len(get_pairs(tag_db.session)) == 6
+
+    TrackedFile.detach_tag_pairs(
+        db_session=tag_db.session, file_tag_ids=pairs[:3])
+    assert get_pairs(tag_db.session) == sorted([keep_pair] + pairs[3:])
+
+
+def test_bulk_set_descriptions():
+    tag_db = TagDB()
+    file_ids = add_files(tag_db.session, 3)
+    TrackedFile.bulk_set_descriptions(
+        db_session=tag_db.session, descriptions={
+            file_ids[0]: ("Title", "A comment"), file_ids[2]: (None, "Hi")})
+    tag_db.session.commit()
+    tag_db.session.expire_all()
+    assert [(tracked_file.title, tracked_file.comment) for tracked_file in
+            tag_db.session.query(TrackedFile).order_by(TrackedFile._id)] == [
+        ("Title", "A comment"), (None, None), (None, "Hi")]
@@ -0,0 +1,246 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+from datetime import datetime
+
+import pytest
+
+from myarchive.db.tag_db.tag_db import TagDB
+from myarchive.db.tag_db.tables import LJComment, LJEntry, LJHost, LJUser
+from myarchive.libs.myarchive import livejournal
+
+
+SYNC_TIME = "2017-07-21 00:00:00"
+
+
+class FakeTransport(object):
+    session = None
+
+
+class FakeLJServer(object):
+    """Serves a journal of entries and comments out of dicts."""
+
+    # Entry itemid -> time of its last change
+    entries = dict()
+    # Comment ID -> (entry itemid, parent comment ID, poster ID)
+    comments = dict()
+    # Comment ID -> state, for comments that aren't A(ctive)
+    states = dict()
+
+    # Whether login() manages to set up cookie auth
+    cookie_auth = True
+    generated_sessions = []
+    expired_sessions = []
+    expire_error = None
+
+    def __init__(self, *args, **kwargs):
+        self.transport = FakeTransport()
+
+    def login(self, user, password):
+        if self.cookie_auth:
+            self.transport.session = self.sessiongenerate()
+        return {"userid": 1, "fullname": user}
+
+    def syncitems(self, lastsync):
+        items = [
+            {"item": "L-%d" % itemid, "time": synctime}
+            for itemid, synctime in sorted(self.entries.items())
+            if lastsync is None or synctime > lastsync]
+        return {"count": len(items), "total": len(items), "syncitems": items}
+
+    def getevents_syncitems(self, since):
+        return {"events": [
+            {"itemid": itemid, "eventtime": SYNC_TIME, "subject": "s",
+             "event": "entry %d" % itemid, "props": {}}
+            for itemid, synctime in sorted(self.entries.items())
+            if synctime > since]}
+
+    def sessiongenerate(self):
+        self.generated_sessions.append(
+            "ws:me:%d:cookie" % (len(self.generated_sessions) + 1))
+        return self.generated_sessions[-1]
+
+    def sessionexpire(self, expire):
+        if self.expire_error is not None:
+            raise self.expire_error
+        self.expired_sessions.append(expire)
+
+    def close(self):
+        pass
+
+    def fetch_comment_meta(self, startid, session):
+        return {
+            "maxid": str(max(self.comments)),
+            "comments": dict(
+                (str(comment_id),
+                 (str(poster_id), self.states.get(comment_id, "A")))
+                for comment_id, (_, _, poster_id) in self.comments.items()
+                if comment_id > int(startid)),
+            "usermaps": dict(
+                (str(poster_id), "user%d" % poster_id)
+                for _, _, poster_id in self.comments.values()),
+        }
+
+    def iter_comment_bodies(self, startid, session):
+        for comment_id in sorted(self.comments):
+            if comment_id <= int(startid):
+                continue
+            jitemid, parentid, posterid = self.comments[comment_id]
+            yield str(comment_id), {
+                "jitemid": str(jitemid), "parentid": str(parentid),
+                "posterid": str(posterid), "subject": "",
+                "body": "comment %d" % comment_id,
+                "date": "2017-07-21T00:00:00Z",
+                "state": self.states.get(comment_id, "A")}
+
+
+@pytest.fixture
+def lj_server(monkeypatch):
+    monkeypatch.setattr(livejournal.lj, "LJServer", FakeLJServer)
+    monkeypatch.setattr(FakeLJServer, "entries", dict(
+        (itemid, SYNC_TIME) for itemid in range(1, 11)))
+    monkeypatch.setattr(FakeLJServer, "comments", dict(
+        (comment_id, (comment_id % 10 + 1, comment_id - 1 if comment_id % 3
+                      else 0, comment_id % 4 + 2))
+        for comment_id in range(1, 31)))
+    monkeypatch.setattr(FakeLJServer, "generated_sessions", [])
+    monkeypatch.setattr(FakeLJServer, "expired_sessions", [])
+    monkeypatch.setattr(FakeLJServer, "states", {7: "S"})
+    # Comments 12 and 20 are on an entry the sync doesn't see.
+    FakeLJServer.comments[12] = (99, 0, 2)
+    FakeLJServer.comments[20] = (99, 0, 2)
+    return FakeLJServer
+
+
+def sync(tag_db):
+    connection = livejournal.LJAPIConnection(
+        db_session=tag_db.session, host="https://lj.example/",
+        user_agent="test", username="me", password="secret")
+    connection.download_journals_and_comments(db_session=tag_db.session)
+    return tag_db.session.query(LJUser).filter_by(user_id=1).one()
+
+
+def get_comment(tag_db, itemid):
+    return tag_db.session.query(LJComment).filter_by(itemid=itemid).one()
+
+
+def test_sync_comments(lj_server):
+    tag_db = TagDB()
+    poster = sync(tag_db)
+    stored_itemids = sorted(
+        itemid for (itemid,) in tag_db.session.query(LJComment.itemid))
+    assert stored_itemids == [
+        itemid for itemid in range(1, 31) if itemid not in (12, 20)]
+    # Comments on entries we don't have are skipped, not fetched again.
+    assert poster.last_comment == "30"
+    assert poster.last_comment_meta is not None
+    assert tag_db.session.query(LJComment).filter(
+        LJComment.user_id.is_(None)).count() == 0
+    comment = get_comment(tag_db, 5)
+    assert comment.parent_comment.itemid == 4
+    assert comment.lj_user.username == "user3"
+    assert comment.state == "A"
+    assert get_comment(tag_db, 7).state == "S"
+
+    # Metadata of comments we already have is only read again monthly.
+    lj_server.comments[5] = (6, 4, 9)
+    lj_server.states[7] = "D"
+    lj_server.comments[31] = (1, 0, 2)
+    poster = sync(tag_db)
+    assert tag_db.session.query(LJComment).count() == 29
+    assert poster.last_comment == "31"
+    assert get_comment(tag_db, 5).lj_user.username == "user3"
+    assert get_comment(tag_db, 7).state == "S"
+
+    poster.last_comment_meta = "2017-07-21 00:00:00"
+    tag_db.session.commit()
+    poster = sync(tag_db)
+    tag_db.session.expire_all()
+    assert get_comment(tag_db, 5).lj_user.username == "user9"
+    assert get_comment(tag_db, 7).state == "D"
+    assert get_comment(tag_db, 31).state == "A"
+    assert poster.last_comment_meta > "2017-07-21 00:00:00"
+
+
+def test_sync_comments_sessions(lj_server, monkeypatch, caplog):
+    # The cookie auth session from login() is used as is.
+    tag_db = TagDB()
+    sync(tag_db)
+    assert lj_server.generated_sessions == ["ws:me:1:cookie"]
+    assert lj_server.expired_sessions == []
+
+    # Without one, a session is generated and expired by its id.
+    monkeypatch.setattr(lj_server, "cookie_auth", False)
+    lj_server.comments[31] = (1, 0, 2)
+    sync(tag_db)
+    assert lj_server.generated_sessions == [
+        "ws:me:1:cookie", "ws:me:2:cookie"]
+    assert lj_server.expired_sessions == [["2"]]
+
+    # Failing to expire it doesn't lose the comments.
+    monkeypatch.setattr(
+        lj_server, "expire_error", livejournal.lj.LJException("Timed out"))
+    lj_server.comments[32] = (1, 0, 2)
+    poster = sync(tag_db)
+    assert poster.last_comment == "32"
+    assert tag_db.session.query(LJComment).count() == 30
+    assert "Unable to expire LJ session: Timed out" in caplog.text
+
+
+def make_entry(itemid, synctime, tag_names):
+    return {
+        "itemid": itemid, "eventtime": datetime(2017, 7, 21),
+        "subject": "subject %d" % itemid, "text": "entry %d" % itemid,
+        "current_music": None, "synctime": synctime, "tag_names": tag_names}
+
+
+def test_bulk_upsert():
+    tag_db = TagDB()
+    lj_host = LJHost(url="https://lj.example/")
+    lj_user = LJUser(user_id=1, username="me")
+    lj_user.host = lj_host
+    tag_db.session.add(lj_user)
+    tag_db.session.flush()
+    other_user = LJUser(user_id=2, username="other")
+    other_user.host = lj_host
+    tag_db.session.add(other_user)
+    tag_db.session.flush()
+
+    assert LJEntry.bulk_upsert(
+        db_session=tag_db.session, lj_user=lj_user, entries=[
+            make_entry(1, SYNC_TIME, ["cats"]),
+            make_entry(2, SYNC_TIME, ["cats", "dogs", "cats"]),
+            make_entry(3, None, [])]) == (3, 0)
+    # The same itemid from another journal is a different entry.
+    assert LJEntry.bulk_upsert(
+        db_session=tag_db.session, lj_user=other_user,
+        entries=[make_entry(1, SYNC_TIME, ["birds"])]) == (1, 0)
+    tag_db.session.commit()
+    assert tag_db.session.query(LJEntry).count() == 4
+
+    later = "2017-07-22 00:00:00"
+    edited_entry = make_entry(2, later, ["dogs", "frogs"])
+    edited_entry["text"] = "edited"
+    # 1 is unchanged, 2 was edited, 3 was never synced before, 4 is new.
+    assert LJEntry.bulk_upsert(
+        db_session=tag_db.session, lj_user=lj_user, entries=[
+            make_entry(1, SYNC_TIME, ["ignored"]), edited_entry,
+            make_entry(3, later, ["fish"]),
+            make_entry(4, later, [])]) == (1, 2)
+    tag_db.session.commit()
+    tag_db.session.expire_all()
+    entries = dict(
+        (entry.itemid, entry) for entry in
+        tag_db.session.query(LJEntry).filter_by(user_id=lj_user.id))
+    assert sorted(entries) == [1, 2, 3, 4]
+    assert entries[2].text == "edited"
+    assert entries[2].synctime == later
+    assert dict(
+        (itemid, sorted(tag.name for tag in entry.tags))
+        for itemid, entry in entries.items()) == {
+        1: ["cats"], 2: ["dogs", "frogs"], 3: ["fish"], 4: []}
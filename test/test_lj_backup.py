@@ -0,0 +1,164 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+from myarchive.libs.livejournal.backup import (
+    DEFAULT_JOURNAL, get_meta_since, iter_bodies_since,
+    update_journal_entries)
+
+
+class FakeCommentServer(object):
+    """Pages through comments 1 to max_comment_id like the LJ export does."""
+
+    def __init__(self, max_comment_id, page_size=1000, missing_ids=()):
+        self.max_comment_id = max_comment_id
+        self.page_size = page_size
+        self.missing_ids = set(missing_ids)
+        self.calls = 0
+
+    def _page(self, startid):
+        self.calls += 1
+        first_id = int(startid) + 1
+        last_id = min(int(startid) + self.page_size, self.max_comment_id)
+        return [
+            comment_id for comment_id in range(first_id, last_id + 1)
+            if comment_id not in self.missing_ids]
+
+    def fetch_comment_meta(self, startid, session):
+        return {
+            'maxid': str(self.max_comment_id),
+            'comments': dict(
+                (str(comment_id), (str(comment_id % 7), 'A'))
+                for comment_id in self._page(startid)),
+            'usermaps': dict(
+                (str(user_id), 'user%d' % user_id) for user_id in range(7)),
+        }
+
+    def iter_comment_bodies(self, startid, session):
+        for comment_id in self._page(startid):
+            yield str(comment_id), {'body': 'comment %d' % comment_id}
+
+
+def test_get_meta_since_compares_ids_as_numbers():
+    server = FakeCommentServer(max_comment_id=12345)
+    meta = get_meta_since('99', server, 'session')
+    assert meta['maxid'] == '12345'
+    assert sorted(int(comment_id) for comment_id in meta['comments']) == \
+        list(range(100, 12346))
+    assert len(meta['usermaps']) == 7
+
+
+def test_get_meta_since_up_to_date():
+    server = FakeCommentServer(max_comment_id=50)
+    meta = get_meta_since('50', server, 'session')
+    assert meta['comments'] == {}
+    assert server.calls == 1
+
+
+def test_get_meta_since_stops_without_progress():
+    # The server claims more comments than it will hand out.
+    server = FakeCommentServer(max_comment_id=500, missing_ids=range(1, 501))
+    meta = get_meta_since('0', server, 'session')
+    assert meta['comments'] == {}
+    assert server.calls == 1
+
+
+def test_iter_bodies_since_yields_in_id_order():
+    server = FakeCommentServer(max_comment_id=2500, missing_ids=[1001, 2000])
+    comment_ids = [
+        int(comment_id) for comment_id, _ in
+        iter_bodies_since('10', '2500', server, 'session')]
+    assert comment_ids == [
+        comment_id for comment_id in range(11, 2501)
+        if comment_id not in (1001, 2000)]
+    assert server.calls == 3
+
+
+def test_iter_bodies_since_stops_without_progress():
+    server = FakeCommentServer(max_comment_id=100, missing_ids=range(51, 101))
+    comment_ids = [
+        int(comment_id) for comment_id, _ in
+        iter_bodies_since('0', '100', server, 'session')]
+    assert comment_ids == list(range(1, 51))
+    assert server.calls == 2
+
+
+class FakeEntryServer(object):
+    """
+    Serves syncitems and getevents_syncitems for entries keyed by itemid,
+    each with the time of its last change. Like LJ, getevents_syncitems
+    returns at most window_size entries changed after a time, oldest first,
+    so windows overlap wherever several entries share a time.
+    """
+
+    def __init__(self, synctimes, deleted_itemids=(), window_size=100,
+                 syncitems_page_size=500):
+        self.synctimes = synctimes
+        self.deleted_itemids = set(deleted_itemids)
+        self.window_size = window_size
+        self.syncitems_page_size = syncitems_page_size
+        self.getevents_calls = 0
+
+    def _sorted_items(self):
+        return sorted(self.synctimes.items(), key=lambda item: item[::-1])
+
+    def syncitems(self, lastsync):
+        items = [
+            {'item': 'L-%d' % itemid, 'time': synctime}
+            for itemid, synctime in self._sorted_items()
+            if lastsync is None or synctime > lastsync]
+        return {
+            'count': min(len(items), self.syncitems_page_size),
+            'total': len(items),
+            'syncitems': items[:self.syncitems_page_size]}
+
+    def getevents_syncitems(self, since):
+        self.getevents_calls += 1
+        return {'events': [
+            {'itemid': itemid, 'event': 'entry %d' % itemid}
+            for itemid, synctime in self._sorted_items()
+            if synctime > since and itemid not in self.deleted_itemids
+        ][:self.window_size]}
+
+
+def new_journal():
+    journal = dict(DEFAULT_JOURNAL)
+    journal['entries'] = {}
+    journal['entry_synctimes'] = {}
+    return journal
+
+
+def test_update_journal_entries_overlapping_windows():
+    # 50 entries per second, so every window overlaps the next.
+    synctimes = dict(
+        (itemid, "2017-07-21 00:%02d:%02d" % divmod((itemid - 1) // 50, 60))
+        for itemid in range(1, 1001))
+    server = FakeEntryServer(synctimes)
+    journal = new_journal()
+    assert update_journal_entries(server, journal) == 1000
+    assert sorted(journal['entries']) == list(range(1, 1001))
+    assert journal['entry_synctimes'] == synctimes
+    assert journal['last_entry'] == synctimes[1000]
+    # Windows of 100 that overlap by a second still move 100 entries on.
+    assert server.getevents_calls == 10
+
+    # Only entries changed since are fetched next time.
+    synctimes[7] = "2017-07-22 00:00:00"
+    assert update_journal_entries(server, journal) == 1
+    assert server.getevents_calls == 11
+
+
+def test_update_journal_entries_drops_missing_itemid():
+    synctimes = dict(
+        (itemid, "2017-07-21 00:00:%02d" % (itemid % 60))
+        for itemid in range(1, 301))
+    # Listed by syncitems, but deleted before its events were fetched.
+    server = FakeEntryServer(synctimes, deleted_itemids=[150])
+    journal = new_journal()
+    assert update_journal_entries(server, journal) == 300
+    assert sorted(journal['entries']) == [
+        itemid for itemid in range(1, 301) if itemid != 150]
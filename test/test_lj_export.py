@@ -0,0 +1,143 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+import gzip
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from myarchive.libs.livejournal.lj import LJException, LJServer
+
+
+NUM_COMMENTS = 2000
+
+
+def comment_meta_xml(startid):
+    comments = "".join(
+        "<comment id='%d' posterid='%d'%s/>" % (
+            comment_id, comment_id % 3,
+            " state='D'" if comment_id % 10 == 0 else "")
+        for comment_id in range(startid + 1, NUM_COMMENTS + 1))
+    return (
+        "<?xml version='1.0' encoding='utf-8'?><livejournal>"
+        "<maxid>%d</maxid><comments>%s</comments><usermaps>"
+        "<usermap id='1' user='alice'/><usermap id='2' user='bob'/>"
+        "</usermaps></livejournal>" % (NUM_COMMENTS, comments))
+
+
+def comment_body_xml(startid):
+    comments = "".join(
+        "<comment id='%d' jitemid='%d' posterid='1' parentid='0'>"
+        "<subject>re: %d</subject><body>comment &amp; %d</body>"
+        "<date>2004-03-16T19:19:16Z</date></comment>" % (
+            comment_id, comment_id // 10, comment_id, comment_id)
+        for comment_id in range(startid + 1, NUM_COMMENTS + 1))
+    return (
+        "<?xml version='1.0' encoding='utf-8'?><livejournal><comments>%s"
+        "</comments></livejournal>" % comments)
+
+
+class ExportHandler(BaseHTTPRequestHandler):
+    """Serves export_comments.bml gzipped, over keep-alive connections."""
+
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    cookies = []
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        type(self).connections += 1
+
+    def do_GET(self):
+        self.cookies.append(self.headers.get("Cookie"))
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        if parts.path != "/export_comments.bml":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        startid = int(query["startid"][0])
+        if query["get"][0] == "comment_meta":
+            body = comment_meta_xml(startid)
+        else:
+            body = comment_body_xml(startid)
+        data = gzip.compress(body.encode("utf-8"))
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def lj_server(monkeypatch):
+    monkeypatch.setattr(ExportHandler, "connections", 0)
+    monkeypatch.setattr(ExportHandler, "cookies", [])
+    server = ThreadingServer(("127.0.0.1", 0), ExportHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    client = LJServer(
+        "Python-PyLJ/test", "test",
+        host="http://127.0.0.1:%s/" % server.server_port)
+    yield client
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_comment_meta(lj_server):
+    meta = lj_server.fetch_comment_meta(startid=1000, session="v1:u1:s1:x")
+    assert meta["maxid"] == str(NUM_COMMENTS)
+    assert len(meta["comments"]) == 1000
+    assert meta["comments"]["1001"] == ("2", "A")
+    assert meta["comments"]["1010"] == ("2", "D")
+    assert meta["usermaps"] == {"1": "alice", "2": "bob"}
+    assert ExportHandler.cookies == ["ljsession=v1:u1:s1:x"]
+
+
+def test_iter_comment_bodies(lj_server):
+    comments = list(lj_server.iter_comment_bodies(startid=0, session="s"))
+    assert [int(comment_id) for comment_id, _ in comments] == \
+        list(range(1, NUM_COMMENTS + 1))
+    assert comments[41][1] == {
+        "posterid": "1", "state": "A", "jitemid": "4", "parentid": "0",
+        "body": "comment & 42", "subject": "re: 42",
+        "date": "2004-03-16T19:19:16Z"}
+    assert lj_server.fetch_comment_bodies(startid=1990, session="s") == \
+        dict(comments[1990:])
+    # Both requests went over the one connection.
+    assert ExportHandler.connections == 1
+
+
+def test_abandoned_export_drops_connection(lj_server):
+    comments = lj_server.iter_comment_bodies(startid=0, session="s")
+    next(comments)
+    comments.close()
+    # The unread rest of the body can't be reused, so this reconnects.
+    assert len(lj_server.fetch_comment_bodies(startid=1999, session="s")) \
+        == 1
+    assert ExportHandler.connections == 2
+
+
+def test_export_http_error(lj_server):
+    lj_server.host = lj_server.host + "missing/"
+    with pytest.raises(LJException):
+        lj_server.fetch_comment_meta(session="s")
@@ -0,0 +1,32 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+
+import hashlib
+import os
+
+from myarchive.db.tag_db.tag_db import TagDB
+from myarchive.db.tag_db.tables.file import TrackedFile
+from myarchive.libs.myarchive import youtube
+from myarchive.main import check_tf_consistency
+
+
+def test_check_tf_consistency_skips_staging(tmpdir, caplog):
+    md5sum = hashlib.md5(b"video").hexdigest()
+    tmpdir.join("%s.mp4" % md5sum).write(b"video")
+    tmpdir.join("notes.txt").write(b"notes")
+    staging_dir = tmpdir.mkdir(youtube.STAGING_DIRNAME)
+    staging_dir.join("%s.mp4.temp" % ("0" * 32)).write(b"part")
+
+    tag_db = TagDB()
+    check_tf_consistency(
+        db_session=tag_db.session, media_storage_path=str(tmpdir))
+    assert [tracked_file.md5sum for tracked_file in
+            tag_db.session.query(TrackedFile)] == [md5sum]
+    assert os.path.join(str(tmpdir), "notes.txt") in caplog.text
+    assert youtube.STAGING_DIRNAME not in caplog.text
@@ -0,0 +1,142 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+import hashlib
+import io
+import os
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from myarchive.libs.pafy import backend_shared
+from myarchive.libs.pafy.backend_shared import (
+    BaseStream, _Segment, _contiguous_end, _hash_up_to, _load_segments,
+    _save_segments)
+
+
+CONTENT = os.urandom(5 * 2 ** 20 + 12345)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves CONTENT, honouring single Range requests."""
+
+    requested_ranges = []
+
+    def do_GET(self):
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match:
+            start, end = int(match.group(1)), int(match.group(2)) + 1
+            self.requested_ranges.append((start, end))
+            self.send_response(206)
+        else:
+            start, end = 0, len(CONTENT)
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        try:
+            self.wfile.write(CONTENT[start:end])
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    monkeypatch.setattr(RangeHandler, "requested_ranges", [])
+    server = ThreadingServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    media_stream = BaseStream.__new__(BaseStream)
+    media_stream._url = "http://127.0.0.1:%s/video" % server.server_port
+    media_stream._active = False
+    yield media_stream
+    server.shutdown()
+    server.server_close()
+
+
+def test_contiguous_end():
+    segments = [_Segment(0, 10, 10), _Segment(10, 20, 4), _Segment(20, 30, 10)]
+    assert _contiguous_end(segments, 0) == 14
+    segments[1].done = 10
+    assert _contiguous_end(segments, 0) == 30
+    assert _contiguous_end([_Segment(5, 10, 0)], 5) == 5
+
+
+def test_hash_up_to():
+    data = os.urandom(3 * backend_shared.CHUNK_MAX_SIZE + 7)
+    hasher = hashlib.md5()
+    fh = io.BytesIO(data)
+    hashed = _hash_up_to(fh, hasher, 0, 100)
+    hashed = _hash_up_to(fh, hasher, hashed, hashed)
+    hashed = _hash_up_to(fh, hasher, hashed, len(data) + 50)
+    assert hashed == len(data)
+    assert hasher.hexdigest() == hashlib.md5(data).hexdigest()
+
+
+def test_segment_records(tmpdir):
+    parts_filepath = str(tmpdir.join("video.temp.parts"))
+    assert _load_segments(parts_filepath, 30) is None
+    _save_segments(parts_filepath, 30, [_Segment(0, 10, 3), _Segment(10, 30)])
+    segments = _load_segments(parts_filepath, 30)
+    assert [(segment.start, segment.end, segment.done)
+            for segment in segments] == [(0, 10, 3), (10, 30, 0)]
+    # Records for a different file size, or with gaps, are ignored.
+    assert _load_segments(parts_filepath, 31) is None
+    _save_segments(parts_filepath, 30, [_Segment(0, 10), _Segment(12, 30)])
+    assert _load_segments(parts_filepath, 30) is None
+
+
+def test_download(stream, tmpdir):
+    filepath = str(tmpdir.join("video.mp4"))
+    hasher = hashlib.md5()
+    assert stream.download(
+        filepath=filepath, quiet=True, hasher=hasher) == filepath
+    with open(filepath, "rb") as fh:
+        assert fh.read() == CONTENT
+    assert hasher.hexdigest() == hashlib.md5(CONTENT).hexdigest()
+    assert not os.path.exists(filepath + ".temp.parts")
+    # The first segment reuses the initial response.
+    assert len(RangeHandler.requested_ranges) == 3
+
+
+def test_download_resumes_killed_download(stream, tmpdir):
+    # What a killed download leaves: a preallocated .temp with holes, and
+    # the last recorded progress of each segment.
+    filepath = str(tmpdir.join("video.mp4"))
+    quarter = len(CONTENT) // 4
+    segments = [
+        _Segment(0, quarter, 1000),
+        _Segment(quarter, 2 * quarter, quarter),
+        _Segment(2 * quarter, len(CONTENT), 0)]
+    temp_content = bytearray(len(CONTENT))
+    for segment in segments:
+        temp_content[segment.start:segment.position] = \
+            CONTENT[segment.start:segment.position]
+    with open(filepath + ".temp", "wb") as fh:
+        fh.write(temp_content)
+    _save_segments(filepath + ".temp.parts", len(CONTENT), segments)
+
+    hasher = hashlib.md5()
+    stream.download(filepath=filepath, quiet=True, hasher=hasher)
+    with open(filepath, "rb") as fh:
+        assert fh.read() == CONTENT
+    assert hasher.hexdigest() == hashlib.md5(CONTENT).hexdigest()
+    assert sorted(RangeHandler.requested_ranges) == [
+        (1000, quarter), (2 * quarter, len(CONTENT))]
@@ -0,0 +1,89 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+import pytest
+
+from myarchive.db.response_cache import response_cache_db
+from myarchive.db.response_cache.response_cache_db import (
+    DAY, STALE_GRACE_PERIOD, ResponseCacheDB)
+from myarchive.db.response_cache.tables import CachedResponse
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1500000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(response_cache_db.time, "time", fake_clock.time)
+    return fake_clock
+
+
+def test_ttl_for_picks_longest_prefix():
+    cache = ResponseCacheDB()
+    assert cache.ttl_for("deviantart", "/gallery/folders") == DAY
+    assert cache.ttl_for("deviantart", "/gallery/0F1E2D3C") == 60 * 60
+    assert cache.ttl_for("deviantart", "/collections/folders") == DAY
+    assert cache.ttl_for("deviantart", "/collections/0F1E2D3C") == 60 * 60
+    assert cache.ttl_for("deviantart", "/deviation/download/1") is None
+    assert cache.ttl_for("nothing", "/gallery/folders") is None
+
+
+def test_lookup_fresh_and_stale(clock):
+    cache = ResponseCacheDB()
+    params = [{"username": "someone"}, {}]
+    assert cache.lookup("deviantart", "/gallery/folders", params) is None
+    cache.store("deviantart", "/gallery/folders", params, '{"a": 1}',
+                etag='"abc"')
+    cached = cache.lookup("deviantart", "/gallery/folders", params)
+    assert cached.body == '{"a": 1}' and cached.etag == '"abc"'
+    assert cached.fresh
+
+    clock.now += DAY + 1
+    assert not cache.lookup("deviantart", "/gallery/folders", params).fresh
+    cache.revalidated("deviantart", "/gallery/folders", params)
+    assert cache.lookup("deviantart", "/gallery/folders", params).fresh
+
+
+def test_uncached_endpoints_are_not_stored():
+    cache = ResponseCacheDB()
+    cache.store("deviantart", "/deviation/download/1", [{}, {}], "{}")
+    assert cache.session.query(CachedResponse).count() == 0
+
+
+def test_evict_expired_per_prefix(clock):
+    cache = ResponseCacheDB()
+    cache.store("deviantart", "/gallery/folders", [{}, {}], "{}")
+    cache.store("deviantart", "/gallery/0F1E2D3C", [{}, {}], "{}")
+    # Past the page TTL plus grace, but not the folder list's.
+    clock.now += 60 * 60 + STALE_GRACE_PERIOD + 1
+    cache.evict()
+    assert [endpoint for (endpoint,) in
+            cache.session.query(CachedResponse.endpoint)] == \
+        ["/gallery/folders"]
+
+
+def test_evict_least_recently_used(clock):
+    cache = ResponseCacheDB(max_entries=2)
+    for index in range(3):
+        cache.store("deviantart", "/user/profile/%d" % index, [{}, {}], "{}")
+        clock.now += 1
+    # Hits are batched, so this only reaches the DB when evict flushes it.
+    cache.lookup("deviantart", "/user/profile/0", [{}, {}])
+    assert cache._touched_keys
+    cache.evict()
+    assert not cache._touched_keys
+    assert sorted(endpoint for (endpoint,) in
+                  cache.session.query(CachedResponse.endpoint)) == \
+        ["/user/profile/0", "/user/profile/2"]
@@ -0,0 +1,342 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+import hashlib
+import os
+import sqlite3
+
+import pytest
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import URL
+
+from myarchive.db import db
+from myarchive.db.shotwell.tables import Base as ShotwellBase
+from myarchive.db.tag_db.tag_db import TagDB
+from myarchive.db.tag_db.tables.file import TrackedFile
+from myarchive.db.tag_db.tables.shotwelltables import ShotwellSyncedMedia
+from myarchive.db.tag_db.tables.tag import Tag
+from myarchive.libs.myarchive.shotwell import (
+    SOURCE_ID_REGEX, import_from_shotwell_db)
+from myarchive.util.workers import WorkerPools
+
+
+class ShotwellLibrary(object):
+    """A Shotwell photo.db and its files, built up row by row."""
+
+    def __init__(self, path):
+        self.path = path
+        self.db_path = os.path.join(path, "photo.db")
+        ShotwellBase.metadata.create_all(
+            create_engine("sqlite:///" + self.db_path),
+            tables=[
+                table for name, table in ShotwellBase.metadata.tables.items()
+                if name != "sqlite_stat1"])
+        self.connection = sqlite3.connect(self.db_path)
+
+    def write_file(self, filename, data):
+        filepath = os.path.join(self.path, filename)
+        with open(filepath, "wb") as fptr:
+            fptr.write(data)
+        file_stat = os.stat(filepath)
+        return filepath, file_stat.st_size, int(file_stat.st_mtime)
+
+    def add_media(self, table, row_id, data, md5=True, **columns):
+        filepath, filesize, timestamp = self.write_file(
+            "%s%d.jpg" % (table, row_id), data)
+        if md5 is True:
+            md5 = hashlib.md5(data).hexdigest()
+        columns.update(
+            id=row_id, filename=filepath, filesize=filesize,
+            timestamp=timestamp, md5=md5)
+        self.insert(table, **columns)
+        return filepath
+
+    def add_photo(self, row_id, data, **columns):
+        return self.add_media("PhotoTable", row_id, data, **columns)
+
+    def add_video(self, row_id, data, **columns):
+        return self.add_media("VideoTable", row_id, data, **columns)
+
+    def add_tag(self, name, source_ids):
+        self.insert(
+            "TagTable", name=name, photo_id_list="".join(
+                source_id + "," for source_id in source_ids))
+
+    def insert(self, table, **columns):
+        self.connection.execute(
+            "INSERT INTO %s (%s) VALUES (%s)" % (
+                table, ", ".join(columns), ", ".join("?" * len(columns))),
+            list(columns.values()))
+        self.connection.commit()
+
+    def execute(self, statement, *params):
+        self.connection.execute(statement, params)
+        self.connection.commit()
+
+
+@pytest.fixture(autouse=True)
+def sqlalchemy_url(monkeypatch):
+    # DB builds its URL with URL(), which SQLAlchemy 1.4 and up only allow
+    # through URL.create().
+    monkeypatch.setattr(db, "SQLAlchemyURL", getattr(URL, "create", URL))
+
+
+@pytest.fixture
+def library(tmpdir):
+    sw_library = ShotwellLibrary(str(tmpdir.mkdir("shotwell")))
+    yield sw_library
+    sw_library.connection.close()
+
+
+@pytest.fixture
+def media_path(tmpdir):
+    return str(tmpdir.mkdir("media"))
+
+
+@pytest.fixture
+def workers():
+    with WorkerPools(processes=2, threads=1, chunk_size=2) as worker_pools:
+        yield worker_pools
+
+
+def run_import(tag_db, library, media_path, workers):
+    import_from_shotwell_db(
+        tag_db=tag_db, media_storage_path=media_path,
+        sw_database_path=library.db_path, sw_media_path=library.path,
+        workers=workers)
+
+
+def get_tags_by_filename(tag_db):
+    return dict(
+        (tracked_file.original_filename,
+         sorted(tag.name for tag in tracked_file.tags))
+        for tracked_file in tag_db.session.query(TrackedFile))
+
+
+def test_source_id_regex():
+    photo_id_list = (
+        "thumb000000000000000a,video-00000000000000FF,,thumb12,"
+        "event1,thumb0000000000000100")
+    assert SOURCE_ID_REGEX.findall(photo_id_list) == [
+        "thumb000000000000000a", "video-00000000000000FF",
+        "thumb0000000000000100"]
+    assert SOURCE_ID_REGEX.findall("") == []
+
+
+def test_import_tags(library, media_path, workers):
+    library.add_photo(10, b"ten")
+    library.add_photo(11, b"eleven")
+    library.add_video(255, b"video")
+    library.add_tag(
+        "cats", ["thumb000000000000000a", "video-00000000000000FF"])
+    library.add_tag("dogs", ["thumb000000000000000A", "thumb000000000000000b"])
+    # Rows that were deleted from Shotwell linger in tag lists.
+    library.add_tag("fish", ["thumb00000000000000ff"])
+
+    tag_db = TagDB()
+    run_import(tag_db, library, media_path, workers)
+    assert get_tags_by_filename(tag_db) == {
+        "PhotoTable10.jpg": ["cats", "dogs", "shotwell"],
+        "PhotoTable11.jpg": ["dogs", "shotwell"],
+        "VideoTable255.jpg": ["cats", "shotwell"],
+    }
+
+    # Tags taken off in Shotwell come off here too; our own tags stay.
+    tracked_file = tag_db.session.query(TrackedFile).filter_by(
+        original_filename="PhotoTable11.jpg").one()
+    tracked_file.tags.append(Tag(name="mine"))
+    tag_db.session.commit()
+    library.execute(
+        "UPDATE TagTable SET photo_id_list = ? WHERE name = ?",
+        "thumb000000000000000a,", "dogs")
+    run_import(tag_db, library, media_path, workers)
+    tag_db.session.expire_all()
+    assert get_tags_by_filename(tag_db) == {
+        "PhotoTable10.jpg": ["cats", "dogs", "shotwell"],
+        "PhotoTable11.jpg": ["mine", "shotwell"],
+        "VideoTable255.jpg": ["cats", "shotwell"],
+    }
+
+
+def test_import_keeps_tags_it_did_not_apply(library, media_path, workers):
+    tag_db = TagDB()
+    # Another import already tagged this file before Shotwell did.
+    other_file, _ = TrackedFile.add_file(
+        db_session=tag_db.session, media_path=media_path,
+        file_source="twitter",
+        copy_from_filepath=library.write_file("PhotoTable12.jpg", b"12")[0])
+    other_file.tags.append(Tag(name="dogs"))
+    tag_db.session.commit()
+    library.add_photo(10, b"ten")
+    library.add_photo(11, b"eleven")
+    library.add_photo(12, b"12")
+    library.add_tag("cats", ["thumb000000000000000a"])
+    library.add_tag("dogs", ["thumb000000000000000c"])
+    run_import(tag_db, library, media_path, workers)
+
+    # The user tags another file with a name Shotwell also uses.
+    tracked_file = tag_db.session.query(TrackedFile).filter_by(
+        original_filename="PhotoTable11.jpg").one()
+    tracked_file.tags.append(
+        tag_db.session.query(Tag).filter_by(name="cats").one())
+    tag_db.session.commit()
+    library.execute("UPDATE TagTable SET photo_id_list = ''")
+    run_import(tag_db, library, media_path, workers)
+    tag_db.session.expire_all()
+    assert get_tags_by_filename(tag_db) == {
+        "PhotoTable10.jpg": ["shotwell"],
+        "PhotoTable11.jpg": ["cats", "shotwell"],
+        "PhotoTable12.jpg": ["dogs", "shotwell"],
+    }
+
+
+@pytest.fixture
+def added_filepaths(monkeypatch):
+    filepaths = []
+    add_file = TrackedFile.add_file
+
+    def counting_add_file(**kwargs):
+        filepaths.append(os.path.basename(kwargs["copy_from_filepath"]))
+        return add_file(**kwargs)
+
+    monkeypatch.setattr(TrackedFile, "add_file", counting_add_file)
+    return filepaths
+
+
+def get_md5sums_by_filename(tag_db):
+    return dict(tag_db.session.query(
+        TrackedFile.original_filename, TrackedFile.md5sum))
+
+
+def test_import_is_incremental(library, media_path, workers,
+                               added_filepaths):
+    # Shotwell's md5sum is used as is while the file matches its row.
+    library.add_photo(1, b"one", md5="f" * 32)
+    library.add_photo(2, b"two", md5=None)
+    library.add_photo(3, b"three", md5="e" * 32)
+    library.execute(
+        "UPDATE PhotoTable SET filesize = filesize + 1 WHERE id = 3")
+    library.add_video(1, b"video")
+    library.execute(
+        "INSERT INTO PhotoTable (id, filename) VALUES (4, ?)",
+        os.path.join(library.path, "missing.jpg"))
+
+    tag_db = TagDB()
+    run_import(tag_db, library, media_path, workers)
+    assert sorted(added_filepaths) == [
+        "PhotoTable1.jpg", "PhotoTable2.jpg", "PhotoTable3.jpg",
+        "VideoTable1.jpg"]
+    assert get_md5sums_by_filename(tag_db) == {
+        "PhotoTable1.jpg": "f" * 32,
+        "PhotoTable2.jpg": hashlib.md5(b"two").hexdigest(),
+        "PhotoTable3.jpg": hashlib.md5(b"three").hexdigest(),
+        "VideoTable1.jpg": hashlib.md5(b"video").hexdigest(),
+    }
+
+    # Nothing changed, so nothing is read again.
+    del added_filepaths[:]
+    run_import(tag_db, library, media_path, workers)
+    assert added_filepaths == []
+
+    # Only rows Shotwell has seen change are.
+    _, filesize, timestamp = library.write_file("PhotoTable2.jpg", b"2")
+    library.execute(
+        "UPDATE PhotoTable SET filesize = ?, timestamp = ? WHERE id = 2",
+        filesize, timestamp)
+    run_import(tag_db, library, media_path, workers)
+    assert added_filepaths == ["PhotoTable2.jpg"]
+    assert tag_db.session.query(TrackedFile.md5sum).filter_by(
+        original_filename="PhotoTable2.jpg").all() == [
+        (hashlib.md5(b"two").hexdigest(),), (hashlib.md5(b"2").hexdigest(),)]
+
+
+def test_import_handles_deletions(library, media_path, workers):
+    library.add_photo(1, b"one")
+    library.add_photo(2, b"two")
+    tag_db = TagDB()
+    # Imported by an older version, before sync rows were kept.
+    legacy_file, _ = TrackedFile.add_file(
+        db_session=tag_db.session, media_path=media_path,
+        file_source="shotwell",
+        copy_from_filepath=library.write_file("old.jpg", b"old")[0])
+    legacy_file.tags.append(Tag(name="shotwell"))
+    tag_db.session.commit()
+
+    run_import(tag_db, library, media_path, workers)
+    library.execute("DELETE FROM PhotoTable WHERE id = 1")
+    library.insert(
+        "TombstoneTable", filepath="old.jpg",
+        md5=hashlib.md5(b"old").hexdigest())
+    run_import(tag_db, library, media_path, workers)
+    tag_db.session.expire_all()
+    # The files are kept, they just aren't in the library any more.
+    assert get_tags_by_filename(tag_db) == {
+        "PhotoTable1.jpg": [],
+        "PhotoTable2.jpg": ["shotwell"],
+        "old.jpg": [],
+    }
+    assert [source_id for (source_id,) in tag_db.session.query(
+        ShotwellSyncedMedia.source_id)] == ["thumb0000000000000002"]
+
+
+def get_descriptions_by_filename(tag_db):
+    return dict(
+        (filename, (title, comment)) for filename, title, comment in
+        tag_db.session.query(
+            TrackedFile.original_filename, TrackedFile.title,
+            TrackedFile.comment))
+
+
+def test_import_metadata(library, media_path, workers, added_filepaths):
+    library.insert("EventTable", id=1, name="Holiday")
+    library.insert("EventTable", id=2)
+    backing_filepath, filesize, timestamp = library.write_file(
+        "backing7.jpg", b"raw")
+    library.insert(
+        "BackingPhotoTable", id=7, filepath=backing_filepath,
+        filesize=filesize, timestamp=timestamp)
+    library.add_photo(
+        1, b"one", event_id=1, rating=5, title="Beach", comment="Sunny",
+        develop_camera_id=7)
+    library.add_photo(2, b"two", event_id=2, rating=-1)
+    library.add_video(1, b"video", event_id=1, rating=2, title="Clip")
+    library.add_tag("cats", ["thumb0000000000000001"])
+
+    tag_db = TagDB()
+    run_import(tag_db, library, media_path, workers)
+    assert get_tags_by_filename(tag_db) == {
+        "PhotoTable1.jpg": ["cats", "event:Holiday", "rating:5", "shotwell"],
+        # RAW developments and editor copies share their photo's tags.
+        "backing7.jpg": ["cats", "event:Holiday", "rating:5", "shotwell"],
+        "PhotoTable2.jpg": ["rating:rejected", "shotwell"],
+        "VideoTable1.jpg": ["event:Holiday", "rating:2", "shotwell"],
+    }
+    assert get_descriptions_by_filename(tag_db) == {
+        "PhotoTable1.jpg": ("Beach", "Sunny"),
+        "backing7.jpg": (None, None),
+        "PhotoTable2.jpg": (None, None),
+        "VideoTable1.jpg": ("Clip", None),
+    }
+
+    # Metadata changes are picked up without reading the files again.
+    del added_filepaths[:]
+    library.execute(
+        "UPDATE PhotoTable SET rating = 3, title = 'Beach day' WHERE id = 1")
+    library.execute("UPDATE EventTable SET name = 'Trip' WHERE id = 1")
+    run_import(tag_db, library, media_path, workers)
+    assert added_filepaths == []
+    tag_db.session.expire_all()
+    assert get_tags_by_filename(tag_db) == {
+        "PhotoTable1.jpg": ["cats", "event:Trip", "rating:3", "shotwell"],
+        "backing7.jpg": ["cats", "event:Trip", "rating:3", "shotwell"],
+        "PhotoTable2.jpg": ["rating:rejected", "shotwell"],
+        "VideoTable1.jpg": ["event:Trip", "rating:2", "shotwell"],
+    }
+    assert get_descriptions_by_filename(tag_db)["PhotoTable1.jpg"] == \
+        ("Beach day", "Sunny")
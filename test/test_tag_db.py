@@ -0,0 +1,102 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+import sqlite3
+
+from sqlalchemy import inspect
+from sqlalchemy.engine.url import URL
+
+from myarchive.db import db
+from myarchive.db.tag_db.tag_db import ADDED_COLUMNS, TagDB
+from myarchive.db.tag_db.tables.association_tables import (
+    at_ytplaylist_ytvideo, at_ytvideo_tag)
+from myarchive.db.tag_db.tables.file import TrackedFile
+from myarchive.db.tag_db.tables.yttables import YTPlaylist, YTVideo
+
+
+def test_add_missing_columns(tmpdir, monkeypatch):
+    # DB builds its URL with URL(), which SQLAlchemy 1.4 and up only allow
+    # through URL.create().
+    monkeypatch.setattr(db, "SQLAlchemyURL", getattr(URL, "create", URL))
+    db_path = str(tmpdir.join("tag_db.sqlite"))
+    tag_db = TagDB(drivername="sqlite", db_name=db_path)
+    tag_db.session.add(TrackedFile(
+        file_source="test", original_filename="old.jpg",
+        filepath="/media/old.jpg", md5sum="0" * 32))
+    tag_db.session.commit()
+    tag_db.session.close()
+    tag_db.engine.dispose()
+
+    # Roll the tables back to how older versions created them.
+    connection = sqlite3.connect(db_path)
+    for table_name, column_names in ADDED_COLUMNS:
+        for column_name in column_names:
+            connection.execute(
+                "ALTER TABLE %s DROP COLUMN %s" % (table_name, column_name))
+    connection.commit()
+    connection.close()
+
+    tag_db = TagDB(drivername="sqlite", db_name=db_path)
+    inspector = inspect(tag_db.engine)
+    for table_name, column_names in ADDED_COLUMNS:
+        existing_columns = set(
+            column["name"] for column in inspector.get_columns(table_name))
+        assert existing_columns.issuperset(column_names)
+    tracked_file = tag_db.session.query(TrackedFile).one()
+    assert tracked_file.original_filename == "old.jpg"
+    assert tracked_file.title is None
+    # Opening an up to date DB leaves it alone.
+    TagDB(drivername="sqlite", db_name=db_path)
+
+
+def test_migrate_ytvideos(tmpdir, monkeypatch):
+    monkeypatch.setattr(db, "SQLAlchemyURL", getattr(URL, "create", URL))
+    db_path = str(tmpdir.join("tag_db.sqlite"))
+    tag_db = TagDB(drivername="sqlite", db_name=db_path)
+    tag_db.session.close()
+    tag_db.engine.dispose()
+
+    # Recreate the tables as they were when a video had a single playlist.
+    connection = sqlite3.connect(db_path)
+    connection.executescript("""
+        DROP TABLE at_ytplaylist_ytvideo;
+        DROP TABLE ytvideos;
+        CREATE TABLE ytvideos (
+            id INTEGER NOT NULL PRIMARY KEY, uploader VARCHAR,
+            description VARCHAR, duration VARCHAR, publish_time DATETIME,
+            videoid VARCHAR, playlist_id INTEGER REFERENCES ytplaylists (id),
+            file_id INTEGER REFERENCES files (id));
+        CREATE INDEX ix_ytvideos_id ON ytvideos (id);
+        INSERT INTO ytplaylists (id, plid) VALUES (1, 'PL1'), (2, 'PL2');
+        INSERT INTO tags (tag_id, name) VALUES (5, 'cats'), (6, 'dogs');
+        INSERT INTO ytvideos (id, videoid, playlist_id) VALUES
+            (1, 'aaa', 1), (2, 'bbb', 1), (3, 'bbb', 2), (4, 'ccc', NULL);
+        INSERT INTO at_ytvideo_tag (ytvideo_id, tag_id) VALUES
+            (2, 5), (3, 5), (3, 6);
+    """)
+    connection.close()
+
+    tag_db = TagDB(drivername="sqlite", db_name=db_path)
+    assert sorted(tag_db.session.query(
+        at_ytplaylist_ytvideo.c.ytplaylist_id,
+        at_ytplaylist_ytvideo.c.ytvideo_id)) == [(1, 1), (1, 2), (2, 2)]
+    assert sorted(tag_db.session.query(
+        at_ytvideo_tag.c.ytvideo_id, at_ytvideo_tag.c.tag_id)) == [
+        (2, 5), (2, 6)]
+    assert sorted(tag_db.session.query(YTVideo.id, YTVideo.videoid)) == [
+        (1, "aaa"), (2, "bbb"), (4, "ccc")]
+    playlist = tag_db.session.query(YTPlaylist).filter_by(plid="PL2").one()
+    assert [video.videoid for video in playlist.videos] == ["bbb"]
+    assert {"name": "ix_ytvideos_videoid", "unique": 1} in [
+        {"name": index["name"], "unique": index["unique"]}
+        for index in inspect(tag_db.engine).get_indexes("ytvideos")]
+    tag_db.session.close()
+    tag_db.engine.dispose()
+    # Opening it again finds nothing left to do.
+    tag_db = TagDB(drivername="sqlite", db_name=db_path)
+    assert tag_db.session.query(at_ytplaylist_ytvideo).count() == 3
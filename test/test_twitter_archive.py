@@ -0,0 +1,175 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+import json
+import os
+
+import pytest
+
+from myarchive.db.tag_db.tables import file, tag
+from myarchive.db.tag_db.tag_db import TagDB
+from myarchive.db.tag_db.tables.association_tables import at_tweet_reply
+from myarchive.db.tag_db.tables.tag import Tag
+from myarchive.db.tag_db.tables.twittertables import Tweet, TwitterUser
+from myarchive.libs.myarchive import twitter
+from myarchive.libs.myarchive.twitter import import_tweets_from_archive
+from myarchive.util.workers import WorkerPools
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(tag, "RECENT_TAG_CACHE", dict())
+    monkeypatch.setattr(twitter, "REPLAY_BATCH_SIZE", 2)
+
+
+@pytest.fixture
+def workers():
+    with WorkerPools(processes=2, threads=1, chunk_size=2) as worker_pools:
+        yield worker_pools
+
+
+def dump_status(tweet_storage_path, status_dict):
+    filepath = os.path.join(
+        tweet_storage_path, "%s.json" % status_dict["id"])
+    with open(filepath, "w") as fptr:
+        json.dump(status_dict, fptr)
+
+
+def make_status_dict(tweet_id, user_id, **kwargs):
+    status_dict = {
+        "id": tweet_id,
+        "text": "tweet %s" % tweet_id,
+        "created_at": "Fri Jul 21 00:00:00 +0000 2017",
+        "user": {
+            "id": user_id, "name": "user%s" % user_id,
+            "screen_name": "user%s" % user_id},
+    }
+    status_dict.update(kwargs)
+    return status_dict
+
+
+def get_tag_names(db_session, tweet_id):
+    tweet = db_session.query(Tweet).filter_by(id=tweet_id).one()
+    return sorted(tweet_tag.name for tweet_tag in tweet.tags)
+
+
+def test_import_tweets_from_archive(tmpdir, workers):
+    tweet_storage_path = str(tmpdir)
+    dump_status(tweet_storage_path, make_status_dict(1, user_id=10))
+    dump_status(tweet_storage_path, make_status_dict(
+        2, user_id=20, in_reply_to_status_id=1))
+    # The flattened AsDict() form older runs wrote.
+    dump_status(tweet_storage_path, make_status_dict(
+        3, user_id=20, favorited=True, hashtags=[{"text": "cats"}]))
+    dump_status(tweet_storage_path, make_status_dict(
+        4, user_id=10, in_reply_to_status_id=2,
+        entities={"hashtags": [{"text": "dogs"}]}))
+    with open(os.path.join(tweet_storage_path, "5.json"), "w") as fptr:
+        fptr.write("{not json")
+    with open(os.path.join(tweet_storage_path, "notes.txt"), "w") as fptr:
+        fptr.write("Not a tweet.")
+
+    tag_db = TagDB()
+    import_tweets_from_archive(
+        database=tag_db, tweet_storage_path=tweet_storage_path,
+        username="me", workers=workers)
+    assert tag_db.get_existing_tweet_ids() == {1, 2, 3, 4}
+    assert sorted(user_id for (user_id,) in
+                  tag_db.session.query(TwitterUser.id)) == [10, 20]
+    assert get_tag_names(tag_db.session, 3) == [
+        "cats", "twitter.me.favorite", "twitter.user20.tweet"]
+    assert get_tag_names(tag_db.session, 4) == [
+        "dogs", "twitter.user10.tweet"]
+    # Replies are indexed across batches.
+    assert (1, 4, 2) in list(tag_db.session.query(
+        at_tweet_reply.c.ancestor_id, at_tweet_reply.c.descendant_id,
+        at_tweet_reply.c.depth))
+
+    # Known tweets are skipped without being read again.
+    dump_status(tweet_storage_path, make_status_dict(6, user_id=30))
+    os.remove(os.path.join(tweet_storage_path, "1.json"))
+    import_tweets_from_archive(
+        database=tag_db, tweet_storage_path=tweet_storage_path,
+        username="me", workers=workers)
+    assert tag_db.get_existing_tweet_ids() == {1, 2, 3, 4, 6}
+
+
+def test_replay_keeps_newest_profile(tmpdir, workers):
+    tweet_storage_path = str(tmpdir)
+    for tweet_id, name in ((4, "older"), (9, "newest"), (6, "old")):
+        status_dict = make_status_dict(tweet_id, user_id=10)
+        status_dict["user"]["name"] = name
+        status_dict["user"]["profile_image_url"] = "%s.png" % name
+        dump_status(tweet_storage_path, status_dict)
+
+    tag_db = TagDB()
+    import_tweets_from_archive(
+        database=tag_db, tweet_storage_path=tweet_storage_path,
+        username="me", workers=workers)
+    user = tag_db.session.query(TwitterUser).one()
+    assert (user.name, user.profile_status_id) == ("newest", 9)
+    user.files_downloaded = True
+    tag_db.session.commit()
+
+    # An older status archived later doesn't roll the profile back.
+    status_dict = make_status_dict(2, user_id=10)
+    status_dict["user"]["profile_image_url"] = "oldest.png"
+    dump_status(tweet_storage_path, status_dict)
+    import_tweets_from_archive(
+        database=tag_db, tweet_storage_path=tweet_storage_path,
+        username="me", workers=workers)
+    user = tag_db.session.query(TwitterUser).one()
+    assert (user.name, user.profile_image_url) == ("newest", "newest.png")
+    assert user.files_downloaded is True
+
+
+def test_download_media(tmpdir, monkeypatch, workers):
+    fetched_urls = []
+
+    def fake_fetch_url(url):
+        fetched_urls.append(url)
+        if "missing" in url:
+            return url, None
+        return url, url.encode("utf-8")
+
+    monkeypatch.setattr(file, "_fetch_url", fake_fetch_url)
+    monkeypatch.setattr(twitter, "MEDIA_BATCH_SIZE", 1)
+    tag_db = TagDB()
+    tweet = Tweet(
+        id=1, text="", in_reply_to_status_id=None, created_at=None,
+        media_urls_list=["http://t.co/a.jpg", "http://t.co/b.jpg"])
+    tweet.tags.append(Tag(name="cats"))
+    tag_db.session.add(tweet)
+    tag_db.session.add(Tweet(
+        id=2, text="", in_reply_to_status_id=None, created_at=None,
+        media_urls_list=["http://t.co/b.jpg", "http://t.co/missing.jpg"]))
+    tag_db.session.add(TwitterUser(
+        {"id": 10, "profile_image_url": "http://t.co/a.jpg"}))
+    tag_db.session.commit()
+
+    twitter.download_media(
+        db_session=tag_db.session, media_storage_path=str(tmpdir),
+        workers=workers)
+    # Files we already have aren't fetched again.
+    assert sorted(fetched_urls) == [
+        "http://t.co/a.jpg", "http://t.co/b.jpg", "http://t.co/missing.jpg"]
+    tweets = dict(
+        (tweet.id, tweet) for tweet in tag_db.session.query(Tweet))
+    assert sorted(
+        tracked_file.url for tracked_file in tweets[1].files) == [
+        "http://t.co/a.jpg", "http://t.co/b.jpg"]
+    assert [tracked_file.url for tracked_file in tweets[2].files] == [
+        "http://t.co/b.jpg"]
+    # Tweets pass their tags on to their files.
+    assert [[tag.name for tag in tracked_file.tags]
+            for tracked_file in tweets[1].files] == [["cats"], ["cats"]]
+    assert all(tweet.files_downloaded for tweet in tweets.values())
+    user = tag_db.session.query(TwitterUser).one()
+    assert [tracked_file.url for tracked_file in user.files] == [
+        "http://t.co/a.jpg"]
+    assert user.files_downloaded is True
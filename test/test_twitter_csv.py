@@ -0,0 +1,102 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+import csv
+import queue
+import threading
+
+import pytest
+
+from myarchive.db.tag_db.tag_db import TagDB
+from myarchive.libs.myarchive.twitter import (
+    TwitterAPI, _feed_csv_batches, iter_csv_tweet_batches)
+
+
+CSV_FIELDS = [
+    "tweet_id", "in_reply_to_status_id", "in_reply_to_user_id", "timestamp",
+    "source", "text", "retweeted_status_id", "retweeted_status_user_id",
+    "retweeted_status_timestamp", "expanded_urls"]
+
+
+class FakeLookupAPI(object):
+    """Stands in for TwitterAPI, with statuses/lookup returning nothing."""
+
+    def __init__(self):
+        self.looked_up_ids = []
+
+    def PacedLookupStatuses(self, status_ids):
+        self.looked_up_ids.extend(status_ids)
+        return []
+
+
+def write_csv(csv_filepath, tweet_ids):
+    with open(csv_filepath, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        for tweet_id in tweet_ids:
+            row = dict((field, "") for field in CSV_FIELDS)
+            row.update(
+                tweet_id=tweet_id, text="tweet %s" % tweet_id,
+                timestamp="2017-07-21 00:00:00 +0000")
+            writer.writerow(row)
+
+
+def import_csv(tmpdir, csv_filepath):
+    fake_api = FakeLookupAPI()
+    TwitterAPI.import_from_csv(
+        fake_api,
+        database=TagDB(),
+        tweet_storage_path=str(tmpdir),
+        csv_filepath=csv_filepath,
+        username="someone",
+        media_storage_path=str(tmpdir))
+    return fake_api
+
+
+def test_iter_csv_tweet_batches_skips_existing(tmpdir):
+    csv_filepath = str(tmpdir.join("tweets.csv"))
+    write_csv(csv_filepath, range(1, 8))
+    batches = list(iter_csv_tweet_batches(
+        csv_filepath=csv_filepath, username="someone",
+        existing_tweet_ids={2, 5}, batch_size=2))
+    assert [[csv_tweet.id for csv_tweet in batch] for batch in batches] == \
+        [[1, 3], [4, 6], [7]]
+
+
+def test_feeder_stops_workers_on_error():
+    def broken_batches():
+        yield ["batch"]
+        raise ValueError("bad row")
+
+    batch_queue = queue.Queue()
+    errors = []
+    _feed_csv_batches(
+        csv_batches=broken_batches(), batch_queue=batch_queue, num_workers=3,
+        stop_event=threading.Event(), errors=errors)
+    assert [batch_queue.get_nowait() for _ in range(4)] == \
+        [["batch"], None, None, None]
+    assert len(errors) == 1 and isinstance(errors[0], ValueError)
+
+
+def test_import_from_csv(tmpdir):
+    csv_filepath = str(tmpdir.join("tweets.csv"))
+    write_csv(csv_filepath, range(1, 251))
+    fake_api = import_csv(tmpdir, csv_filepath)
+    assert sorted(fake_api.looked_up_ids) == list(range(1, 251))
+
+
+def test_import_from_csv_raises_on_malformed_csv(tmpdir):
+    csv_filepath = str(tmpdir.join("tweets.csv"))
+    write_csv(csv_filepath, ["1", "2", "not an id", "4"])
+    with pytest.raises(ValueError):
+        import_csv(tmpdir, csv_filepath)
+
+
+def test_import_from_csv_raises_on_missing_csv(tmpdir):
+    with pytest.raises(FileNotFoundError):
+        import_csv(tmpdir, str(tmpdir.join("missing.csv")))
@@ -0,0 +1,91 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+from myarchive.db.tag_db.tag_db import TagDB
+from myarchive.db.tag_db.tables.association_tables import at_tweet_reply
+from myarchive.db.tag_db.tables.twittertables import (
+    Tweet, UnavailableTweet, get_missing_thread_ancestor_ids,
+    index_tweet_replies)
+from myarchive.libs.myarchive.twitter import RawStatus, TwitterAPI
+
+
+def make_status(tweet_id, in_reply_to_status_id=None):
+    return RawStatus({
+        "id": tweet_id,
+        "text": "tweet %s" % tweet_id,
+        "created_at": "Fri Jul 21 00:00:00 +0000 2017",
+        "in_reply_to_status_id": in_reply_to_status_id,
+        "user": {"id": 10, "screen_name": "someone"},
+    })
+
+
+class FakeLookupAPI(object):
+    """Stands in for TwitterAPI, serving statuses/lookup from a dict."""
+
+    def __init__(self, statuses):
+        self.statuses = dict((status.id, status) for status in statuses)
+        self.looked_up_ids = []
+
+    def PacedLookupStatuses(self, status_ids):
+        self.looked_up_ids.extend(status_ids)
+        return [
+            self.statuses[status_id] for status_id in status_ids
+            if status_id in self.statuses]
+
+
+def get_closure(db_session):
+    return sorted(db_session.query(
+        at_tweet_reply.c.ancestor_id, at_tweet_reply.c.descendant_id,
+        at_tweet_reply.c.depth).filter(at_tweet_reply.c.depth > 0))
+
+
+def add_tweet(db_session, tweet_id, in_reply_to_status_id):
+    db_session.add(Tweet(
+        id=tweet_id, text="", in_reply_to_status_id=in_reply_to_status_id,
+        created_at=None, media_urls_list=[]))
+
+
+def test_index_tweet_replies_either_end_first():
+    tag_db = TagDB()
+    # The middle of the chain 1 <- 2 <- 3 arrives last.
+    index_tweet_replies(tag_db.session, [(3, 2)])
+    index_tweet_replies(tag_db.session, [(1, None)])
+    index_tweet_replies(tag_db.session, [(2, 1)])
+    assert get_closure(tag_db.session) == [(1, 2, 1), (1, 3, 2), (2, 3, 1)]
+
+
+def test_backfill_remembers_unavailable_ancestors(tmpdir):
+    tag_db = TagDB()
+    # 4 replies to 3, which replies to 2, which replies to 1.
+    add_tweet(tag_db.session, 4, 3)
+    tag_db.session.commit()
+    # 3 and 1 are gone, 2 is still up.
+    fake_api = FakeLookupAPI([make_status(2, in_reply_to_status_id=1)])
+
+    TwitterAPI.backfill_thread_ancestors(
+        fake_api, database=tag_db, tweet_storage_path=str(tmpdir))
+    assert sorted(fake_api.looked_up_ids) == [3]
+    assert get_missing_thread_ancestor_ids(tag_db.session) == []
+    assert [tweet_id for (tweet_id,) in
+            tag_db.session.query(UnavailableTweet.id)] == [3]
+
+    # Now the archive picks up 3, and 2 and 1 become reachable.
+    add_tweet(tag_db.session, 3, 2)
+    index_tweet_replies(tag_db.session, [(3, 2)])
+    tag_db.session.commit()
+    TwitterAPI.backfill_thread_ancestors(
+        fake_api, database=tag_db, tweet_storage_path=str(tmpdir))
+    assert sorted(fake_api.looked_up_ids) == [1, 2, 3]
+    assert sorted(tweet_id for (tweet_id,) in
+                  tag_db.session.query(UnavailableTweet.id)) == [1, 3]
+    assert (1, 4, 3) in get_closure(tag_db.session)
+
+    # Nothing is looked up again on later runs.
+    TwitterAPI.backfill_thread_ancestors(
+        fake_api, database=tag_db, tweet_storage_path=str(tmpdir))
+    assert sorted(fake_api.looked_up_ids) == [1, 2, 3]
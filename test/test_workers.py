@@ -0,0 +1,98 @@
+# @Author: Zeta Syanthis <zetasyanthis>
+# @Date:   2017/07/21
+# @Email:  zeta@zetasyanthis.org
+# @Project: MyArchive
+# @Last modified by:   zetasyanthis
+# @Last modified time: 2017/07/21
+# @License MIT
+
+import threading
+import time
+
+import pytest
+
+from myarchive.util.workers import WorkerPools, borrow_workers
+
+
+def square(number):
+    return number * number
+
+
+def fail_on_three(number):
+    if number == 3:
+        raise ValueError("three")
+    return number
+
+
+class CountingIterable(object):
+    """Counts how many items have been read from it."""
+
+    def __init__(self, count):
+        self.count = count
+        self.read = 0
+
+    def __iter__(self):
+        for number in range(self.count):
+            self.read += 1
+            yield number
+
+
+@pytest.fixture
+def workers():
+    with WorkerPools(processes=2, threads=2, chunk_size=4,
+                     max_pending=3) as worker_pools:
+        yield worker_pools
+
+
+def test_process_imap_unordered(workers):
+    assert sorted(workers.process_imap_unordered(square, range(100))) == \
+        [number * number for number in range(100)]
+
+
+def test_imap_unordered_reads_ahead_max_pending_chunks(workers):
+    numbers = CountingIterable(1000)
+    results = workers.thread_imap_unordered(square, numbers, chunk_size=4)
+    next(results)
+    assert numbers.read == 3 * 4
+    assert len(list(results)) == 999
+    assert numbers.read == 1000
+
+
+def test_imap_unordered_raises_worker_errors(workers):
+    with pytest.raises(ValueError):
+        list(workers.process_imap_unordered(fail_on_three, range(10)))
+    with pytest.raises(ValueError):
+        list(workers.thread_imap_unordered(fail_on_three, range(10)))
+
+
+def test_thread_imap_keeps_order(workers):
+    def slow_for_small(number):
+        time.sleep(0.01 * (5 - number % 5))
+        return number
+
+    numbers = CountingIterable(20)
+    results = workers.thread_imap(slow_for_small, numbers, lookahead=4)
+    assert next(results) == 0
+    assert numbers.read == 4
+    assert list(results) == list(range(1, 20))
+
+
+def test_start_starts_both_pools():
+    worker_pools = WorkerPools(processes=1, threads=1)
+    threads_before = threading.active_count()
+    try:
+        process_pool, thread_pool = worker_pools.start()
+        assert worker_pools.process_pool is process_pool
+        assert worker_pools.thread_pool is thread_pool
+        assert threading.active_count() > threads_before
+    finally:
+        worker_pools.close()
+
+
+def test_borrow_workers(workers):
+    with borrow_workers(workers) as borrowed:
+        assert borrowed is workers
+    with borrow_workers() as private_workers:
+        assert list(private_workers.thread_imap(square, range(3))) == \
+            [0, 1, 4]
+    assert private_workers._thread_pool is None